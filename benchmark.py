@@ -0,0 +1,1555 @@
+"""
+Equivalence checks and micro-benchmarks for the performance work on CrossModel.
+
+Every sub command first verifies that the optimized path reproduces the
+reference computation and then times both, e.g.
+
+    python benchmark.py attention --batch_size 32 --seq_len 256
+"""
+import argparse
+import copy
+import json
+import math
+import os
+import pickle as pkl
+import random
+import tempfile
+import time
+import warnings
+
+import torch
+import torch.nn.functional as F
+
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from nltk.translate.bleu_score import sentence_bleu
+
+from models.inference import (
+    CrossModelInference,
+    NodeTable,
+    OnnxServing,
+    check_parity,
+    compile_serving,
+    export_onnx,
+    generate,
+    model_size,
+    pad_seed_sets,
+    quantize,
+    trace,
+)
+from models.transformer import (
+    MultiHeadAttention,
+    TransformerDecoderKG,
+    TransformerEncoder,
+)
+from checkpoint import (
+    AsyncCheckpointWriter,
+    TrainProgress,
+    atomic_save,
+    load_grad_accum,
+    load_states,
+)
+from metrics import LossLog, RecMetrics, bleu_scores, distinct
+from models.utils import EvalBatches, autocast, configure_cpu, neginf
+from profiling import disable_profiling, enable_profiling, iterate, region
+
+
+def _timeit(fn, repeats, warmup=3):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def _report(name, ref_ms, new_ms):
+    print(f"{name:<36} reference {ref_ms:8.3f} ms   optimized {new_ms:8.3f} ms   speedup {ref_ms / new_ms:5.2f}x")
+
+
+def reference_attention(attn, query, key=None, value=None, mask=None):
+    """The original bmm based MultiHeadAttention.forward, kept for comparison."""
+    batch_size, query_len, dim = query.size()
+    n_heads = attn.n_heads
+    dim_per_head = dim // n_heads
+    scale = math.sqrt(dim_per_head)
+
+    def prepare_head(tensor):
+        _, seq_len, _ = tensor.size()
+        tensor = tensor.view(batch_size, tensor.size(1), n_heads, dim_per_head)
+        tensor = (
+            tensor.transpose(1, 2)
+            .contiguous()
+            .view(batch_size * n_heads, seq_len, dim_per_head)
+        )
+        return tensor
+
+    if key is None and value is None:
+        key = value = query
+    elif value is None:
+        value = key
+    _, key_len, dim = key.size()
+
+    q = prepare_head(attn.q_lin(query))
+    k = prepare_head(attn.k_lin(key))
+    v = prepare_head(attn.v_lin(value))
+
+    dot_prod = q.div_(scale).bmm(k.transpose(1, 2))
+    attn_mask = (
+        (mask == 0)
+        .view(batch_size, 1, -1, key_len)
+        .repeat(1, n_heads, 1, 1)
+        .expand(batch_size, n_heads, query_len, key_len)
+        .view(batch_size * n_heads, query_len, key_len)
+    )
+    dot_prod.masked_fill_(attn_mask, neginf(dot_prod.dtype))
+    attn_weights = F.softmax(dot_prod, dim=-1).type_as(query)
+    attn_weights = attn.attn_dropout(attn_weights)
+    attentioned = attn_weights.bmm(v)
+    attentioned = (
+        attentioned.type_as(query)
+        .view(batch_size, n_heads, query_len, dim_per_head)
+        .transpose(1, 2)
+        .contiguous()
+        .view(batch_size, query_len, dim)
+    )
+    return attn.out_lin(attentioned)
+
+
+def bench_attention(args):
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    attn = MultiHeadAttention(args.n_heads, args.dim).to(device).eval()
+    bsz, seq_len, dim = args.batch_size, args.seq_len, args.dim
+
+    x = torch.randn(bsz, seq_len, dim, device=device)
+    memory = torch.randn(bsz, args.memory_len, dim, device=device)
+    # right padded sequences, the first row keeps no valid token at all
+    lengths = torch.randint(1, seq_len + 1, (bsz,), device=device)
+    lengths[0] = 0
+    pad_mask = torch.arange(seq_len, device=device)[None, :] < lengths[:, None]
+    mem_lengths = torch.randint(1, args.memory_len + 1, (bsz,), device=device)
+    mem_mask = torch.arange(args.memory_len, device=device)[None, :] < mem_lengths[:, None]
+    causal = torch.tril(x.new_ones(seq_len, seq_len)).unsqueeze(0).expand(bsz, -1, -1)
+
+    cases = [
+        ("encoder self attention", dict(query=x, mask=pad_mask)),
+        ("decoder causal attention", dict(query=x, mask=causal)),
+        ("decoder memory attention", dict(query=x, key=memory, value=memory, mask=mem_mask)),
+    ]
+    with torch.no_grad():
+        for name, kwargs in cases:
+            expected = reference_attention(attn, **kwargs)
+            worst = 0.0
+            for use_sdpa in (True, False):
+                attn.use_sdpa = use_sdpa
+                got = attn(**kwargs)
+                err = (got - expected).abs().max().item()
+                assert torch.allclose(got, expected, atol=args.atol, rtol=1e-4), (
+                    f"{name} (sdpa={use_sdpa}) differs from the reference by {err}"
+                )
+                worst = max(worst, err)
+            print(f"{name:<36} max abs diff {worst:.2e}  ok")
+
+        attn.use_sdpa = True
+        for name, kwargs in cases:
+            ref_ms = _timeit(lambda: reference_attention(attn, **kwargs), args.repeats)
+            new_ms = _timeit(lambda: attn(**kwargs), args.repeats)
+            _report(name, ref_ms, new_ms)
+
+
+def bench_encoder(args):
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    embedding = nn.Embedding(args.vocab_size, args.dim, padding_idx=0)
+    encoder = TransformerEncoder(
+        n_heads=args.n_heads,
+        n_layers=args.n_layers,
+        embedding_size=args.dim,
+        ffn_size=args.dim,
+        vocabulary_size=args.vocab_size,
+        embedding=embedding,
+        padding_idx=0,
+        embeddings_scale=True,
+        reduction=False,
+    )
+    encoder = encoder.to(device).eval()
+
+    # right padded contexts, lengths skewed towards short dialogues like ReDial
+    bsz, seq_len = args.batch_size, args.seq_len
+    lengths = (torch.rand(bsz) ** 2 * seq_len).long().clamp_(min=1).to(device)
+    xs = torch.randint(1, args.vocab_size, (bsz, seq_len), device=device)
+    xs.masked_fill_(torch.arange(seq_len, device=device)[None, :] >= lengths[:, None], 0)
+    print(f"real tokens {int(lengths.sum())} of {bsz * seq_len} positions")
+
+    with torch.no_grad():
+        encoder.length_buckets = 0
+        expected, expected_mask = encoder(xs)
+        ref_ms = _timeit(lambda: encoder(xs), args.repeats)
+        for buckets in (1, 2, 4, 8):
+            encoder.length_buckets = buckets
+            output, mask = encoder(xs)
+            longest = output.size(1)
+            assert torch.equal(mask, expected_mask[:, :longest])
+            assert not expected_mask[:, longest:].any()
+            err = (output - expected[:, :longest]).abs().max().item()
+            assert err < args.atol, f"{buckets} buckets differ from the reference by {err}"
+            new_ms = _timeit(lambda: encoder(xs), args.repeats)
+            _report(f"{buckets} length bucket(s), diff {err:.1e}", ref_ms, new_ms)
+
+
+def _dialogue_contexts(args, split_idx, end_idx=2):
+    """Consecutive cases of synthetic dialogues, built like padding_context."""
+    contexts = []
+    for _ in range(args.n_dialogues):
+        turns = []
+        for _ in range(args.n_turns):
+            length = int(torch.randint(5, 30, (1,)))
+            turns.append(torch.randint(4, split_idx, (length,)).tolist())
+            if len(turns) < 2:
+                continue
+            context = []
+            for utterance in turns[-args.max_count : -1]:
+                context.extend(utterance + [split_idx])
+            context.extend(turns[-1] + [end_idx])
+            context = context[-args.seq_len :]
+            contexts.append(context + [0] * (args.seq_len - len(context)))
+    return torch.tensor(contexts)
+
+
+def bench_utterance_cache(args):
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    split_idx = args.vocab_size - 1
+    embedding = nn.Embedding(args.vocab_size, args.dim, padding_idx=0)
+    encoder = TransformerEncoder(
+        n_heads=args.n_heads,
+        n_layers=args.n_layers,
+        embedding_size=args.dim,
+        ffn_size=args.dim,
+        vocabulary_size=args.vocab_size,
+        embedding=embedding,
+        padding_idx=0,
+        embeddings_scale=True,
+        reduction=False,
+        length_buckets=4,
+        attention="hierarchical",
+        split_idx=split_idx,
+        cache_size=args.cache_size,
+    )
+    encoder = encoder.to(device).eval()
+    contexts = _dialogue_contexts(args, split_idx).to(device)
+    print(f"{len(contexts)} cases from {args.n_dialogues} dialogues")
+
+    def run(batches, attention, cache):
+        encoder.attention = attention
+        encoder.utterance_cache.clear()
+        encoder.utterance_cache.hits = encoder.utterance_cache.misses = 0
+        saved, encoder.utterance_cache = encoder.utterance_cache, (
+            encoder.utterance_cache if cache else None
+        )
+        start = time.perf_counter()
+        outputs = [encoder(xs) for xs in batches]
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) * 1000
+        encoder.utterance_cache = saved
+        return outputs, elapsed
+
+    # batched offline evaluation, then one case at a time like a live session
+    for batch_size in (args.batch_size, 1):
+        batches = contexts.split(batch_size)
+        with torch.no_grad():
+            _, full_ms = run(batches, "full", False)
+            expected, uncached_ms = run(batches, "hierarchical", False)
+            cached, cached_ms = run(batches, "hierarchical", True)
+        err = 0.0
+        for (out, mask), (ref, ref_mask) in zip(cached, expected):
+            assert torch.equal(mask, ref_mask)
+            err = max(err, (out - ref).abs().max().item())
+        assert err < args.atol, f"cached encodings differ by {err}"
+        cache = encoder.utterance_cache
+        hit_rate = cache.hits / max(cache.hits + cache.misses, 1)
+        print(f"batch size {batch_size}: cache hit rate {hit_rate:.2%}, max abs diff {err:.1e}")
+        _report("  hierarchical vs full attention", full_ms, uncached_ms)
+        _report("  with utterance cache", uncached_ms, cached_ms)
+        _report("  cached hierarchical vs full", full_ms, cached_ms)
+
+
+def _window_reference_mask(mask, global_mask, window):
+    """Dense [B, L, L] mask of what windowed attention lets every token see."""
+    steps = torch.arange(mask.size(1), device=mask.device)
+    band = (steps[:, None] - steps[None, :]).abs() <= window
+    global_mask = global_mask & mask
+    allowed = (band[None] & ~global_mask[:, None, :]) | global_mask[:, None, :]
+    allowed = allowed | global_mask[:, :, None]
+    return allowed & mask[:, None, :]
+
+
+def _peak_memory(fn):
+    if not torch.cuda.is_available():
+        fn()
+        return None
+    torch.cuda.reset_peak_memory_stats()
+    fn()
+    return torch.cuda.max_memory_allocated() / 2 ** 20
+
+
+def bench_window(args):
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    attn = MultiHeadAttention(args.n_heads, args.dim).to(device).eval()
+
+    def inputs(seq_len):
+        x = torch.randn(args.batch_size, seq_len, args.dim, device=device)
+        lengths = torch.randint(seq_len // 2, seq_len + 1, (args.batch_size,), device=device)
+        mask = torch.arange(seq_len, device=device)[None, :] < lengths[:, None]
+        # a _split_ token roughly every 20 tokens
+        global_mask = torch.rand(args.batch_size, seq_len, device=device) < 0.05
+        return x, mask, global_mask
+
+    with torch.no_grad():
+        x, mask, global_mask = inputs(args.check_len)
+        expected = attn(x, mask=_window_reference_mask(mask, global_mask, args.window))
+        got = attn.forward_windowed(x, mask, args.window, global_mask)
+        err = ((got - expected).abs().max(dim=-1)[0] * mask).max().item()
+        assert err < args.atol, f"windowed attention differs from the dense mask by {err}"
+        print(f"windowed vs dense masked attention, max abs diff {err:.1e}  ok")
+
+        for seq_len in args.seq_lens:
+            x, mask, global_mask = inputs(seq_len)
+            full = lambda: attn(x, mask=mask)
+            windowed = lambda: attn.forward_windowed(x, mask, args.window, global_mask)
+            ref_ms = _timeit(full, args.repeats, warmup=1)
+            new_ms = _timeit(windowed, args.repeats, warmup=1)
+            _report(f"seq_len {seq_len}", ref_ms, new_ms)
+            ref_mb, new_mb = _peak_memory(full), _peak_memory(windowed)
+            if ref_mb is not None:
+                print(f"{'':<36} peak memory {ref_mb:8.1f} MB -> {new_mb:8.1f} MB")
+            else:
+                rows = args.batch_size * args.n_heads * seq_len
+                n_global = int(global_mask.sum(dim=1).max())
+                print(
+                    f"{'':<36} attention scores {rows * seq_len / 1e6:8.1f} M"
+                    f" -> {rows * (3 * args.window + n_global) / 1e6:8.1f} M elements"
+                )
+
+
+class _Seq2Seq(nn.Module):
+    """Context encoder, KG decoder and vocabulary projection of CrossModel."""
+
+    def __init__(self, args):
+        super().__init__()
+        self.embeddings = nn.Embedding(args.vocab_size, args.dim, padding_idx=0)
+        nn.init.normal_(self.embeddings.weight, 0, args.dim ** -0.5)
+        layers = dict(
+            n_heads=args.n_heads,
+            n_layers=args.n_layers,
+            embedding_size=args.dim,
+            ffn_size=args.dim,
+            vocabulary_size=args.vocab_size,
+            embedding=self.embeddings,
+            padding_idx=0,
+            embeddings_scale=True,
+        )
+        self.encoder = TransformerEncoder(reduction=False, length_buckets=4, **layers)
+        self.decoder = TransformerDecoderKG(**layers)
+        self.criterion = nn.CrossEntropyLoss(ignore_index=0)
+
+    def forward(self, xs, ys, kg, db):
+        encoder_states = self.encoder(xs)
+        inputs = torch.cat([ys.new_ones(ys.size(0), 1), ys[:, :-1]], 1)
+        latent, _ = self.decoder(inputs, encoder_states, kg, db)
+        logits = F.linear(latent, self.embeddings.weight)
+        loss = self.criterion(logits.float().view(-1, logits.size(-1)), ys.view(-1))
+        return logits, loss
+
+
+def _fixed_batch(args, device):
+    """The same synthetic ReDial-shaped batch for every precision."""
+    g = torch.Generator().manual_seed(args.seed)
+    bsz = args.batch_size
+    lengths = (torch.rand(bsz, generator=g) ** 2 * args.seq_len).long().clamp_(min=1)
+    xs = torch.randint(4, args.vocab_size, (bsz, args.seq_len), generator=g)
+    xs.masked_fill_(torch.arange(args.seq_len)[None, :] >= lengths[:, None], 0)
+    ys = torch.randint(4, args.vocab_size, (bsz, args.response_len), generator=g)
+    kg = (torch.randn(bsz, 50, args.dim, generator=g), torch.rand(bsz, 50, generator=g) < 0.2)
+    db = (torch.randn(bsz, 50, args.dim, generator=g), torch.rand(bsz, 50, generator=g) < 0.1)
+    to = lambda t: t.to(device)
+    return to(xs), to(ys), tuple(map(to, kg)), tuple(map(to, db))
+
+
+def bench_precision(args):
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = _Seq2Seq(args).to(device)
+    batch = _fixed_batch(args, device)
+
+    def train_step(precision):
+        model.zero_grad()
+        with autocast(precision, device.type):
+            _, loss = model(*batch)
+        loss.backward()
+
+    def inference(precision):
+        with torch.no_grad(), autocast(precision, device.type):
+            return model(*batch)
+
+    results = {}
+    for precision in args.precisions:
+        if precision == "fp16" and device.type == "cpu":
+            print("fp16 autocast needs CUDA, skipped")
+            continue
+        model.train()
+        train_ms = _timeit(lambda: train_step(precision), args.repeats, warmup=1)
+        model.eval()
+        logits, loss = inference(precision)
+        eval_ms = _timeit(lambda: inference(precision), args.repeats, warmup=1)
+        results[precision] = (logits.float(), loss.item(), train_ms, eval_ms)
+
+    ref_logits, ref_loss, ref_train, ref_eval = results["fp32"]
+    print(f"fp32: loss {ref_loss:.5f}, train step {ref_train:.1f} ms, inference {ref_eval:.1f} ms")
+    for precision, (logits, loss, train_ms, eval_ms) in results.items():
+        if precision == "fp32":
+            continue
+        agree = (logits.argmax(-1) == ref_logits.argmax(-1)).float().mean().item()
+        print(
+            f"{precision}: loss {loss:.5f} (delta {loss - ref_loss:+.2e}), "
+            f"argmax agreement with fp32 {agree:.2%}"
+        )
+        _report(f"  train step ({precision})", ref_train, train_ms)
+        _report(f"  inference ({precision})", ref_eval, eval_ms)
+
+
+def bench_threads(args):
+    torch.manual_seed(args.seed)
+    configure_cpu(0, args.inter_op_threads, args.numa_node)
+    model = _Seq2Seq(args)
+    batch = _fixed_batch(args, torch.device("cpu"))
+
+    def train_step():
+        model.zero_grad()
+        _, loss = model(*batch)
+        loss.backward()
+
+    def inference():
+        with torch.no_grad():
+            return model(*batch)[0]
+
+    print(f"CPU affinity: {len(os.sched_getaffinity(0))} cores, "
+          f"inter-op threads: {torch.get_num_interop_threads()}")
+    ref_logits = None
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        model.eval()
+        logits = inference()
+        if ref_logits is None:
+            ref_logits = logits
+        # the kernels split their work differently, the results stay close
+        assert torch.allclose(logits, ref_logits, atol=args.atol), (
+            f"{threads} threads differ by {(logits - ref_logits).abs().max():.2e}"
+        )
+        eval_ms = _timeit(inference, args.repeats, warmup=1)
+        model.train()
+        train_ms = _timeit(train_step, args.repeats, warmup=1)
+        print(
+            f"{threads:3d} intra-op threads   "
+            f"train {args.batch_size * 1000 / train_ms:8.1f} samples/s   "
+            f"inference {args.batch_size * 1000 / eval_ms:8.1f} samples/s"
+        )
+
+
+def _shard(batch, rank, world_size):
+    """The slice of a _fixed_batch that process ``rank`` trains on."""
+    xs, ys, kg, db = batch
+    bsz = xs.size(0) // world_size
+    cut = lambda t: t[rank * bsz : (rank + 1) * bsz]
+    return cut(xs), cut(ys), tuple(map(cut, kg)), tuple(map(cut, db))
+
+
+def _ddp_worker(rank, world_size, args, init_file, results):
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    # as run.py does, the cores are split between the processes
+    torch.set_num_threads(max(1, len(os.sched_getaffinity(0)) // world_size))
+    torch.manual_seed(args.seed)
+    model = _Seq2Seq(args)
+    reference = copy.deepcopy(model)
+    ddp = nn.parallel.DistributedDataParallel(
+        model, find_unused_parameters=True, broadcast_buffers=False
+    )
+    global_args = copy.copy(args)
+    global_args.batch_size = args.batch_size * world_size
+    full_batch = _fixed_batch(global_args, torch.device("cpu"))
+    batch = _shard(full_batch, rank, world_size)
+
+    # the all-reduced gradient of the shards is the full batch gradient
+    # (every response has the same number of tokens, so the mean losses agree)
+    ddp(*batch)[1].backward()
+    if rank == 0:
+        reference(*full_batch)[1].backward()
+        diff = max(
+            (p.grad - r.grad).abs().max().item()
+            for p, r in zip(model.parameters(), reference.parameters())
+            if r.grad is not None
+        )
+        assert diff < args.atol, f"{world_size} processes: gradients differ by {diff:.2e}"
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+    def train_step():
+        optimizer.zero_grad()
+        _, loss = ddp(*batch)
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(2):
+        train_step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        train_step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        results.put((diff, elapsed / args.repeats))
+    dist.destroy_process_group()
+
+
+def bench_ddp(args):
+    results = mp.get_context("spawn").SimpleQueue()
+    throughput = {}
+    for world_size in args.processes:
+        with tempfile.TemporaryDirectory() as tmp:
+            mp.spawn(
+                _ddp_worker,
+                args=(world_size, args, os.path.join(tmp, "init"), results),
+                nprocs=world_size,
+            )
+        diff, step_s = results.get()
+        throughput[world_size] = world_size * args.batch_size / step_s
+        efficiency = throughput[world_size] / (world_size * throughput[args.processes[0]] / args.processes[0])
+        print(
+            f"{world_size} processes   gradient diff {diff:.1e}   "
+            f"step {step_s * 1000:8.1f} ms   "
+            f"{throughput[world_size]:8.1f} samples/s   "
+            f"scaling efficiency {efficiency:6.1%}"
+        )
+
+
+def _saved_activation_bytes(model, fn):
+    """Bytes of non-parameter tensors autograd keeps for backward during fn."""
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in params:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(saved.values())
+
+
+def bench_checkpointing(args):
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = _Seq2Seq(args).to(device).train()
+    batch = _fixed_batch(args, device)
+
+    def forward():
+        return model(*batch)[1]
+
+    def train_step():
+        model.zero_grad()
+        forward().backward()
+
+    configs = {
+        "none": (False, False),
+        "encoder": (True, False),
+        "decoder": (False, True),
+        "all": (True, True),
+    }
+    grads, ref = {}, None
+    for name, (encoder, decoder) in configs.items():
+        model.encoder.checkpoint_activations = encoder
+        model.decoder.checkpoint_activations = decoder
+        torch.manual_seed(args.seed)
+        train_step()
+        grads[name] = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+        saved = _saved_activation_bytes(model, forward) / 2 ** 20
+        step_ms = _timeit(train_step, args.repeats, warmup=1)
+        peak = _peak_memory(train_step)
+        if ref is None:
+            ref = (saved, step_ms)
+        err = max(
+            (g - r).abs().max().item() for g, r in zip(grads[name], grads["none"])
+        )
+        line = (
+            f"{name:<8} saved activations {saved:8.1f} MB ({saved - ref[0]:+8.1f} MB), "
+            f"train step {step_ms:8.1f} ms ({step_ms / ref[1] - 1:+.1%} recompute), "
+            f"grad diff {err:.1e}"
+        )
+        if peak is not None:
+            line += f", peak memory {peak:8.1f} MB"
+        print(line)
+
+
+class _Preempted(Exception):
+    pass
+
+
+def _resume_loop(args, directory, resume=False, stop_at=None):
+    """
+    The rec stage of TrainLoop_fusion_rec on a small dropout MLP.
+
+    The optimizer, accumulation and checkpoint methods are those of run.py;
+    the state is restored as TrainLoop_fusion_rec.__init__ does on --resume.
+    Raises _Preempted after step ``stop_at``.
+    """
+    from run import TrainLoop_fusion_rec, train_loader
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    loop = TrainLoop_fusion_rec.__new__(TrainLoop_fusion_rec)
+    loop.opt = dict(
+        optimizer="adam",
+        learningrate=1e-2,
+        gradient_clip=0.1,
+        precision="fp32",
+        update_freq=args.update_freq,
+        checkpoint_every=args.checkpoint_every,
+    )
+    loop.model = loop.parallel_model = nn.Sequential(
+        nn.Linear(args.dim, 4 * args.dim), nn.Dropout(0.3), nn.Linear(4 * args.dim, 1)
+    )
+    loop.run_dir, loop.logs = directory, {}
+    loop.checkpoint_writer = AsyncCheckpointWriter(1)
+    states = load_states(directory, loop.model) if resume else {}
+    loop.progress = TrainProgress(["rec"], states if resume else None)
+    loop.init_optim(
+        list(loop.model.parameters()),
+        optim_states=states.get("optimizer"),
+        saved_optim_type=states.get("optimizer_type"),
+    )
+    loop._number_grad_accum = load_grad_accum(loop.model, states)
+
+    g = torch.Generator().manual_seed(args.seed)
+    x = torch.randn(args.batches * 4, args.dim, generator=g)
+    train_set = torch.utils.data.TensorDataset(x, x.sum(1, keepdim=True))
+    try:
+        for epoch in range(args.epochs):
+            if loop.progress.done("rec", epoch):
+                continue
+            skip = loop.progress.start("rec", epoch)
+            for x, y in loop.progress.batches(train_loader(train_set, 4, epoch, skip)):
+                loop.zero_grad()
+                with loop.no_sync():
+                    loss = (loop.parallel_model(x) - y).pow(2).mean()
+                loop.backward(loss)
+                loop.update_params()
+                loop.progress.step()
+                if loop.checkpoint_due():
+                    loop.save_checkpoint()
+                if loop.progress.steps == stop_at:
+                    raise _Preempted
+            loop.progress.end_epoch()
+            loop.save_checkpoint()
+    finally:
+        loop.checkpoint_writer.wait()
+    return torch.cat([p.detach().flatten() for p in loop.model.parameters()])
+
+
+def bench_resume(args):
+    steps = args.epochs * args.batches
+    with tempfile.TemporaryDirectory() as tmp:
+        ref = _resume_loop(args, os.path.join(tmp, "ref"))
+        for stop_at in range(1, steps):
+            directory = os.path.join(tmp, str(stop_at))
+            try:
+                _resume_loop(args, directory, stop_at=stop_at)
+            except _Preempted:
+                pass
+            if not os.path.exists(os.path.join(directory, "checkpoint.pt")):
+                continue
+            out = _resume_loop(args, directory, resume=True)
+            assert torch.equal(out, ref), f"resumed after step {stop_at}: parameters differ"
+    print(
+        f"resumed at every step of {args.epochs} epochs of {args.batches} batches "
+        f"with update_freq {args.update_freq}: parameters are bit-exact"
+    )
+
+
+class _EvalCases(torch.utils.data.Dataset):
+    """Synthetic cases with the fields and __getitem__ work of CRSdataset."""
+
+    def __init__(self, args):
+        rng = np.random.RandomState(args.seed)
+        self.args = args
+        self.cases = [
+            (
+                rng.randint(4, 20000, args.seq_len),
+                rng.randint(1, 30),
+                rng.randint(4, 20000, args.response_len),
+                rng.randint(1, 30),
+                rng.randint(4, 20000, args.response_len),
+                rng.randint(1, 30),
+                rng.randint(0, args.n_entity, rng.randint(1, 20)).tolist(),
+                rng.randint(0, args.n_entity),
+                rng.randint(0, args.n_concept, 50),
+                rng.randint(0, args.n_entity, 50),
+                1,
+            )
+            for _ in range(args.cases)
+        ]
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __getitem__(self, index):
+        (context, c_len, response, r_len, mask_response, mask_r_len, entity, movie,
+         concept_mask, dbpedia_mask, rec) = self.cases[index]
+        entity_vec = np.zeros(self.args.n_entity)
+        entity_vector = np.zeros(50, dtype=np.int64)
+        for point, en in enumerate(entity):
+            entity_vec[en] = 1
+            entity_vector[point] = en
+        concept_vec = np.zeros(self.args.n_concept + 1)
+        concept_vec[concept_mask[concept_mask != 0]] = 1
+        db_vec = np.zeros(self.args.n_entity)
+        db_vec[dbpedia_mask[dbpedia_mask != 0]] = 1
+        return (context, c_len, response, r_len, mask_response, mask_r_len, entity_vec,
+                entity_vector, movie, concept_mask, dbpedia_mask, concept_vec, db_vec, rec)
+
+
+def bench_eval_cache(args):
+    cases = _EvalCases(args)
+
+    def loader():
+        return torch.utils.data.DataLoader(cases, batch_size=args.batch_size, shuffle=False)
+
+    cached = EvalBatches(loader())
+    for batch, reference in zip(cached, loader()):
+        assert all(torch.equal(a, b) for a, b in zip(batch, reference))
+    dense = sum(t.numel() * t.element_size() for batch in loader() for t in batch)
+    stored = sum(
+        t.indices().nbytes + t.values().nbytes if t.is_sparse else t.numel() * t.element_size()
+        for batch in cached.batches
+        for t in batch
+    )
+    print(
+        f"{len(cases)} cases, {len(cached)} batches: "
+        f"{dense / 2 ** 20:.0f} MB dense, {stored / 2 ** 20:.1f} MB cached"
+    )
+
+    def consume(batches):
+        for batch in batches:
+            # the only per batch work of val() that is not model time
+            [batch[6][b].nonzero().view(-1).tolist() for b in range(batch[0].size(0))]
+
+    ref_ms = _timeit(lambda: consume(loader()), args.repeats, warmup=1)
+    new_ms = _timeit(lambda: consume(cached), args.repeats, warmup=1)
+    _report("data time per val()", ref_ms, new_ms)
+
+
+def _checkpoint_state(args):
+    """Tensors shaped like the large parts of a CrossModel checkpoint."""
+    g = torch.Generator().manual_seed(args.seed)
+    model = {
+        "embeddings.weight": torch.randn(args.vocab_size, args.dim, generator=g),
+        "output_en.weight": torch.randn(args.vocab_size, args.dim, generator=g),
+        "copy_norm.weight": torch.randn(args.vocab_size, args.dim, generator=g),
+        "dbpedia_RGCN.weight": torch.randn(
+            args.num_bases, args.n_entity, args.dim, generator=g
+        ),
+    }
+    # Adam keeps two moments per parameter
+    optimizer = {
+        name: {"exp_avg": torch.zeros_like(p), "exp_avg_sq": torch.zeros_like(p)}
+        for name, p in model.items()
+    }
+    return {"model": model, "optimizer": optimizer}
+
+
+def bench_checkpoint(args):
+    state = _checkpoint_state(args)
+    size = sum(
+        t.numel() * t.element_size()
+        for part in (state["model"], *state["optimizer"].values())
+        for t in part.values()
+    )
+    x = torch.randn(args.batch_size, args.dim)
+    w = torch.randn(args.dim, args.dim)
+
+    def train(save):
+        """Steps that change the state, with a checkpoint every few steps."""
+        blocked = 0.0
+        start = time.perf_counter()
+        for step in range(1, args.steps + 1):
+            for _ in range(args.step_work):
+                torch.mm(x, w)
+            state["model"]["embeddings.weight"][0] = step
+            if step % args.save_every == 0:
+                t = time.perf_counter()
+                save(state, path)
+                blocked += time.perf_counter() - t
+        return time.perf_counter() - start, blocked
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "checkpoint.pt")
+        sync_s, sync_blocked = train(atomic_save)
+        print(
+            f"checkpoint of {size / 2 ** 20:.0f} MB, "
+            f"{args.steps // args.save_every} saves in {args.steps} steps"
+        )
+        for in_flight in args.in_flight:
+            writer = AsyncCheckpointWriter(in_flight)
+            # the snapshot is taken at save(), later steps do not leak into it
+            writer.save(state, path)
+            state["model"]["embeddings.weight"][0] = -1
+            writer.wait()
+            saved = torch.load(path, weights_only=False)
+            assert (saved["model"]["embeddings.weight"] != -1).all()
+            async_s, async_blocked = train(writer.save)
+            writer.wait()
+            saved = torch.load(path, weights_only=False)
+            assert (saved["model"]["embeddings.weight"][0] == args.steps).all()
+            print(
+                f"{in_flight} in flight: training thread blocked "
+                f"{sync_blocked * 1000:8.1f} ms -> {async_blocked * 1000:8.1f} ms"
+            )
+            _report(f"  {args.steps} steps with checkpoints", sync_s * 1000, async_s * 1000)
+
+
+def _crossmodel(args):
+    """An untrained CrossModel of run.py and a synthetic ReDial batch for it."""
+    from model import CrossModel
+    from run import setup_args
+
+    opt = vars(
+        setup_args().parse_args(
+            ["--device", "cpu", "--embedding_size", str(args.embedding_size),
+             "--dim", str(args.dim), "--n_heads", str(args.n_heads),
+             "--n_layers", str(args.n_layers)]
+        )
+    )
+    dictionary = json.load(open("word2index_redial.json", encoding="utf-8"))
+    torch.manual_seed(args.seed)
+    model = CrossModel(opt, dictionary, is_finetune=False)
+
+    g = torch.Generator().manual_seed(args.seed)
+    bsz, n_entity, n_concept = args.batch_size, opt["n_entity"], opt["n_concept"]
+    xs, concept_mask, entity_vector, _, _ = _serving_batch(
+        argparse.Namespace(
+            seed=args.seed, batch_size=bsz, seq_len=args.seq_len,
+            n_entity=n_entity, n_concept=n_concept,
+        ),
+        model.embeddings.num_embeddings,
+    )
+    ys = torch.randint(4, model.embeddings.num_embeddings, (bsz, args.response_len), generator=g)
+    seed_sets = [entity_vector[i][entity_vector[i] != 0].tolist() for i in range(bsz)]
+    labels = torch.randint(1, n_entity, (bsz,), generator=g)
+    con_label = (torch.rand(bsz, n_concept + 1, generator=g) < 1e-3).double()
+    db_label = (torch.rand(bsz, n_entity, generator=g) < 1e-4).double()
+    batch = (xs, ys, ys, concept_mask, torch.zeros_like(concept_mask), seed_sets,
+             labels, con_label, db_label, entity_vector, torch.ones(bsz))
+    return model, opt, batch
+
+
+def bench_rec_forward(args):
+    model, opt, batch = _crossmodel(args)
+    bsz = args.batch_size
+
+    def train_step(mode):
+        model.train()
+        model.zero_grad()
+        out = model(*batch, test=False, mode=mode)
+        # the joint loss of TrainLoop_fusion_rec
+        (out[3] + opt["info_loss_ratio"] * out[6]).backward()
+        return out
+
+    def val_step(mode):
+        model.eval()
+        with torch.no_grad():
+            return model(*batch, test=True, maxlen=20, bsz=bsz, mode=mode)
+
+    # the recommender part runs first in both modes, even dropout agrees
+    grads = {}
+    for mode in ("full", "rec"):
+        torch.manual_seed(args.seed)
+        out = train_step(mode)
+        grads[mode] = (out[3].item(), {n: p.grad.clone() for n, p in model.named_parameters()
+                                       if p.grad is not None})
+    (full_loss, full_grads), (rec_loss, rec_grads) = grads["full"], grads["rec"]
+    assert full_loss == rec_loss, (full_loss, rec_loss)
+    for name, grad in rec_grads.items():
+        assert torch.allclose(grad, full_grads[name], atol=args.atol), name
+    full, rec = val_step("full"), val_step("rec")
+    assert torch.equal(full[2], rec[2]) and full[3].item() == rec[3].item()
+    print("rec loss, gradients and entity scores match")
+
+    for name, step in (("train", train_step), ("val", val_step)):
+        ref_ms = _timeit(lambda: step("full"), args.repeats, warmup=1)
+        new_ms = _timeit(lambda: step("rec"), args.repeats, warmup=1)
+        print(f"{name}: {1000 / ref_ms:6.2f} -> {1000 / new_ms:6.2f} steps/s")
+        _report(f"  {name} step", ref_ms, new_ms)
+
+
+def bench_gen_val(args):
+    model, _, batch = _crossmodel(args)
+    model.eval()
+    bsz = args.batch_size
+
+    @torch.no_grad()
+    def two_passes():
+        gen_loss = model(*batch, test=False)[4]
+        return model(*batch, test=True, maxlen=args.maxlen, bsz=bsz)[:4] + (gen_loss,)
+
+    @torch.no_grad()
+    def one_pass():
+        return model(*batch, test=True, maxlen=args.maxlen, bsz=bsz, mode="eval")[:5]
+
+    ref, new = two_passes(), one_pass()
+    for a, b in zip(ref, new):
+        assert torch.equal(a, b) if torch.is_tensor(a) else a == b
+    print("greedy responses, entity scores, rec and gen loss match")
+    ref_ms = _timeit(two_passes, args.repeats, warmup=1)
+    new_ms = _timeit(one_pass, args.repeats, warmup=1)
+    _report("gen val() batch", ref_ms, new_ms)
+
+
+def reference_rec_metrics(movie_ids, scores, labels, ks):
+    """The original per-sample recall loop of metrics_cal_rec, with mrr / ndcg."""
+    sums = dict.fromkeys(
+        [f"{metric}@{k}" for metric in ("recall", "mrr", "ndcg") for k in ks], 0.0
+    )
+    outputs = scores.cpu()[:, torch.LongTensor(movie_ids)]
+    _, pred_idx = torch.topk(outputs, k=max(ks), dim=1)
+    count = 0
+    for b in range(len(labels.view(-1).tolist())):
+        if labels[b].item() == 0:
+            continue
+        target_idx = movie_ids.index(labels[b].item())
+        pred = pred_idx[b].tolist()
+        for k in ks:
+            if target_idx in pred[:k]:
+                rank = pred.index(target_idx)
+                sums[f"recall@{k}"] += 1
+                sums[f"mrr@{k}"] += 1 / (rank + 1)
+                sums[f"ndcg@{k}"] += 1 / math.log2(rank + 2)
+        count += 1
+    sums["count"] = count
+    return sums
+
+
+def bench_rec_metrics(args):
+    movie_ids = pkl.load(open("data/movie_ids.pkl", "rb"))
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    g = torch.Generator().manual_seed(args.seed)
+    batches = []
+    for _ in range(args.batches):
+        scores = torch.randn(args.batch_size, args.n_entity, generator=g)
+        labels = torch.tensor(movie_ids)[
+            torch.randint(len(movie_ids), (args.batch_size,), generator=g)
+        ]
+        # cases without a recommendation, and labels ranked first
+        labels[: args.batch_size // 8] = 0
+        scores[torch.arange(args.batch_size // 4), labels[: args.batch_size // 4]] = 1e3
+        batches.append((scores.to(device), labels))
+    metrics = RecMetrics(movie_ids, args.n_entity, args.ks)
+
+    def reference():
+        sums = None
+        for scores, labels in batches:
+            batch = reference_rec_metrics(movie_ids, scores, labels, metrics.ks)
+            sums = batch if sums is None else {k: sums[k] + batch[k] for k in sums}
+        return sums
+
+    def vectorized():
+        metrics.reset()
+        for scores, labels in batches:
+            metrics.update(scores, labels)
+        return metrics.compute()
+
+    ref, new = reference(), vectorized()
+    new.pop("loss")
+    assert ref.keys() == new.keys()
+    for key in ref:
+        assert math.isclose(ref[key], new[key], rel_tol=1e-9), (key, ref[key], new[key])
+    print(f"recall / mrr / ndcg @ {metrics.ks} match over {ref['count']} cases")
+    ref_ms = _timeit(reference, args.repeats, warmup=1)
+    new_ms = _timeit(vectorized, args.repeats, warmup=1)
+    _report(f"rec metrics, {args.batches} batches", ref_ms, new_ms)
+
+
+def bench_loss_log(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(args.seed)
+    model = nn.Sequential(
+        nn.Linear(args.dim, args.dim), nn.ReLU(), nn.Linear(args.dim, args.dim)
+    ).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    inputs = torch.randn(args.steps, args.batch_size, args.dim, device=device)
+
+    def step(x):
+        out = model(x)
+        # two losses, like rec_loss and info_db_loss
+        losses = out.pow(2).mean(), out.abs().mean()
+        optimizer.zero_grad()
+        (losses[0] + losses[1]).backward()
+        optimizer.step()
+        return losses
+
+    def reference():
+        # the live loss tensors of the train loops, summed every 50 steps
+        records, losses = [], []
+        for num, x in enumerate(inputs):
+            losses.append(step(x))
+            if num % args.every == args.every - 1:
+                records.append(
+                    [(sum([l[n] for l in losses]) / len(losses)).item() for n in (0, 1)]
+                )
+                losses = []
+        return records
+
+    def optimized():
+        records = []
+        loss_log = LossLog(
+            "bench",
+            ["a_loss", "b_loss"],
+            args.every,
+            lambda record: records.append([record["a_loss"], record["b_loss"]]),
+        )
+        for x in inputs:
+            loss_log.add(*step(x))
+        loss_log.flush(wait=True)
+        return records
+
+    state = copy.deepcopy(model.state_dict())
+    ref = reference()
+    model.load_state_dict(state)
+    assert ref == optimized(), "loss means differ"
+    print(f"{len(ref)} records of the mean losses are identical")
+
+    def timed(fn):
+        model.load_state_dict(state)
+        return fn()
+
+    ref_ms = _timeit(lambda: timed(reference), args.repeats, warmup=1)
+    new_ms = _timeit(lambda: timed(optimized), args.repeats, warmup=1)
+    _report(f"{args.steps} steps on {device}", ref_ms, new_ms)
+
+
+def bench_profiling(args):
+    model, opt, batch = _crossmodel(args)
+    bsz = args.batch_size
+
+    def train_step():
+        model.train()
+        model.zero_grad()
+        with region("forward"):
+            out = model(*batch, test=False)
+        with region("backward"):
+            (out[3] + opt["info_loss_ratio"] * out[6] + out[4]).backward()
+
+    def val_step():
+        model.eval()
+        with torch.no_grad(), region("forward"):
+            model(*batch, test=True, maxlen=args.maxlen, bsz=bsz, mode="eval")
+
+    def steps():
+        for _ in iterate("data", range(2)):
+            with region("train"):
+                train_step()
+            with region("val"):
+                val_step()
+
+    # the cost of a region while profiling is off
+    calls = 100000
+    start = time.perf_counter()
+    for _ in range(calls):
+        with region("off"):
+            pass
+    print(f"disabled region: {(time.perf_counter() - start) / calls * 1e9:.0f} ns per call")
+
+    off_ms = _timeit(steps, args.repeats, warmup=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        trace = os.path.join(tmp, "trace.json") if args.trace else None
+        profiler = enable_profiling(trace, model.device)
+        on_ms = _timeit(steps, args.repeats, warmup=0)
+        disable_profiling()
+        if trace is not None:
+            print(f"chrome trace: {os.path.getsize(trace) / 2 ** 20:.1f} MB")
+    print(profiler.summary())
+    print(f"2 train + val steps: {off_ms:.1f} ms profiling off, {on_ms:.1f} ms on")
+
+
+def reference_gen_metrics(preds, responses):
+    """The original metrics_cal_gen: NLTK BLEU per sample, string n-gram sets."""
+    sums = [0, 0, 0, 0]
+    for out, tar in zip(preds, responses):
+        for n, weights in enumerate([(1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1)]):
+            sums[n] += sentence_bleu([tar], out, weights=weights)
+    grams = [set(), set(), set(), set()]
+    for sen in preds:
+        for n in range(4):
+            for start in range(len(sen) - n):
+                grams[n].add(" ".join(str(word) for word in sen[start : start + n + 1]))
+    return sums, [len(g) / len(preds) for g in grams]
+
+
+def bench_bleu(args):
+    words = list(json.load(open("word2index_redial.json", encoding="utf-8")))
+    rng = np.random.default_rng(args.seed)
+    # zipf distributed words, so that responses share n-grams
+    word = lambda n: [words[i] for i in (rng.zipf(1.3, n) - 1) % len(words)]
+    responses = [word(rng.integers(1, 31)) for _ in range(args.sentences)]
+    preds = [word(rng.integers(0, 21)) for _ in range(args.sentences)]
+    preds[::10] = responses[::10]
+
+    def vectorized():
+        bleus = bleu_scores(preds, responses, workers=args.workers)
+        return [sum(bleu) for bleu in bleus.T.tolist()], distinct(preds)
+
+    with warnings.catch_warnings():
+        # NLTK warns about every hypothesis without matching n-grams
+        warnings.simplefilter("ignore")
+        ref = reference_gen_metrics(preds, responses)
+        assert ref == vectorized(), (ref, vectorized())
+        print(f"bleu1-4 and dist1-4 of {args.sentences} responses are identical")
+        ref_ms = _timeit(lambda: reference_gen_metrics(preds, responses), args.repeats, warmup=0)
+    new_ms = _timeit(vectorized, args.repeats, warmup=1)
+    _report(f"gen metrics, {args.workers} worker(s)", ref_ms, new_ms)
+
+
+def _serving_model(args):
+    """An untrained CrossModelInference with the ReDial vocabulary and graphs."""
+    dictionary = json.load(open("word2index_redial.json", encoding="utf-8"))
+    copy_mask = torch.Tensor(np.load("mask4key.npy") + np.load("mask4movie.npy"))
+    opt = dict(
+        n_heads=args.n_heads,
+        n_layers=args.n_layers,
+        embedding_size=args.embedding_size,
+        ffn_size=args.embedding_size,
+        dropout=0.0,
+        attention_dropout=0.0,
+        relu_dropout=0.0,
+        embeddings_scale=True,
+        dim=args.dim,
+        n_entity=args.n_entity,
+        n_concept=args.n_concept,
+        encoder_length_buckets=4,
+    )
+    serving = CrossModelInference(opt, dictionary, copy_mask)
+    nn.init.normal_(serving.embeddings.weight, 0, args.embedding_size ** -0.5)
+    db_nodes = torch.randn(args.n_entity, args.dim) * args.dim ** -0.5
+    serving.db_nodes = NodeTable(db_nodes)
+    serving.con_nodes = NodeTable(torch.randn(args.n_concept + 1, args.dim) * args.dim ** -0.5)
+    with torch.no_grad():
+        serving.entity_scorer.weight.copy_(db_nodes)
+    return serving.eval()
+
+
+def _serving_batch(args, vocab_size):
+    g = torch.Generator().manual_seed(args.seed)
+    bsz, seq_len = args.batch_size, args.seq_len
+    lengths = (torch.rand(bsz, generator=g) ** 2 * seq_len).long().clamp_(min=1)
+    xs = torch.randint(4, vocab_size, (bsz, seq_len), generator=g)
+    xs.masked_fill_(torch.arange(seq_len)[None, :] >= lengths[:, None], 0)
+    concept_mask = torch.randint(1, args.n_concept + 1, (bsz, seq_len), generator=g)
+    concept_mask.masked_fill_(torch.rand(bsz, seq_len, generator=g) < 0.8, 0)
+    entity_vector = torch.randint(1, args.n_entity, (bsz, 50), generator=g)
+    entity_vector.masked_fill_(torch.arange(50)[None, :] >= 5, 0)
+    seed_sets = [entity_vector[i, : i % 4].tolist() for i in range(bsz)]
+    seed_ids, seed_mask = pad_seed_sets(seed_sets, seq_len)
+    return xs, concept_mask, entity_vector, seed_ids, seed_mask
+
+
+def _distinct(sentences):
+    """dist-1..4 as in run.py: distinct n-grams per generated sentence."""
+    return [
+        len({tuple(s[i : i + n]) for s in sentences for i in range(len(s) - n + 1)})
+        / len(sentences)
+        for n in (1, 2, 3, 4)
+    ]
+
+
+def _tokens(preds, end_idx=2):
+    """Word ids of every generated response, up to its end token."""
+    sentences = []
+    for row in preds[:, 1:].tolist():
+        if end_idx in row:
+            row = row[: row.index(end_idx)]
+        sentences.append([token for token in row if token > 3])
+    return sentences
+
+
+def bench_quantization(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    serving = _serving_model(args)
+    quantized = quantize(serving)
+    batch = _serving_batch(args, serving.embeddings.num_embeddings)
+
+    with torch.no_grad():
+        ref_preds, ref_scores = serving.generate(*batch, maxlen=args.maxlen)
+        preds, scores = quantized.generate(*batch, maxlen=args.maxlen)
+
+        # the fp32 model's outputs serve as the labels / references
+        labels = ref_scores.argmax(dim=-1, keepdim=True)
+        ranks = (scores > scores.gather(1, labels)).sum(dim=-1)
+        for k in (1, 10, 50):
+            print(f"int8 recall@{k} of the fp32 top entity: {(ranks < k).float().mean().item():.3f}")
+        ref_sentences, sentences = _tokens(ref_preds), _tokens(preds)
+        for n in (1, 2, 3, 4):
+            weights = tuple(float(i == n - 1) for i in range(4))
+            bleu = np.mean([
+                sentence_bleu([ref], out, weights=weights)
+                for out, ref in zip(sentences, ref_sentences)
+            ])
+            print(f"int8 bleu{n} against fp32 responses: {bleu:.3f}")
+        print("dist1-4 fp32", ["%.3f" % d for d in _distinct(ref_sentences)])
+        print("dist1-4 int8", ["%.3f" % d for d in _distinct(sentences)])
+
+        ref_ms = _timeit(lambda: serving.recommend(*batch[1:2], *batch[3:]), args.repeats)
+        new_ms = _timeit(lambda: quantized.recommend(*batch[1:2], *batch[3:]), args.repeats)
+        _report("recommend", ref_ms, new_ms)
+        ref_ms = _timeit(lambda: serving.generate(*batch, maxlen=args.maxlen), args.repeats, warmup=1)
+        new_ms = _timeit(lambda: quantized.generate(*batch, maxlen=args.maxlen), args.repeats, warmup=1)
+        _report("recommend + generate", ref_ms, new_ms)
+    ref_mb, new_mb = model_size(serving) / 2 ** 20, model_size(quantized) / 2 ** 20
+    print(f"serialized size {ref_mb:.1f} MB -> {new_mb:.1f} MB")
+
+
+def _redecode_generate(serving, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen):
+    """Greedy decoding that re-runs the decoder over the whole prefix every step."""
+    user_emb, con_user_emb, db_user_emb = serving.user_representation(
+        concept_mask, seed_ids, seed_mask
+    )
+    entity_scores = serving.entity_scorer(user_emb)
+    encoder_states = serving.encoder._encode(xs)
+    kg_states = (serving.kg_norm(serving.con_nodes(concept_mask)), concept_mask != 0)
+    db_states = (serving.db_norm(serving.db_nodes(entity_vector)), entity_vector != 0)
+    kg_attn_norm = serving.kg_attn_norm(con_user_emb).unsqueeze(1)
+    db_attn_norm = serving.db_attn_norm(db_user_emb).unsqueeze(1)
+    preds = xs.new_full((xs.size(0), 1), serving.START_IDX)
+    for _ in range(maxlen):
+        latent, _ = serving.decoder(preds, encoder_states, kg_states, db_states)
+        logits = serving.step_logits(latent[:, -1:], kg_attn_norm, db_attn_norm)
+        preds = torch.cat([preds, logits.squeeze(1).argmax(dim=-1, keepdim=True)], dim=1)
+    return preds, entity_scores
+
+
+def bench_compiled(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    serving = _serving_model(args)
+    batch = _serving_batch(args, serving.embeddings.num_embeddings)
+    # one request at a time, as a server sees them
+    requests = [tuple(t[i : i + 1] for t in batch) for i in range(args.batch_size)]
+
+    models = {"eager": serving}
+    if "trace" in args.backends:
+        models["trace"] = trace(serving, *requests[0], maxlen=args.maxlen)
+    if "compile" in args.backends:
+        models["compile"] = compile_serving(copy.deepcopy(serving), dynamic=False)
+
+    with torch.no_grad():
+        ref_preds, ref_scores = _redecode_generate(serving, *batch, args.maxlen)
+        for name, model in models.items():
+            preds, scores = generate(model, *batch, maxlen=args.maxlen, stop=False)
+            assert torch.equal(preds, ref_preds), f"{name} responses differ"
+            assert torch.allclose(scores, ref_scores, atol=args.atol), (
+                f"{name} entity scores differ by {(scores - ref_scores).abs().max():.2e}"
+            )
+        print(f"responses and entity scores match ({args.batch_size} requests)")
+
+        def serve(fn):
+            return lambda: [fn(*request) for request in requests]
+
+        ref_ms = _timeit(
+            serve(lambda *r: _redecode_generate(serving, *r, args.maxlen)),
+            args.repeats,
+            warmup=1,
+        )
+        for name, model in models.items():
+            new_ms = _timeit(
+                serve(lambda *r: generate(model, *r, maxlen=args.maxlen, stop=False)),
+                args.repeats,
+                warmup=2,
+            )
+            _report(f"{name}, per request", ref_ms / len(requests), new_ms / len(requests))
+
+
+def bench_onnx(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    serving = _serving_model(args)
+    batch = _serving_batch(args, serving.embeddings.num_embeddings)
+    requests = [tuple(t[i : i + 1] for t in batch) for i in range(args.batch_size)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        export_onnx(serving, directory, *requests[0], maxlen=args.maxlen)
+        onnx_serving = OnnxServing(directory, threads=args.threads)
+        # exported on one request, checked on the whole padded batch
+        parity = check_parity(serving, onnx_serving, [batch], maxlen=args.maxlen)
+        print(parity)
+        assert parity["entity_score_diff"] < args.atol and parity["logit_diff"] < args.atol
+        assert parity["same_response"] == 1.0, "ONNX responses differ"
+
+        models = {"eager": serving, "trace": trace(serving, *requests[0], maxlen=args.maxlen)}
+        models["onnxruntime"] = onnx_serving
+        with torch.no_grad():
+            ref_ms = None
+            for name, model in models.items():
+                ms = _timeit(
+                    lambda: [generate(model, *r, maxlen=args.maxlen, stop=False) for r in requests],
+                    args.repeats,
+                    warmup=2,
+                )
+                ref_ms = ms if ref_ms is None else ref_ms
+                _report(f"{name}, per request", ref_ms / len(requests), ms / len(requests))
+
+
+def setup_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeats", type=int, default=20)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    attention = subparsers.add_parser("attention", help="fused QKV / sdpa attention")
+    attention.add_argument("--batch_size", type=int, default=32)
+    attention.add_argument("--seq_len", type=int, default=256)
+    attention.add_argument("--memory_len", type=int, default=64)
+    attention.add_argument("--dim", type=int, default=300)
+    attention.add_argument("--n_heads", type=int, default=2)
+    attention.add_argument("--atol", type=float, default=1e-5)
+    attention.set_defaults(func=bench_attention)
+
+    encoder = subparsers.add_parser("encoder", help="length trimmed encoder")
+    encoder.add_argument("--batch_size", type=int, default=32)
+    encoder.add_argument("--seq_len", type=int, default=256)
+    encoder.add_argument("--vocab_size", type=int, default=23929)
+    encoder.add_argument("--dim", type=int, default=300)
+    encoder.add_argument("--n_heads", type=int, default=2)
+    encoder.add_argument("--n_layers", type=int, default=2)
+    encoder.add_argument("--atol", type=float, default=1e-4)
+    encoder.set_defaults(func=bench_encoder)
+
+    cache = subparsers.add_parser("utterance_cache", help="hierarchical encoder cache")
+    cache.add_argument("--batch_size", type=int, default=32)
+    cache.add_argument("--seq_len", type=int, default=256)
+    cache.add_argument("--max_count", type=int, default=5)
+    cache.add_argument("--n_dialogues", type=int, default=40)
+    cache.add_argument("--n_turns", type=int, default=12)
+    cache.add_argument("--vocab_size", type=int, default=23929)
+    cache.add_argument("--dim", type=int, default=300)
+    cache.add_argument("--n_heads", type=int, default=2)
+    cache.add_argument("--n_layers", type=int, default=2)
+    cache.add_argument("--cache_size", type=int, default=20000)
+    # cached rows were encoded in other batches, so kernels saw other shapes
+    cache.add_argument("--atol", type=float, default=1e-3)
+    cache.set_defaults(func=bench_utterance_cache)
+
+    window = subparsers.add_parser("window", help="sliding window attention")
+    window.add_argument("--batch_size", type=int, default=8)
+    window.add_argument("--seq_lens", type=int, nargs="+", default=[256, 1024, 2048])
+    window.add_argument("--check_len", type=int, default=300)
+    window.add_argument("--window", type=int, default=64)
+    window.add_argument("--dim", type=int, default=300)
+    window.add_argument("--n_heads", type=int, default=2)
+    window.add_argument("--atol", type=float, default=1e-5)
+    window.set_defaults(func=bench_window)
+
+    precision = subparsers.add_parser("precision", help="bf16 / fp16 autocast")
+    precision.add_argument("--precisions", nargs="+", default=["fp32", "bf16", "fp16"])
+    precision.add_argument("--batch_size", type=int, default=32)
+    precision.add_argument("--seq_len", type=int, default=256)
+    precision.add_argument("--response_len", type=int, default=30)
+    precision.add_argument("--vocab_size", type=int, default=23929)
+    precision.add_argument("--dim", type=int, default=300)
+    precision.add_argument("--n_heads", type=int, default=2)
+    precision.add_argument("--n_layers", type=int, default=2)
+    precision.set_defaults(func=bench_precision)
+
+    threads = subparsers.add_parser("threads", help="CPU throughput per thread count")
+    threads.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, 4, 8, 16, os.cpu_count()} & set(range(1, os.cpu_count() + 1))),
+    )
+    threads.add_argument("--inter_op_threads", type=int, default=0)
+    threads.add_argument("--numa_node", type=int, default=-1)
+    threads.add_argument("--batch_size", type=int, default=32)
+    threads.add_argument("--seq_len", type=int, default=256)
+    threads.add_argument("--response_len", type=int, default=30)
+    threads.add_argument("--vocab_size", type=int, default=23929)
+    threads.add_argument("--dim", type=int, default=300)
+    threads.add_argument("--n_heads", type=int, default=2)
+    threads.add_argument("--n_layers", type=int, default=2)
+    threads.add_argument("--atol", type=float, default=1e-4)
+    threads.set_defaults(func=bench_threads)
+
+    ddp = subparsers.add_parser("ddp", help="gloo data parallel training on CPU")
+    ddp.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    # per process, the global batch grows with the number of processes
+    ddp.add_argument("--batch_size", type=int, default=16)
+    ddp.add_argument("--seq_len", type=int, default=128)
+    ddp.add_argument("--response_len", type=int, default=30)
+    ddp.add_argument("--vocab_size", type=int, default=23929)
+    ddp.add_argument("--dim", type=int, default=300)
+    ddp.add_argument("--n_heads", type=int, default=2)
+    ddp.add_argument("--n_layers", type=int, default=2)
+    ddp.add_argument("--atol", type=float, default=1e-5)
+    ddp.set_defaults(func=bench_ddp)
+
+    checkpointing = subparsers.add_parser("checkpointing", help="activation checkpointing")
+    checkpointing.add_argument("--batch_size", type=int, default=32)
+    checkpointing.add_argument("--seq_len", type=int, default=256)
+    checkpointing.add_argument("--response_len", type=int, default=30)
+    checkpointing.add_argument("--vocab_size", type=int, default=23929)
+    checkpointing.add_argument("--dim", type=int, default=300)
+    checkpointing.add_argument("--n_heads", type=int, default=2)
+    checkpointing.add_argument("--n_layers", type=int, default=2)
+    checkpointing.set_defaults(func=bench_checkpointing)
+
+    eval_cache = subparsers.add_parser("eval_cache", help="cached evaluation batches")
+    eval_cache.add_argument("--cases", type=int, default=1000)
+    eval_cache.add_argument("--batch_size", type=int, default=32)
+    eval_cache.add_argument("--seq_len", type=int, default=256)
+    eval_cache.add_argument("--response_len", type=int, default=30)
+    eval_cache.add_argument("--n_entity", type=int, default=64368)
+    eval_cache.add_argument("--n_concept", type=int, default=29308)
+    eval_cache.set_defaults(func=bench_eval_cache)
+
+    checkpoint = subparsers.add_parser("checkpoint", help="background checkpoint writer")
+    checkpoint.add_argument("--in_flight", type=int, nargs="+", default=[1, 2])
+    checkpoint.add_argument("--steps", type=int, default=40)
+    checkpoint.add_argument("--save_every", type=int, default=10)
+    # matmuls per step, stands in for the forward / backward
+    checkpoint.add_argument("--step_work", type=int, default=3000)
+    checkpoint.add_argument("--batch_size", type=int, default=256)
+    checkpoint.add_argument("--vocab_size", type=int, default=23929)
+    checkpoint.add_argument("--dim", type=int, default=300)
+    checkpoint.add_argument("--n_entity", type=int, default=64368)
+    checkpoint.add_argument("--num_bases", type=int, default=8)
+    checkpoint.set_defaults(func=bench_checkpoint)
+
+    resume = subparsers.add_parser("resume", help="bit-exact resume of a preempted run")
+    resume.add_argument("--update_freq", type=int, default=3)
+    # an epoch that ends inside an update_freq window
+    resume.add_argument("--batches", type=int, default=10)
+    resume.add_argument("--epochs", type=int, default=3)
+    resume.add_argument("--checkpoint_every", type=int, default=2)
+    resume.add_argument("--dim", type=int, default=8)
+    resume.set_defaults(func=bench_resume)
+
+    rec_forward = subparsers.add_parser("rec_forward", help="recommendation-only forward")
+    rec_forward.add_argument("--batch_size", type=int, default=32)
+    rec_forward.add_argument("--seq_len", type=int, default=256)
+    rec_forward.add_argument("--response_len", type=int, default=30)
+    rec_forward.add_argument("--embedding_size", type=int, default=300)
+    rec_forward.add_argument("--dim", type=int, default=128)
+    rec_forward.add_argument("--n_heads", type=int, default=2)
+    rec_forward.add_argument("--n_layers", type=int, default=2)
+    rec_forward.add_argument("--atol", type=float, default=1e-6)
+    rec_forward.set_defaults(func=bench_rec_forward)
+
+    gen_val = subparsers.add_parser("gen_val", help="single pass generation validation")
+    gen_val.add_argument("--batch_size", type=int, default=32)
+    gen_val.add_argument("--seq_len", type=int, default=256)
+    gen_val.add_argument("--response_len", type=int, default=30)
+    gen_val.add_argument("--maxlen", type=int, default=20)
+    gen_val.add_argument("--embedding_size", type=int, default=300)
+    gen_val.add_argument("--dim", type=int, default=128)
+    gen_val.add_argument("--n_heads", type=int, default=2)
+    gen_val.add_argument("--n_layers", type=int, default=2)
+    gen_val.set_defaults(func=bench_gen_val)
+
+    rec_metrics = subparsers.add_parser("rec_metrics", help="vectorized recall / mrr / ndcg")
+    rec_metrics.add_argument("--batch_size", type=int, default=32)
+    rec_metrics.add_argument("--batches", type=int, default=50)
+    rec_metrics.add_argument("--n_entity", type=int, default=64368)
+    rec_metrics.add_argument("--ks", type=int, nargs="+", default=[1, 10, 50])
+    rec_metrics.set_defaults(func=bench_rec_metrics)
+
+    bleu = subparsers.add_parser("bleu", help="NumPy BLEU and distinct-n")
+    bleu.add_argument("--sentences", type=int, default=5000)
+    bleu.add_argument("--workers", type=int, default=1)
+    bleu.set_defaults(func=bench_bleu)
+
+    loss_log = subparsers.add_parser("loss_log", help="on-device loss logging")
+    loss_log.add_argument("--steps", type=int, default=500)
+    loss_log.add_argument("--every", type=int, default=50)
+    loss_log.add_argument("--batch_size", type=int, default=32)
+    loss_log.add_argument("--dim", type=int, default=256)
+    loss_log.set_defaults(func=bench_loss_log)
+
+    profiling = subparsers.add_parser("profiling", help="per-stage regions of CrossModel")
+    profiling.add_argument("--batch_size", type=int, default=16)
+    profiling.add_argument("--seq_len", type=int, default=128)
+    profiling.add_argument("--response_len", type=int, default=30)
+    profiling.add_argument("--maxlen", type=int, default=20)
+    profiling.add_argument("--embedding_size", type=int, default=300)
+    profiling.add_argument("--dim", type=int, default=128)
+    profiling.add_argument("--n_heads", type=int, default=2)
+    profiling.add_argument("--n_layers", type=int, default=2)
+    profiling.add_argument("--trace", action="store_true", help="also record a Chrome trace")
+    profiling.set_defaults(func=bench_profiling)
+
+    quantization = subparsers.add_parser("quantization", help="int8 CPU serving model")
+    quantization.add_argument("--batch_size", type=int, default=32)
+    quantization.add_argument("--seq_len", type=int, default=256)
+    quantization.add_argument("--maxlen", type=int, default=20)
+    quantization.add_argument("--embedding_size", type=int, default=300)
+    quantization.add_argument("--dim", type=int, default=128)
+    quantization.add_argument("--n_heads", type=int, default=2)
+    quantization.add_argument("--n_layers", type=int, default=2)
+    quantization.add_argument("--n_entity", type=int, default=64368)
+    quantization.add_argument("--n_concept", type=int, default=29308)
+    quantization.add_argument("--threads", type=int, default=torch.get_num_threads())
+    quantization.set_defaults(func=bench_quantization)
+
+    compiled = subparsers.add_parser("compiled", help="traced / compiled serving model")
+    compiled.add_argument("--backends", nargs="+", default=["trace", "compile"])
+    compiled.add_argument("--batch_size", type=int, default=16)
+    compiled.add_argument("--seq_len", type=int, default=256)
+    compiled.add_argument("--maxlen", type=int, default=20)
+    compiled.add_argument("--embedding_size", type=int, default=300)
+    compiled.add_argument("--dim", type=int, default=128)
+    compiled.add_argument("--n_heads", type=int, default=2)
+    compiled.add_argument("--n_layers", type=int, default=2)
+    compiled.add_argument("--n_entity", type=int, default=64368)
+    compiled.add_argument("--n_concept", type=int, default=29308)
+    compiled.add_argument("--threads", type=int, default=torch.get_num_threads())
+    compiled.add_argument("--atol", type=float, default=1e-5)
+    compiled.set_defaults(func=bench_compiled)
+
+    onnx = subparsers.add_parser("onnx", help="ONNX Runtime serving graphs")
+    onnx.add_argument("--batch_size", type=int, default=16)
+    onnx.add_argument("--seq_len", type=int, default=256)
+    onnx.add_argument("--maxlen", type=int, default=20)
+    onnx.add_argument("--embedding_size", type=int, default=300)
+    onnx.add_argument("--dim", type=int, default=128)
+    onnx.add_argument("--n_heads", type=int, default=2)
+    onnx.add_argument("--n_layers", type=int, default=2)
+    onnx.add_argument("--n_entity", type=int, default=64368)
+    onnx.add_argument("--n_concept", type=int, default=29308)
+    onnx.add_argument("--threads", type=int, default=torch.get_num_threads())
+    onnx.add_argument("--atol", type=float, default=1e-4)
+    onnx.set_defaults(func=bench_onnx)
+    return parser
+
+
+if __name__ == "__main__":
+    args = setup_args().parse_args()
+    args.func(args)
@@ -0,0 +1,343 @@
+"""
+Resumable training checkpoints.
+
+A checkpoint holds everything a preempted run needs to continue where it
+stopped: the model, optimizer, GradScaler / LR schedule, the RNG states of
+every process, the position of the loop in its stages, epochs and batches and
+the gradients of an unfinished --update_freq window.
+Files are written atomically, so a crash while saving never leaves a truncated
+checkpoint behind, and in the background, so training does not wait for them.
+
+Every run writes to its own directory, saved_model/<run_name>; resume with
+
+    python run.py --resume saved_model/<run_name> ...
+"""
+
+import copy
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+CHECKPOINT = "checkpoint.pt"
+
+
+def run_dir(opt):
+    """
+    Directory of the checkpoints of this run.
+
+    A resumed run keeps writing to the directory it was resumed from. Without
+    --run_name every run gets its own timestamped directory, so concurrent
+    runs do not overwrite each other.
+    """
+    if opt.get("resume"):
+        resume = opt["resume"]
+        return resume if os.path.isdir(resume) else os.path.dirname(resume)
+    name = opt.get("run_name") or time.strftime("%Y%m%d-%H%M%S-") + str(os.getpid())
+    return os.path.join("saved_model", name)
+
+
+def init_model_path(opt, name):
+    """
+    The recommender a generator run is finetuned from.
+
+    --init_model if given. Otherwise the best model of the rec run named by
+    --run_name, saved_model/<run_name>/<name>, or without --run_name the one
+    the latest rec run published as saved_model/<name>.
+    """
+    if opt.get("init_model"):
+        return opt["init_model"]
+    if opt.get("run_name"):
+        return os.path.join("saved_model", opt["run_name"], name)
+    return os.path.join("saved_model", name)
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file that replaces ``path`` once it is on disk."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # make the rename itself durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _snapshot(obj):
+    """A copy of ``obj`` whose tensors are in host memory of their own."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, _snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints with atomic_save in a background thread.
+
+    save() only snapshots the tensors to host memory on the calling thread,
+    serialization, fsync and rename happen in the background in the order of
+    the calls. At most ``max_in_flight`` snapshots are held at a time, save()
+    blocks while that many are still being written. ``max_in_flight=0``
+    writes synchronously.
+
+    Call wait() before reading a checkpoint back or exiting; an error of a
+    background write is raised by the next save() or wait().
+    """
+
+    def __init__(self, max_in_flight=1):
+        self.max_in_flight = max_in_flight
+        self._slots = threading.Semaphore(max(max_in_flight, 1))
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = None
+
+    def save(self, obj, path):
+        self._raise()
+        if self.max_in_flight <= 0:
+            atomic_save(obj, path)
+            return
+        self._slots.acquire()
+        try:
+            snapshot = _snapshot(obj)
+        except BaseException:
+            self._slots.release()
+            raise
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._write, name="checkpoint-writer", daemon=True
+            )
+            self._thread.start()
+        self._queue.put((snapshot, path))
+
+    def _write(self):
+        while True:
+            snapshot, path = self._queue.get()
+            try:
+                atomic_save(snapshot, path)
+            except BaseException as e:
+                self._error = e
+            finally:
+                del snapshot
+                self._slots.release()
+                self._queue.task_done()
+
+    def wait(self):
+        """Block until every pending checkpoint is on disk."""
+        self._queue.join()
+        self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def load_checkpoint(path, map_location="cpu"):
+    """A checkpoint file, or the checkpoint of a run directory."""
+    if os.path.isdir(path):
+        path = os.path.join(path, CHECKPOINT)
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def load_states(path, model):
+    """
+    Load the model parameters of a checkpoint into ``model``.
+
+    ``path`` may also be a bare state_dict such as saved_model/net_parameter1.pkl.
+    Returns the other states of the checkpoint (optimizer, progress, ...),
+    which are empty for a bare state_dict.
+    """
+    states = load_checkpoint(path)
+    if not isinstance(states.get("model"), dict):
+        model.load_state_dict(states)
+        return {}
+    model.load_state_dict(states["model"])
+    return states
+
+
+def grad_accum_state(model, pending):
+    """
+    The open gradient accumulation window of a checkpoint.
+
+    ``pending`` is the number of micro-batches accumulated since the last
+    optimizer step (_number_grad_accum of the train loops). A checkpoint at
+    the end of an epoch can fall inside a window; the gradients summed so far
+    are then saved with it, those of every process in distributed training,
+    so every process has to call this.
+    """
+    if not pending:
+        return {"grad_accum": 0}
+    grads = {
+        name: param.grad.detach().cpu()
+        for name, param in model.named_parameters()
+        if param.grad is not None
+    }
+    return {"grad_accum": pending, "grads": _all_ranks(grads)}
+
+
+def load_grad_accum(model, states):
+    """Restore the window of grad_accum_state; returns its micro-batch count."""
+    if not states.get("grad_accum"):
+        return 0
+    grads = _this_rank(states["grads"])
+    for name, param in model.named_parameters():
+        if name in grads:
+            param.grad = grads[name].to(param.device, copy=True)
+    return states["grad_accum"]
+
+
+def rng_state():
+    """The states of the python, numpy and torch generators of this process."""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def _all_ranks(obj):
+    """``obj`` of every process, indexed by rank."""
+    if not _distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def _this_rank(objs):
+    return objs[dist.get_rank() if _distributed() else 0]
+
+
+class TrainProgress:
+    """
+    Position of a training loop in its stages, epochs and batches.
+
+    ``stages`` names the stages in the order the loop runs them. A fresh run
+    starts every epoch at its first batch. A run resumed from ``states`` skips
+    the epochs and batches that were done before the checkpoint and restores
+    the RNG states, so it continues exactly as the original run would have:
+
+        for epoch in range(n_epochs):
+            if progress.done("rec", epoch):
+                continue
+            skip = progress.start("rec", epoch)
+            loader = train_loader(train_set, batch_size, epoch, skip)
+            for batch in progress.batches(loader):
+                ...
+                progress.step()
+            progress.end_epoch()
+
+    ``values`` holds the loop variables (iteration counts, best validation
+    score, ...) of the checkpoint.
+    """
+
+    def __init__(self, stages, states=None):
+        self.stages = list(stages)
+        states = states or {}
+        progress = states.get("progress", {})
+        self.stage = progress.get("stage", self.stages[0])
+        self.epoch = progress.get("epoch", 0)
+        self.batch = progress.get("batch", 0)
+        self.steps = progress.get("steps", 0)
+        self.values = dict(progress.get("values", {}))
+        self.resumed = "progress" in states
+        self._target = self._key(self.stage, self.epoch) if self.resumed else None
+        self._resume_rng = states.get("rng")
+        self._resume_epoch_rng = states.get("epoch_rng")
+        self._epoch_rng = None
+
+    def _key(self, stage, epoch):
+        return self.stages.index(stage), epoch
+
+    def done(self, stage, epoch):
+        """Whether the checkpoint was saved after this epoch."""
+        return self._target is not None and self._key(stage, epoch) < self._target
+
+    def start(self, stage, epoch):
+        """Begin an epoch; returns the number of its batches to skip."""
+        self.stage, self.epoch = stage, epoch
+        if self._target is not None:
+            # the epoch of the checkpoint, or the first one after it when it
+            # was saved at the end of a stage: replay the epoch from its start
+            set_rng_state(_this_rank(self._resume_epoch_rng))
+            if self._key(stage, epoch) > self._target:
+                self._target = None
+                self.batch = 0
+        else:
+            self.batch = 0
+        self._epoch_rng = rng_state()
+        return self.batch
+
+    def batches(self, loader):
+        """Iterate ``loader``, restoring the RNG of a checkpoint on resume."""
+        batches = iter(loader)
+        if self._target is not None:
+            if self.batch:
+                # inside the epoch of the checkpoint: after iter(), which draws
+                # the DataLoader's base seed. A checkpoint between epochs was
+                # saved before that draw, start() restored its state.
+                set_rng_state(_this_rank(self._resume_rng))
+            self._target = None
+        yield from batches
+
+    def step(self):
+        self.batch += 1
+        self.steps += 1
+
+    def end_epoch(self):
+        self.epoch += 1
+        self.batch = 0
+        self._epoch_rng = None
+
+    def state(self, **values):
+        """
+        The progress part of a checkpoint, updating ``values``.
+
+        In distributed training every process must call this, the RNG states of
+        all ranks are gathered into the checkpoint.
+        """
+        self.values.update(values)
+        rng = rng_state()
+        return {
+            "progress": {
+                "stage": self.stage,
+                "epoch": self.epoch,
+                "batch": self.batch,
+                "steps": self.steps,
+                "values": dict(self.values),
+            },
+            "rng": _all_ranks(rng),
+            # between epochs the next one starts from the current state
+            "epoch_rng": _all_ranks(self._epoch_rng if self.batch else rng),
+        }
@@ -0,0 +1,269 @@
+"""
+Metrics of the train loops, computed without per-sample Python.
+
+RecMetrics ranks the movies of a batch with a single topk, on the device of
+the scores, and keeps running sums there; only compute() synchronizes.
+LossLog does the same for the training losses and reads them back without
+blocking the loop.
+
+bleu_scores and distinct replace NLTK's sentence_bleu and the string n-gram
+sets of the generation metrics. Words are mapped to integer ids and every
+n-gram to a dense id with NumPy, so all responses are scored in one pass.
+The numbers are the same as before, bit for bit.
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import torch
+
+
+class RecMetrics:
+    """
+    Recall, MRR and NDCG at the cutoffs ``ks`` of the movie ranking.
+
+    Only the movies (``movie_ids``, entity ids) are ranked. A case with label 0
+    has no recommendation and is not counted, as in the original per-sample
+    loop of metrics_cal_rec. The batch losses passed to update() are summed
+    as "loss".
+    """
+
+    def __init__(self, movie_ids, n_entity, ks=(1, 10, 50)):
+        self.ks = sorted(set(ks))
+        self.movie_ids = torch.as_tensor(movie_ids, dtype=torch.long)
+        self.max_k = min(self.ks[-1], len(self.movie_ids))
+        # position of an entity in movie_ids, -1 for entities that are no movie
+        self.movie_position = torch.full((n_entity,), -1, dtype=torch.long)
+        self.movie_position[self.movie_ids] = torch.arange(len(self.movie_ids))
+        self.names = [
+            f"{metric}@{k}" for metric in ("recall", "mrr", "ndcg") for k in self.ks
+        ]
+        self.reset()
+
+    def reset(self):
+        self.sums = torch.zeros(len(self.names), dtype=torch.float64)
+        self.count = torch.zeros((), dtype=torch.long)
+        self.loss = torch.zeros((), dtype=torch.float64)
+
+    def _to(self, device):
+        if self.movie_ids.device != device:
+            self.movie_ids = self.movie_ids.to(device)
+            self.movie_position = self.movie_position.to(device)
+            self.sums = self.sums.to(device)
+            self.count = self.count.to(device)
+            self.loss = self.loss.to(device)
+
+    @torch.no_grad()
+    def update(self, scores, labels, loss=None):
+        """Add a batch of entity scores [bsz, n_entity] and movie labels [bsz]."""
+        self._to(scores.device)
+        labels = labels.view(-1).to(scores.device)
+        _, top = scores.index_select(1, self.movie_ids).topk(self.max_k, dim=1)
+        target = self.movie_position[labels]
+        hits = top == target[:, None]
+        # the rank of the label, beyond every cutoff when it is not in the top
+        rank = torch.where(
+            hits.any(1), hits.int().argmax(1), torch.full_like(target, self.ks[-1])
+        )
+        ks = torch.tensor(self.ks, device=rank.device)
+        within = (rank[:, None] < ks[None, :]).double()
+        rank = rank.double()[:, None]
+        per_case = torch.cat(
+            [within, within / (rank + 1), within / torch.log2(rank + 2)], dim=1
+        )
+        counted = labels != 0
+        self.sums += per_case[counted].sum(0)
+        self.count += counted.sum()
+        if loss is not None:
+            self.loss += loss.detach().double()
+
+    def compute(self):
+        """The sums of every metric and the loss, and the number of counted cases."""
+        metrics = dict(zip(self.names, self.sums.tolist()))
+        metrics["loss"] = self.loss.item()
+        metrics["count"] = self.count.item()
+        return metrics
+
+
+class LossLog:
+    """
+    Running means of the losses of a training stage, reduced on their device.
+
+    add() detaches the losses of a step and sums them on their device, it
+    never waits for the device. Every ``every`` steps the sums are copied to
+    host memory with a non-blocking copy, and an event is recorded behind the
+    copy; the record is emitted at a later step, once the event has passed.
+    flush(wait=True) emits everything that is left, e.g. at the end of an
+    epoch.
+
+    Records are dicts ``{"stage": ..., "step": ..., "steps": ..., <name>: mean}``
+    passed to ``sink``; "step" counts from ``start`` and "steps" is the number
+    of steps the means are over. Without a sink (e.g. on the other processes
+    of distributed training) add() does nothing.
+    """
+
+    def __init__(self, stage, names, every=50, sink=print, start=0):
+        self.stage = stage
+        self.names = list(names)
+        self.every = every
+        self.sink = sink
+        self.step = start
+        self._sums = None
+        self._count = 0
+        self._pending = []
+
+    def add(self, *losses):
+        if self.sink is None:
+            return
+        values = torch.stack([loss.detach().float() for loss in losses])
+        if self._sums is None:
+            self._sums = values
+        else:
+            self._sums += values
+        self._count += 1
+        self.step += 1
+        if self._count >= self.every:
+            self.flush()
+        else:
+            self._emit()
+
+    def flush(self, wait=False):
+        """Start reading back the current sums; ``wait`` emits all records."""
+        if self._count:
+            sums, event = self._sums, None
+            if sums.is_cuda:
+                host = torch.empty(sums.shape, dtype=sums.dtype, pin_memory=True)
+                host.copy_(sums, non_blocking=True)
+                sums, event = host, torch.cuda.Event()
+                event.record()
+            self._pending.append((self.step, self._count, sums, event))
+            self._sums, self._count = None, 0
+        self._emit(wait)
+
+    def _emit(self, wait=False):
+        while self._pending:
+            step, count, sums, event = self._pending[0]
+            if event is not None and not wait and not event.query():
+                return
+            if event is not None:
+                event.synchronize()
+            self._pending.pop(0)
+            record = {"stage": self.stage, "step": step, "steps": count}
+            record.update(zip(self.names, (sums / count).tolist()))
+            self.sink(record)
+
+
+def print_losses(path=None):
+    """
+    A LossLog sink printing "<name> is <mean>" for every loss of a record.
+
+    With ``path`` the records are also appended to it as JSON lines.
+    """
+
+    def sink(record):
+        for name, value in record.items():
+            if name.endswith("_loss"):
+                print("%s is %f" % (name.replace("_", " "), value))
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    return sink
+
+
+def _ngrams(sentences, max_n):
+    """
+    Dense n-gram ids of the words of ``sentences``, for n = 1 .. max_n.
+
+    Returns the sentence of every word position, the length of every sentence
+    and for each n the id of the n-gram starting at a position, -1 where the
+    sentence ends before it. Equal n-grams have equal ids across sentences.
+    """
+    vocab = {}
+    tokens = np.fromiter(
+        (vocab.setdefault(word, len(vocab)) for sen in sentences for word in sen),
+        dtype=np.int64,
+    )
+    lengths = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+    sentence = np.repeat(np.arange(len(sentences)), lengths)
+    # words from every position to the end of its sentence
+    remaining = np.cumsum(lengths)[sentence] - np.arange(len(tokens))
+    grams, ids = [], tokens
+    for n in range(1, max_n + 1):
+        if n > 1:
+            # an n-gram is an (n-1)-gram and the word after it
+            following = np.append(tokens[n - 1 :], np.zeros(n - 1, dtype=np.int64))
+            ids = np.unique(ids * len(vocab) + following, return_inverse=True)[1]
+        grams.append(np.where(remaining >= n, ids, -1))
+    return sentence, lengths, grams
+
+
+# math.exp / math.log elementwise, as in NLTK; numpy's may round differently
+_exp = np.frompyfunc(math.exp, 1, 1)
+_log = np.frompyfunc(math.log, 1, 1)
+
+
+def _sentence_bleu(hypotheses, references, max_n):
+    n_hyp = len(hypotheses)
+    sentence, lengths, grams = _ngrams(list(hypotheses) + list(references), max_n)
+    hyp_len, ref_len = lengths[:n_hyp], lengths[n_hyp:]
+    is_ref = sentence >= n_hyp
+    # the hypothesis of every position, references share it with theirs
+    pair = np.where(is_ref, sentence - n_hyp, sentence)
+
+    numerators = np.zeros((n_hyp, max_n), dtype=np.int64)
+    for n, ids in enumerate(grams):
+        n_ids = max(ids.max(initial=-1) + 1, 1)
+        keys = pair * n_ids + ids
+        hyp_keys, hyp_counts = np.unique(keys[(ids >= 0) & ~is_ref], return_counts=True)
+        ref_keys, ref_counts = np.unique(keys[(ids >= 0) & is_ref], return_counts=True)
+        at = np.searchsorted(ref_keys, hyp_keys)
+        found = np.append(ref_keys, -1)[at] == hyp_keys
+        # counts clipped to the reference, as in nltk's modified_precision
+        clipped = np.minimum(hyp_counts, np.append(ref_counts, 0)[at] * found)
+        numerators[:, n] = np.bincount(
+            hyp_keys // n_ids, weights=clipped, minlength=n_hyp
+        )
+    denominators = np.maximum(hyp_len[:, None] - np.arange(max_n), 1)
+
+    # no smoothing: a precision without matches is sys.float_info.min
+    precisions = np.where(numerators > 0, numerators / denominators, sys.float_info.min)
+    brevity = np.ones(n_hyp)
+    short = hyp_len <= ref_len
+    # hyp_len == 0 has no unigram match, its score is 0 below
+    short &= hyp_len > 0
+    brevity[short] = _exp(1 - ref_len[short] / hyp_len[short]).astype(float)
+    # the weights of BLEU-n are one-hot, its geometric mean is precision n
+    scores = brevity[:, None] * _exp(_log(precisions)).astype(float)
+    scores[numerators[:, 0] == 0] = 0
+    return scores
+
+
+def bleu_scores(hypotheses, references, max_n=4, workers=1):
+    """
+    BLEU-1 .. BLEU-max_n of every hypothesis against its single reference.
+
+    Row i, column n-1 is ``sentence_bleu([references[i]], hypotheses[i],
+    weights)`` of NLTK with the one-hot weights of order n. With ``workers``
+    > 1 the sentences are split over a process pool.
+    """
+    if workers > 1 and len(hypotheses) > workers:
+        bounds = np.linspace(0, len(hypotheses), workers + 1).astype(int).tolist()
+        shards = [
+            (hypotheses[start:end], references[start:end], max_n)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        with multiprocessing.Pool(workers) as pool:
+            return np.concatenate(pool.starmap(_sentence_bleu, shards))
+    return _sentence_bleu(hypotheses, references, max_n)
+
+
+def distinct(sentences, max_n=4):
+    """distinct-1 .. distinct-max_n: the number of distinct n-grams per sentence."""
+    _, _, grams = _ngrams(sentences, max_n)
+    return [len(np.unique(ids[ids >= 0])) / len(sentences) for ids in grams]
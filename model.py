@@ -6,8 +6,11 @@ from models.transformer import (
     _build_encoder4kg,
     _build_decoder4kg,
 )
-from models.utils import _create_embeddings, _create_entity_embeddings
+from models.utils import _create_embeddings, _create_entity_embeddings, autocast
 from models.graph import SelfAttentionLayer, SelfAttentionLayer_batch
+from models.decoding import select_tokens
+from checkpoint import atomic_save
+from profiling import region
 from torch_geometric.nn.conv.rgcn_conv import RGCNConv
 from torch_geometric.nn.conv.gcn_conv import GCNConv
 import pickle as pkl
@@ -101,6 +104,29 @@ def _edge_list(kg, n_entity, hop):
     ], len(relation_idx)
 
 
+def _movie_token_entities(word2index, vocab_size):
+    """
+    Map the ``@<movie id>`` tokens of the vocabulary to their entity ids.
+
+    :return:
+        (BoolTensor[vocab], LongTensor[vocab]) marking the movie mention
+        tokens, and their entity id or -1 when the movie is not in the KG.
+    """
+    id2entity = pkl.load(open("data/id2entity.pkl", "rb"))
+    entity2entityId = pkl.load(open("data/entity2entityId.pkl", "rb"))
+    is_movie = torch.zeros(vocab_size, dtype=torch.bool)
+    token2entity = torch.full((vocab_size,), -1, dtype=torch.long)
+    for word, index in word2index.items():
+        if not word.startswith("@") or not word[1:].isdigit():
+            continue
+        is_movie[index] = True
+        try:
+            token2entity[index] = entity2entityId[id2entity[int(word[1:])]]
+        except KeyError:
+            pass
+    return is_movie, token2entity
+
+
 def concept_edge_list4GCN():
     node2index = json.load(open("key2index_3rd.json", encoding="utf-8"))
     f = open("conceptnet_edges2nd.txt", encoding="utf-8")
@@ -115,7 +141,7 @@ def concept_edge_list4GCN():
         edges.add((entity0, entity1))
         edges.add((entity1, entity0))
     edge_set = [[co[0] for co in list(edges)], [co[1] for co in list(edges)]]
-    return torch.LongTensor(edge_set).cuda()
+    return torch.LongTensor(edge_set)
 
 
 class CrossModel(nn.Module):
@@ -166,6 +192,8 @@ class CrossModel(nn.Module):
             if n_positions == 0:
                 # default to 1024
                 n_positions = 1024
+            # long dialogue histories need a position for every context token
+            n_positions = max(n_positions, opt.get("max_c_length") or 0)
 
         if n_positions < 0:
             raise ValueError("n_positions must be positive")
@@ -222,15 +250,22 @@ class CrossModel(nn.Module):
         edge_list, self.n_relation = _edge_list(self.kg, opt["n_entity"], hop=2)
         edge_list = list(set(edge_list))
         print(len(edge_list), self.n_relation)
-        self.dbpedia_edge_sets = torch.LongTensor(edge_list).cuda()
-        self.db_edge_idx = self.dbpedia_edge_sets[:, :2].t()
-        self.db_edge_type = self.dbpedia_edge_sets[:, 2]
+        # constant tensors are non-persistent buffers: model.to(device) moves
+        # them, checkpoints stay as they were
+        dbpedia_edge_sets = torch.LongTensor(edge_list)
+        self.register_buffer("dbpedia_edge_sets", dbpedia_edge_sets, persistent=False)
+        self.register_buffer(
+            "db_edge_idx", dbpedia_edge_sets[:, :2].t().contiguous(), persistent=False
+        )
+        self.register_buffer("db_edge_type", dbpedia_edge_sets[:, 2], persistent=False)
 
         self.dbpedia_RGCN = RGCNConv(
             opt["n_entity"], self.dim, self.n_relation, num_bases=opt["num_bases"]
         )
         # self.concept_RGCN=RGCNConv(opt['n_concept']+1, self.dim, self.n_con_relation, num_bases=opt['num_bases'])
-        self.concept_edge_sets = concept_edge_list4GCN()
+        self.register_buffer(
+            "concept_edge_sets", concept_edge_list4GCN(), persistent=False
+        )
         self.concept_GCN = GCNConv(self.dim, self.dim)
 
         # self.concept_GCN4gen=GCNConv(self.dim, opt['embedding_size'])
@@ -253,9 +288,44 @@ class CrossModel(nn.Module):
         w2i = json.load(open("word2index_redial.json", encoding="utf-8"))
         self.i2w = {w2i[word]: word for word in w2i}
 
-        self.mask4key = torch.Tensor(np.load("mask4key.npy")).cuda()
-        self.mask4movie = torch.Tensor(np.load("mask4movie.npy")).cuda()
-        self.mask4 = self.mask4key + self.mask4movie
+        mask4key = torch.Tensor(np.load("mask4key.npy"))
+        mask4movie = torch.Tensor(np.load("mask4movie.npy"))
+        self.register_buffer("mask4key", mask4key, persistent=False)
+        self.register_buffer("mask4movie", mask4movie, persistent=False)
+        self.register_buffer("mask4", mask4key + mask4movie, persistent=False)
+
+        # fp32, or bf16 / fp16 autocast around forward, see models/utils.py
+        self.precision = opt.get("precision", "fp32")
+
+        # response decoding at test time, see models/decoding.py
+        self.decode_method = opt.get("decode_method", "greedy")
+        self.temperature = opt.get("temperature", 1.0)
+        self.top_k = opt.get("top_k", 0)
+        self.top_p = opt.get("top_p", 1.0)
+        self.repetition_penalty = opt.get("repetition_penalty", 1.0)
+
+        # constrain generated "@<id>" mentions to known movies ("valid") or to
+        # the recommender's top movie_constraint_k movies ("topk"). Mentions
+        # are single tokens in this vocabulary, so a token mask is the whole
+        # prefix trie.
+        self.movie_constraint = opt.get("movie_constraint", "none")
+        self.movie_constraint_k = opt.get("movie_constraint_k", 50)
+        movie_ids = torch.LongTensor(pkl.load(open("data/movie_ids.pkl", "rb")))
+        is_movie_token, token2entity = _movie_token_entities(w2i, len(dictionary) + 4)
+        movie_token_entity = token2entity.clamp(min=0)
+        is_rec_movie = torch.zeros(opt["n_entity"], dtype=torch.bool)
+        is_rec_movie[movie_ids] = True
+        valid_movie_token = is_movie_token & (token2entity >= 0)
+        valid_movie_token &= is_rec_movie[movie_token_entity]
+        self.register_buffer("movie_ids", movie_ids, persistent=False)
+        self.register_buffer("is_movie_token", is_movie_token, persistent=False)
+        self.register_buffer("movie_token_entity", movie_token_entity, persistent=False)
+        self.register_buffer("valid_movie_token", valid_movie_token, persistent=False)
+        # the copy head only scores keyword and movie tokens, so it is projected
+        # onto those rows of representation_bias and scattered into the vocab
+        copy_ids = self.mask4.nonzero().view(-1)
+        self.register_buffer("copy_ids", copy_ids, persistent=False)
+        self.register_buffer("copy_weights", self.mask4[copy_ids], persistent=False)
         if is_finetune:
             params = [
                 self.dbpedia_RGCN.parameters(),
@@ -271,10 +341,55 @@ class CrossModel(nn.Module):
                 for pa in param:
                     pa.requires_grad = False
 
+    @property
+    def device(self):
+        """The device the parameters and buffers live on."""
+        return self.START.device
+
     def _starts(self, bsz):
         """Return bsz start tokens."""
         return self.START.detach().expand(bsz, 1)
 
+    def _copy_logits(self, copy_latent, head, copy_ids):
+        """
+        Project the copy latent onto the ``copy_ids`` rows of ``head`` only.
+
+        This equals ``head(copy_latent)[..., copy_ids]`` without computing the
+        logits of the tokens that the copy mask zeroes out anyway.
+        """
+        return F.linear(copy_latent, head.weight[copy_ids], head.bias[copy_ids])
+
+    def _add_copy_logits(self, voc_logits, con_logits, copy_ids, copy_weights):
+        """Scatter-add weighted sparse copy logits into the vocabulary logits."""
+        return voc_logits.index_add(
+            -1, copy_ids, (con_logits * copy_weights).type_as(voc_logits)
+        )
+
+    def movie_constraint_mask(self, entity_scores):
+        """
+        Tokens that decoding may choose under the movie_constraint option.
+
+        :param entity_scores:
+            FloatTensor[bsz, n_entity] of recommender scores.
+
+        :return:
+            None without a constraint, else a BoolTensor broadcastable to
+            [bsz, vocab] that is False for disallowed movie mention tokens.
+        """
+        if self.movie_constraint == "none":
+            return None
+        if self.movie_constraint == "valid":
+            return (~self.is_movie_token | self.valid_movie_token).unsqueeze(0)
+        if self.movie_constraint != "topk":
+            raise ValueError(f"Unknown movie constraint {self.movie_constraint}")
+
+        k = min(self.movie_constraint_k, self.movie_ids.size(0))
+        top = entity_scores[:, self.movie_ids].topk(k, dim=-1)[1]
+        recommended = torch.zeros_like(entity_scores, dtype=torch.bool)
+        recommended.scatter_(1, self.movie_ids[top], True)
+        allowed_movie = recommended[:, self.movie_token_entity] & self.valid_movie_token
+        return ~self.is_movie_token | allowed_movie
+
     def decode_greedy(
         self,
         encoder_states,
@@ -284,9 +399,11 @@ class CrossModel(nn.Module):
         attention_db,
         bsz,
         maxlen,
+        method="greedy",
+        allowed=None,
     ):
         """
-        Greedy search
+        Greedy search, or top-k / nucleus / temperature sampling
 
         :param int bsz:
             Batch size. Because encoder_states is model-specific, it cannot
@@ -301,6 +418,14 @@ class CrossModel(nn.Module):
         :param int maxlen:
             Maximum decoding length
 
+        :param str method:
+            ``greedy`` or ``sample``. Sampling uses the temperature, top_k,
+            top_p and repetition_penalty options of the model.
+
+        :param allowed:
+            optional BoolTensor[bsz or 1, vocab] of the tokens that may be
+            chosen, see movie_constraint_mask.
+
         :return:
             pair (logits, choices) of the greedy decode
 
@@ -309,38 +434,48 @@ class CrossModel(nn.Module):
         """
         xs = self._starts(bsz)
         incr_state = None
-        logits = []
+        # rows of the batch that are still decoding; finished rows are dropped
+        # from every per-row state and scattered back once decoding stops
+        active = torch.arange(bsz, device=xs.device)
+        step_rows = []
+        step_logits = []
+        step_preds = []
+        kg_attn_norm = self.kg_attn_norm(attention_kg).unsqueeze(1)
+        db_attn_norm = self.db_attn_norm(attention_db).unsqueeze(1)
         for i in range(maxlen):
-            # todo, break early if all beams saw EOS
             scores, incr_state = self.decoder(
                 xs, encoder_states, encoder_states_kg, encoder_states_db, incr_state
             )
             # batch*1*hidden
             scores = scores[:, -1:, :]
             # scores = self.output(scores)
-            kg_attn_norm = self.kg_attn_norm(attention_kg)
-
-            db_attn_norm = self.db_attn_norm(attention_db)
 
             copy_latent = self.copy_norm(
-                torch.cat(
-                    [kg_attn_norm.unsqueeze(1), db_attn_norm.unsqueeze(1), scores], -1
-                )
+                torch.cat([kg_attn_norm, db_attn_norm, scores], -1)
             )
 
             # logits = self.output(latent)
-            con_logits = self.representation_bias(copy_latent) * self.mask4.unsqueeze(
-                0
-            ).unsqueeze(
-                0
-            )  # F.linear(copy_latent, self.embeddings.weight)
             voc_logits = F.linear(scores, self.embeddings.weight)
             # print(logits.size())
             # print(mem_logits.size())
             # gate = F.sigmoid(self.gen_gate_norm(scores))
 
-            sum_logits = voc_logits + con_logits  # * (1 - gate)
-            _, preds = sum_logits.max(dim=-1)
+            sum_logits = self._add_copy_logits(
+                voc_logits,
+                self._copy_logits(copy_latent, self.representation_bias, self.copy_ids),
+                self.copy_ids,
+                self.copy_weights,
+            )  # * (1 - gate)
+            preds = select_tokens(
+                sum_logits.squeeze(1),
+                xs,
+                method=method,
+                temperature=self.temperature,
+                top_k=self.top_k,
+                top_p=self.top_p,
+                repetition_penalty=self.repetition_penalty,
+                allowed=allowed,
+            ).unsqueeze(1)
             # scores = F.linear(scores, self.embeddings.weight)
 
             # print(attention_map)
@@ -357,13 +492,49 @@ class CrossModel(nn.Module):
             # print(sum_logits.size())
 
             # _, preds = sum_logits.max(dim=-1)
-            logits.append(sum_logits)
+            step_rows.append(active)
+            step_logits.append(sum_logits.squeeze(1))
+            step_preds.append(preds.squeeze(1))
             xs = torch.cat([xs, preds], dim=1)
-            # check if everyone has generated an end token
-            all_finished = ((xs == self.END_IDX).sum(dim=1) > 0).sum().item() == bsz
-            if all_finished:
+
+            # the size of ``keep`` is the only host sync per step, and compaction
+            # needs it anyway to shape the next batch
+            keep = (preds.squeeze(1) != self.END_IDX).nonzero().view(-1)
+            if keep.numel() == 0:
                 break
-        logits = torch.cat(logits, 1)
+            if keep.numel() < active.numel():
+                active = active[keep]
+                xs = xs[keep]
+                encoder_states = self.reorder_encoder_states(encoder_states, keep)
+                encoder_states_kg = self.reorder_encoder_states(encoder_states_kg, keep)
+                encoder_states_db = self.reorder_encoder_states(encoder_states_db, keep)
+                kg_attn_norm = kg_attn_norm[keep]
+                db_attn_norm = db_attn_norm[keep]
+                if allowed is not None and allowed.size(0) > 1:
+                    allowed = allowed[keep]
+                incr_state = self.reorder_decoder_incremental_state(incr_state, keep)
+        return self._scatter_decoded(bsz, step_rows, step_logits, step_preds)
+
+    def _scatter_decoded(self, bsz, step_rows, step_logits, step_preds):
+        """
+        Scatter the per-step outputs of a compacted decode back to batch order.
+
+        Positions after a row emitted its end token are filled with
+        ``NULL_IDX`` in the choices and zeros in the logits.
+
+        :rtype:
+            (FloatTensor[bsz, steps, vocab], LongTensor[bsz, steps + 1])
+        """
+        n_steps = len(step_logits)
+        rows = torch.cat(step_rows)
+        steps = torch.cat(
+            [torch.full_like(r, i) for i, r in enumerate(step_rows)]
+        )
+        logits = step_logits[0].new_zeros(bsz, n_steps, step_logits[0].size(-1))
+        logits[rows, steps] = torch.cat(step_logits)
+        xs = rows.new_full((bsz, n_steps + 1), self.NULL_IDX)
+        xs[:, :1] = self._starts(bsz)
+        xs[rows, steps + 1] = torch.cat(step_preds)
         return logits, xs
 
     def decode_forced(
@@ -431,17 +602,17 @@ class CrossModel(nn.Module):
         )
 
         # logits = self.output(latent)
-        con_logits = self.representation_bias(copy_latent) * self.mask4.unsqueeze(
-            0
-        ).unsqueeze(
-            0
-        )  # F.linear(copy_latent, self.embeddings.weight)
         logits = F.linear(latent, self.embeddings.weight)
         # print(logits.size())
         # print(mem_logits.size())
         # gate=F.sigmoid(self.gen_gate_norm(latent))
 
-        sum_logits = logits + con_logits  # *(1-gate)
+        sum_logits = self._add_copy_logits(
+            logits,
+            self._copy_logits(copy_latent, self.representation_bias, self.copy_ids),
+            self.copy_ids,
+            self.copy_weights,
+        )  # *(1-gate)
         _, preds = sum_logits.max(dim=2)
         return logits, preds
 
@@ -461,14 +632,18 @@ class CrossModel(nn.Module):
         db_emb = self.info_db_norm(db_user_emb)
         con_scores = F.linear(db_emb, con_nodes_features, self.info_output_con.bias)
         db_scores = F.linear(con_emb, db_nodes_features, self.info_output_db.bias)
+        # the losses are computed in fp32 under reduced precision
+        con_scores, db_scores = con_scores.float(), db_scores.float()
 
         info_db_loss = (
-            torch.sum(self.info_db_loss(db_scores, db_label.cuda().float()), dim=-1)
-            * mask.cuda()
+            torch.sum(self.info_db_loss(db_scores, db_label.to(self.device).float()), dim=-1)
+            * mask.to(self.device)
         )
         info_con_loss = (
-            torch.sum(self.info_con_loss(con_scores, con_label.cuda().float()), dim=-1)
-            * mask.cuda()
+            torch.sum(
+                self.info_con_loss(con_scores, con_label.to(self.device).float()), dim=-1
+            )
+            * mask.to(self.device)
         )
 
         return torch.mean(info_db_loss), torch.mean(info_con_loss)
@@ -485,13 +660,18 @@ class CrossModel(nn.Module):
         # node_count*dim
         db_scores = F.linear(graph_embedding, db_nodes_features, self.info_output_db.bias)
         info_db_loss = (
-            torch.sum(self.info_db_loss(db_scores, db_label.cuda().float()), dim=-1)
-            * mask.cuda()
+            torch.sum(self.info_db_loss(db_scores, db_label.to(self.device).float()), dim=-1)
+            * mask.to(self.device)
         )
         return torch.mean(info_db_loss)
 
 
-    def forward(
+    def forward(self, *args, **kwargs):
+        """Run :meth:`_forward` under the autocast policy of --precision."""
+        with autocast(self.precision, self.embeddings.weight.device.type):
+            return self._forward(*args, **kwargs)
+
+    def _forward(
         self,
         xs,
         ys,
@@ -509,6 +689,7 @@ class CrossModel(nn.Module):
         prev_enc=None,
         maxlen=None,
         bsz=None,
+        mode="full",
     ):
         """
         Get output predictions from the model.
@@ -532,6 +713,12 @@ class CrossModel(nn.Module):
         :param bsz:
             if ys is not provided, then you must specify the bsz for greedy
             decoding.
+        :param mode:
+            "full" runs the recommender and the generator, "rec" only the graph
+            encoders, user pooling, entity scores and the rec / infomax losses;
+            scores, preds and gen_loss are then None. "eval" shares one encoder
+            and graph pass between the teacher-forced gen_loss and the greedy
+            scores / preds, as validation needs both.
 
         :return:
             (scores, candidate_scores, encoder_states) tuple
@@ -543,51 +730,59 @@ class CrossModel(nn.Module):
             - encoder_states are the output of model.encoder. Model specific types.
               Feed this back in to skip encoding on the next call.
         """
+        if mode not in ("full", "rec", "eval"):
+            raise ValueError(f"Unknown forward mode {mode}, pick full, rec or eval")
         if test == False:
             # TODO: get rid of longest_label
             # keep track of longest label we've ever seen
             # we'll never produce longer ones than that during prediction
             self.longest_label = max(self.longest_label, ys.size(1))
 
-        # use cached encoding if available
-        # xxs = self.embeddings(xs)
-        # mask=xs == self.pad_idx
-        encoder_states = prev_enc if prev_enc is not None else self.encoder(xs)
+        # the training loops hand over the id tensors on the CPU
+        concept_mask = concept_mask.to(self.device)
+        entity_vector = entity_vector.to(self.device)
 
-        # graph network
-        db_nodes_features = self.dbpedia_RGCN(None, self.db_edge_idx, self.db_edge_type)
-        con_nodes_features = self.concept_GCN(
-            self.concept_embeddings.weight, self.concept_edge_sets
-        )
+        # graph network, the message passing aggregation always runs in fp32
+        with torch.autocast(xs.device.type, enabled=False):
+            with region("dbpedia_RGCN"):
+                db_nodes_features = self.dbpedia_RGCN(
+                    None, self.db_edge_idx, self.db_edge_type
+                )
+            with region("concept_GCN"):
+                con_nodes_features = self.concept_GCN(
+                    self.concept_embeddings.weight, self.concept_edge_sets
+                )
 
-        user_representation_list = []
-        db_con_mask = []
-        db_attn_mask = []
-        for i, seed_set in enumerate(seed_sets):
-            if seed_set == []:
-                # user_representation_list.append(torch.zeros(self.dim).cuda())
-                user_representation_list.append(
-                    torch.zeros(concept_mask.shape[1], self.dim).cuda()
+        with region("seed_sets"):
+            user_representation_list = []
+            db_con_mask = []
+            db_attn_mask = []
+            for i, seed_set in enumerate(seed_sets):
+                if seed_set == []:
+                    # user_representation_list.append(torch.zeros(self.dim).cuda())
+                    user_representation_list.append(
+                        torch.zeros(concept_mask.shape[1], self.dim, device=self.device)
+                    )
+                    db_con_mask.append(torch.zeros([1]))
+                    db_attn_mask.append(torch.ones([concept_mask.shape[1]]))
+                    continue
+                user_representation = db_nodes_features[seed_set]  # torch can reflect
+                pad = torch.zeros(
+                    [concept_mask.shape[1] - user_representation.shape[0], self.dim],
+                    device=self.device,
                 )
-                db_con_mask.append(torch.zeros([1]))
-                db_attn_mask.append(torch.ones([concept_mask.shape[1]]))
-                continue
-            user_representation = db_nodes_features[seed_set]  # torch can reflect
-            pad = torch.zeros(
-                [concept_mask.shape[1] - user_representation.shape[0], self.dim]
-            ).cuda()
-            user_representation = torch.cat([user_representation, pad], dim=0)
-            # user_representation = self.self_attn_db(user_representation)
-            user_representation_list.append(user_representation)
-            db_con_mask.append(torch.ones([1]))
-
-            entities = torch.zeros([user_representation.shape[0]])
-            pad = torch.ones([concept_mask.shape[1] - user_representation.shape[0]])
-            db_attn_mask.append(torch.cat([entities, pad], dim=0))
-
-        db_user_emb = torch.stack(user_representation_list)
-        db_con_mask = torch.stack(db_con_mask)
-        db_attn_mask = torch.stack(db_attn_mask)
+                user_representation = torch.cat([user_representation, pad], dim=0)
+                # user_representation = self.self_attn_db(user_representation)
+                user_representation_list.append(user_representation)
+                db_con_mask.append(torch.ones([1]))
+
+                entities = torch.zeros([user_representation.shape[0]])
+                pad = torch.ones([concept_mask.shape[1] - user_representation.shape[0]])
+                db_attn_mask.append(torch.cat([entities, pad], dim=0))
+
+            db_user_emb = torch.stack(user_representation_list)
+            db_con_mask = torch.stack(db_con_mask)
+            db_attn_mask = torch.stack(db_attn_mask)
 
         graph_con_emb = con_nodes_features[concept_mask]
         con_emb_mask = concept_mask == self.concept_padding
@@ -629,14 +824,18 @@ class CrossModel(nn.Module):
         
         # con_user_emb = graph_con_emb
         # type-aware graph pooling
-        con_user_emb, _ = self.self_attn(con_user_emb, con_emb_mask.cuda())
-        db_user_emb, _ = self.en_self_attn(db_user_emb, db_attn_mask.cuda())
+        with region("seed_pooling"):
+            con_user_emb, _ = self.self_attn(graph_con_emb, con_emb_mask)
+            db_user_emb, _ = self.en_self_attn(
+                db_user_emb, db_attn_mask.to(self.device)
+            )
 
-        user_emb = self.user_norm(torch.cat([con_user_emb, db_user_emb], dim=-1))
-        uc_gate = F.sigmoid(self.gate_norm(user_emb))
+        with region("entity_scoring"):
+            user_emb = self.user_norm(torch.cat([con_user_emb, db_user_emb], dim=-1))
+            uc_gate = F.sigmoid(self.gate_norm(user_emb))
 
-        user_emb = uc_gate * db_user_emb + (1 - uc_gate) * con_user_emb
-        entity_scores = F.linear(user_emb, db_nodes_features, self.output_en.bias)
+            user_emb = uc_gate * db_user_emb + (1 - uc_gate) * con_user_emb
+            entity_scores = F.linear(user_emb, db_nodes_features, self.output_en.bias)
         # entity_scores = scores_db * gate + scores_con * (1 - gate)
         # entity_scores=(scores_db+scores_con)/2
 
@@ -656,48 +855,71 @@ class CrossModel(nn.Module):
 
         # entity_scores = F.softmax(entity_scores.cuda(), dim=-1).cuda()
         rec_loss = self.criterion(
-            entity_scores.squeeze(1).squeeze(1).float(), labels.cuda()
+            entity_scores.squeeze(1).squeeze(1).float(), labels.to(self.device)
         )
         # rec_loss=self.klloss(entity_scores.squeeze(1).squeeze(1).float(), labels.float().cuda())
-        rec_loss = torch.sum(rec_loss * rec.float().cuda())
+        rec_loss = torch.sum(rec_loss * rec.float().to(self.device))
 
         self.user_rep = user_emb
 
+        if mode == "rec":
+            # the recommender does not need the context encoder or a decoder
+            return (
+                None,
+                None,
+                entity_scores,
+                rec_loss,
+                None,
+                mask_loss,
+                info_db_loss,
+                info_con_loss,
+            )
+
+        # use cached encoding if available
+        # xxs = self.embeddings(xs)
+        # mask=xs == self.pad_idx
+        with region("encoder"):
+            encoder_states = prev_enc if prev_enc is not None else self.encoder(xs)
+
         # generation---------------------------------------------------------------------------------------------------
         con_nodes_features4gen = con_nodes_features  # self.concept_GCN4gen(con_nodes_features,self.concept_edge_sets)
         con_emb4gen = con_nodes_features4gen[concept_mask]
         con_mask4gen = concept_mask != self.concept_padding
         # kg_encoding=self.kg_encoder(con_emb4gen.cuda(),con_mask4gen.cuda())
-        kg_encoding = (self.kg_norm(con_emb4gen), con_mask4gen.cuda())
+        kg_encoding = (self.kg_norm(con_emb4gen), con_mask4gen)
 
         db_emb4gen = db_nodes_features[entity_vector]  # batch*50*dim
         db_mask4gen = entity_vector != 0
         # db_encoding=self.db_encoder(db_emb4gen.cuda(),db_mask4gen.cuda())
-        db_encoding = (self.db_norm(db_emb4gen), db_mask4gen.cuda())
+        db_encoding = (self.db_norm(db_emb4gen), db_mask4gen)
 
-        if test == False:
+        gen_loss = None
+        if test == False or mode == "eval":
             # use teacher forcing
-            scores, preds = self.decode_forced(
-                encoder_states,
-                kg_encoding,
-                db_encoding,
-                con_user_emb,
-                db_user_emb,
-                mask_ys,
-            )
-            gen_loss = torch.mean(self.compute_loss(scores, mask_ys))
-
-        else:
-            scores, preds = self.decode_greedy(
-                encoder_states,
-                kg_encoding,
-                db_encoding,
-                con_user_emb,
-                db_user_emb,
-                bsz,
-                maxlen or self.longest_label,
-            )
-            gen_loss = None
+            with region("decode_forced"):
+                scores, preds = self.decode_forced(
+                    encoder_states,
+                    kg_encoding,
+                    db_encoding,
+                    con_user_emb,
+                    db_user_emb,
+                    mask_ys,
+                )
+                gen_loss = torch.mean(self.compute_loss(scores, mask_ys))
+
+        if test != False or mode == "eval":
+            with region("decode_greedy"):
+                scores, preds = self.decode_greedy(
+                    encoder_states,
+                    kg_encoding,
+                    db_encoding,
+                    con_user_emb,
+                    db_user_emb,
+                    bsz,
+                    maxlen or self.longest_label,
+                    method=self.decode_method,
+                    allowed=self.movie_constraint_mask(entity_scores),
+                )
 
         return (
             scores,
@@ -799,14 +1021,18 @@ class CrossModel(nn.Module):
     def compute_loss(self, output, scores):
         score_view = scores.view(-1)
         output_view = output.view(-1, output.size(-1))
-        loss = self.criterion(output_view.cuda(), score_view.cuda())
+        loss = self.criterion(output_view.float(), score_view)
         return loss
 
-    def save_model(self):
-        torch.save(self.state_dict(), "saved_model/net_parameter1.pkl")
+    def save_model(self, path="saved_model/net_parameter1.pkl", writer=None):
+        """Save the parameters, in the background with an AsyncCheckpointWriter."""
+        if writer is None:
+            atomic_save(self.state_dict(), path)
+        else:
+            writer.save(self.state_dict(), path)
 
-    def load_model(self):
-        self.load_state_dict(torch.load("saved_model/net_parameter1.pkl"))
+    def load_model(self, path="saved_model/net_parameter1.pkl"):
+        self.load_state_dict(torch.load(path, map_location=self.device))
 
     def output(self, tensor):
         # project back to vocabulary
@@ -8,6 +8,7 @@ from models.transformer import (
 )
 from models.utils import _create_embeddings, _create_entity_embeddings
 from models.graph import SelfAttentionLayer, SelfAttentionLayer_batch
+from checkpoint import atomic_save
 from torch_geometric.nn.conv.rgcn_conv import RGCNConv
 from torch_geometric.nn.conv.gcn_conv import GCNConv
 from torch_geometric.nn import GATConv
@@ -145,7 +146,7 @@ def concept_edge_list4GCN():
         edges.add((entity0, entity1))
         edges.add((entity1, entity0))
     edge_set = [[co[0] for co in list(edges)], [co[1] for co in list(edges)]]
-    return torch.LongTensor(edge_set).cuda()
+    return torch.LongTensor(edge_set)
 
 
 class CrossModel(nn.Module):
@@ -211,6 +212,8 @@ class CrossModel(nn.Module):
             if n_positions == 0:
                 # default to 1024
                 n_positions = 1024
+            # long dialogue histories need a position for every context token
+            n_positions = max(n_positions, opt.get("max_c_length") or 0)
 
         if n_positions < 0:
             raise ValueError("n_positions must be positive")
@@ -280,20 +283,31 @@ class CrossModel(nn.Module):
         edge_list = list(set(edge_list))
         
         print(len(edge_list), self.n_relation)
-        self.dbpedia_edge_sets = torch.LongTensor(edge_list).cuda()
-        self.db_edge_idx = self.dbpedia_edge_sets[:, :2].t()
-        self.db_edge_type = self.dbpedia_edge_sets[:, 2]
+        # constant tensors are non-persistent buffers: model.to(device) moves
+        # them, checkpoints stay as they were
+        dbpedia_edge_sets = torch.LongTensor(edge_list)
+        self.register_buffer("dbpedia_edge_sets", dbpedia_edge_sets, persistent=False)
+        self.register_buffer(
+            "db_edge_idx", dbpedia_edge_sets[:, :2].t().contiguous(), persistent=False
+        )
+        self.register_buffer("db_edge_type", dbpedia_edge_sets[:, 2], persistent=False)
         
         non_relational_edge_list = [(x1, x2) for x1, x2, _ in edge_list]
         non_relational_edge_set = [[co[0] for co in list(non_relational_edge_list)], [co[1] for co in list(non_relational_edge_list)]]
-        self.non_relational_edge_set = torch.LongTensor(non_relational_edge_set).cuda()
+        self.register_buffer(
+            "non_relational_edge_set",
+            torch.LongTensor(non_relational_edge_set),
+            persistent=False,
+        )
         
         #word_item_edge_list
         self.word_item_kg = json.load(open('processed_word_item_edge_list.json','r'))
-        self.word_item_edge_sets = _edge_list_word_item(self.word_item_kg, opt["n_entity"], hop = 1)
+        word_item_edge_sets = _edge_list_word_item(self.word_item_kg, opt["n_entity"], hop = 1)
         
-        self.word_item_edge_sets = [[co[0] for co in list(self.word_item_edge_sets)], [co[1] for co in list(self.word_item_edge_sets)]]
-        self.word_item_edge_sets =  torch.LongTensor(self.word_item_edge_sets).cuda()
+        word_item_edge_sets = [[co[0] for co in list(word_item_edge_sets)], [co[1] for co in list(word_item_edge_sets)]]
+        self.register_buffer(
+            "word_item_edge_sets", torch.LongTensor(word_item_edge_sets), persistent=False
+        )
 
         self.copy_ratio = 0.3
         self.one_hop_ratio = 0.7
@@ -318,10 +332,13 @@ class CrossModel(nn.Module):
             opt['n_entity'], self.dim, self.n_relation, num_bases=opt["num_bases"]
         )
 #         self.concept_RGCN=RGCNConv(opt['n_concept']+1, self.dim, self.n_con_relation, num_bases=opt['num_bases'])
-        self.concept_edge_sets = concept_edge_list4GCN()
+        concept_edge_sets = concept_edge_list4GCN()
+        self.register_buffer("concept_edge_sets", concept_edge_sets, persistent=False)
         self.concept_GCN = GCNConv(self.dim, self.dim)
         
-        self.temp_edge_sets = self.concept_edge_sets.clone() + opt['n_entity']
+        self.register_buffer(
+            "temp_edge_sets", concept_edge_sets + opt['n_entity'], persistent=False
+        )
 #         self.word_item_edge_sets = torch.cat([self.word_item_edge_sets, self.temp_edge_sets ], dim = -1)
         # self.concept_GCN4gen=GCNConv(self.dim, opt['embedding_size'])
         
@@ -334,9 +351,26 @@ class CrossModel(nn.Module):
         w2i = json.load(open("word2index_redial.json", encoding="utf-8"))
         self.i2w = {w2i[word]: word for word in w2i}
 
-        self.mask4key = torch.Tensor(np.load("mask4key.npy")).cuda()
-        self.mask4movie = torch.Tensor(np.load("mask4movie.npy")).cuda()
-        self.mask4 = self.mask4key + self.mask4movie
+        mask4key = torch.Tensor(np.load("mask4key.npy"))
+        mask4movie = torch.Tensor(np.load("mask4movie.npy"))
+        mask4 = mask4key + mask4movie
+        self.register_buffer("mask4key", mask4key, persistent=False)
+        self.register_buffer("mask4movie", mask4movie, persistent=False)
+        self.register_buffer("mask4", mask4, persistent=False)
+        # both copy heads only score keyword (and movie) tokens, so they are
+        # projected onto those rows and scattered into the vocab
+        copy_ids = mask4.nonzero().view(-1)
+        copy_key_ids = mask4key.nonzero().view(-1)
+        self.register_buffer("copy_ids", copy_ids, persistent=False)
+        self.register_buffer(
+            "copy_weights", self.copy_ratio * mask4[copy_ids], persistent=False
+        )
+        self.register_buffer("copy_key_ids", copy_key_ids, persistent=False)
+        self.register_buffer(
+            "copy_key_weights",
+            self.one_hop_ratio * mask4key[copy_key_ids],
+            persistent=False,
+        )
         if is_finetune:
             params = [
                 self.dbpedia_RGCN.parameters(),
@@ -354,10 +388,28 @@ class CrossModel(nn.Module):
                 for pa in param:
                     pa.requires_grad = False
 
+    @property
+    def device(self):
+        """The device the parameters and buffers live on."""
+        return self.START.device
+
     def _starts(self, bsz):
         """Return bsz start tokens."""
         return self.START.detach().expand(bsz, 1)
 
+    def _copy_logits(self, copy_latent, head, copy_ids):
+        """
+        Project the copy latent onto the ``copy_ids`` rows of ``head`` only.
+
+        This equals ``head(copy_latent)[..., copy_ids]`` without computing the
+        logits of the tokens that the copy mask zeroes out anyway.
+        """
+        return F.linear(copy_latent, head.weight[copy_ids], head.bias[copy_ids])
+
+    def _add_copy_logits(self, voc_logits, con_logits, copy_ids, copy_weights):
+        """Scatter-add weighted sparse copy logits into the vocabulary logits."""
+        return voc_logits.index_add(-1, copy_ids, con_logits * copy_weights)
+
     def decode_greedy(
         self,
         encoder_states,
@@ -392,50 +444,50 @@ class CrossModel(nn.Module):
         """
         xs = self._starts(bsz)
         incr_state = None
-        logits = []
+        # rows of the batch that are still decoding; finished rows are dropped
+        # from every per-row state and scattered back once decoding stops
+        active = torch.arange(bsz, device=xs.device)
+        step_rows = []
+        step_logits = []
+        step_preds = []
+        kg_attn_norm = self.kg_attn_norm(attention_kg).unsqueeze(1)
+        db_attn_norm = self.db_attn_norm(attention_db).unsqueeze(1)
         for i in range(maxlen):
-            # todo, break early if all beams saw EOS
             scores, incr_state = self.decoder(
                 xs, encoder_states, encoder_states_kg, encoder_states_db, incr_state
             )
             # batch*1*hidden
             scores = scores[:, -1:, :]
             # scores = self.output(scores)
-            kg_attn_norm = self.kg_attn_norm(attention_kg)
-
-            db_attn_norm = self.db_attn_norm(attention_db)
 
             copy_latent = self.copy_norm(
-                torch.cat(
-                    [kg_attn_norm.unsqueeze(1), db_attn_norm.unsqueeze(1), scores], -1
-                )
+                torch.cat([kg_attn_norm, db_attn_norm, scores], -1)
             )
 
             copy_latent_1_hop = self.copy_norm_1_hop(
-                torch.cat(
-                    [kg_attn_norm.unsqueeze(1), db_attn_norm.unsqueeze(1), scores], -1
-                )
+                torch.cat([kg_attn_norm, db_attn_norm, scores], -1)
             )
 
             # logits = self.output(latent)
-            con_logits = self.representation_bias(copy_latent) * self.mask4.unsqueeze(
-                0
-            ).unsqueeze(
-                0
-            )  
-            con_logits_1_hop = self.representation_bias_1_hop(copy_latent_1_hop) * self.mask4key.unsqueeze(
-                0
-            ).unsqueeze(
-                0
+            con_logits = self._copy_logits(
+                copy_latent, self.representation_bias, self.copy_ids
             )
-            
+            con_logits_1_hop = self._copy_logits(
+                copy_latent_1_hop, self.representation_bias_1_hop, self.copy_key_ids
+            )
+
             # F.linear(copy_latent, self.embeddings.weight)
             voc_logits = F.linear(scores, self.embeddings.weight)
             # print(logits.size())
             # print(mem_logits.size())
             # gate = F.sigmoid(self.gen_gate_norm(scores))
 
-            sum_logits = voc_logits + self.copy_ratio * con_logits + self.one_hop_ratio * con_logits_1_hop # * (1 - gate)
+            sum_logits = self._add_copy_logits(
+                voc_logits, con_logits, self.copy_ids, self.copy_weights
+            )
+            sum_logits = self._add_copy_logits(
+                sum_logits, con_logits_1_hop, self.copy_key_ids, self.copy_key_weights
+            )  # * (1 - gate)
             _, preds = sum_logits.max(dim=-1)
             # scores = F.linear(scores, self.embeddings.weight)
             # print(attention_map)
@@ -452,13 +504,47 @@ class CrossModel(nn.Module):
             # print(sum_logits.size())
 
             # _, preds = sum_logits.max(dim=-1)
-            logits.append(sum_logits)
+            step_rows.append(active)
+            step_logits.append(sum_logits.squeeze(1))
+            step_preds.append(preds.squeeze(1))
             xs = torch.cat([xs, preds], dim=1)
-            # check if everyone has generated an end token
-            all_finished = ((xs == self.END_IDX).sum(dim=1) > 0).sum().item() == bsz
-            if all_finished:
+
+            # the size of ``keep`` is the only host sync per step, and compaction
+            # needs it anyway to shape the next batch
+            keep = (preds.squeeze(1) != self.END_IDX).nonzero().view(-1)
+            if keep.numel() == 0:
                 break
-        logits = torch.cat(logits, 1)
+            if keep.numel() < active.numel():
+                active = active[keep]
+                xs = xs[keep]
+                encoder_states = self.reorder_encoder_states(encoder_states, keep)
+                encoder_states_kg = self.reorder_encoder_states(encoder_states_kg, keep)
+                encoder_states_db = self.reorder_encoder_states(encoder_states_db, keep)
+                kg_attn_norm = kg_attn_norm[keep]
+                db_attn_norm = db_attn_norm[keep]
+                incr_state = self.reorder_decoder_incremental_state(incr_state, keep)
+        return self._scatter_decoded(bsz, step_rows, step_logits, step_preds)
+
+    def _scatter_decoded(self, bsz, step_rows, step_logits, step_preds):
+        """
+        Scatter the per-step outputs of a compacted decode back to batch order.
+
+        Positions after a row emitted its end token are filled with
+        ``NULL_IDX`` in the choices and zeros in the logits.
+
+        :rtype:
+            (FloatTensor[bsz, steps, vocab], LongTensor[bsz, steps + 1])
+        """
+        n_steps = len(step_logits)
+        rows = torch.cat(step_rows)
+        steps = torch.cat(
+            [torch.full_like(r, i) for i, r in enumerate(step_rows)]
+        )
+        logits = step_logits[0].new_zeros(bsz, n_steps, step_logits[0].size(-1))
+        logits[rows, steps] = torch.cat(step_logits)
+        xs = rows.new_full((bsz, n_steps + 1), self.NULL_IDX)
+        xs[:, :1] = self._starts(bsz)
+        xs[rows, steps + 1] = torch.cat(step_preds)
         return logits, xs
 
     def decode_forced(
@@ -537,16 +623,26 @@ class CrossModel(nn.Module):
         )
 
         # logits = self.output(latent)
-        con_logits = self.representation_bias(copy_latent) 
-        con_logits_1_hop = self.representation_bias_1_hop(copy_latent_1_hop) 
-                
+        con_logits = self._copy_logits(
+            copy_latent, self.representation_bias, self.copy_ids
+        )
+        # only the keyword columns, [bsz, seqlen, len(copy_key_ids)]
+        con_logits_1_hop = self._copy_logits(
+            copy_latent_1_hop, self.representation_bias_1_hop, self.copy_key_ids
+        )
+
         # F.linear(copy_latent, self.embeddings.weight)
         logits = F.linear(latent, self.embeddings.weight)
         # print(logits.size())
         # print(mem_logits.size())
         # gate=F.sigmoid(self.gen_gate_norm(latent))
 
-        sum_logits = logits + self.copy_ratio * con_logits  * self.mask4.unsqueeze(0).unsqueeze(0) + self.one_hop_ratio * con_logits_1_hop * self.mask4key.unsqueeze(0).unsqueeze(0)
+        sum_logits = self._add_copy_logits(
+            logits, con_logits, self.copy_ids, self.copy_weights
+        )
+        sum_logits = self._add_copy_logits(
+            sum_logits, con_logits_1_hop, self.copy_key_ids, self.copy_key_weights
+        )
         _, preds = sum_logits.max(dim=2)
         return logits, con_logits_1_hop, preds
 
@@ -568,8 +664,8 @@ class CrossModel(nn.Module):
         db_scores = F.linear(con_user_emb, db_nodes_features, self.info_output_db.bias)
 
         info_db_loss = (
-            torch.sum(self.info_db_loss(db_scores, db_label.cuda().float()), dim=-1)
-            * mask.cuda()
+            torch.sum(self.info_db_loss(db_scores, db_label.to(self.device).float()), dim=-1)
+            * mask.to(self.device)
         )
 #         info_con_loss = (
 #             torch.sum(self.info_con_loss(con_scores, con_label.cuda().float()), dim=-1)
@@ -589,8 +685,11 @@ class CrossModel(nn.Module):
         
         db_scores = F.linear(con_user_emb, db_nodes_features, self.info_output_db.bias)
         cross_entropy_loss = (
-            torch.sum(self.link_prediction_loss(db_scores, db_label.cuda().float()), dim=-1)
-            * mask.cuda()
+            torch.sum(
+                self.link_prediction_loss(db_scores, db_label.to(self.device).float()),
+                dim=-1,
+            )
+            * mask.to(self.device)
         )
         
         return torch.mean(cross_entropy_loss), 0
@@ -657,6 +756,11 @@ class CrossModel(nn.Module):
             # we'll never produce longer ones than that during prediction
             self.longest_label = max(self.longest_label, ys.size(1))
 
+        # the training loops hand over the id tensors on the CPU
+        concept_mask = concept_mask.to(self.device)
+        entity_vector = entity_vector.to(self.device)
+        db_label = db_label.to(self.device)
+
         # use cached encoding if available
         # xxs = self.embeddings(xs)
         # mask=xs == self.pad_idx
@@ -690,7 +794,9 @@ class CrossModel(nn.Module):
 
         for i, seed_set in enumerate(seed_sets):
             if seed_set == []:
-                proj_user_representation_list.append(torch.zeros(2 * self.dim).cuda())
+                proj_user_representation_list.append(
+                    torch.zeros(2 * self.dim, device=self.device)
+                )
                 db_con_mask.append(torch.zeros([1]))
                 continue
             
@@ -706,7 +812,7 @@ class CrossModel(nn.Module):
         concept_mask = concept_mask - 64368
         graph_con_emb = word_features[concept_mask]
         con_emb_mask = concept_mask == 0
-        con_user_emb, _ = self.self_attn(graph_con_emb, con_emb_mask.cuda())
+        con_user_emb, _ = self.self_attn(graph_con_emb, con_emb_mask)
         
         user_emb = self.user_norm(torch.cat([con_user_emb, proj_db_user_emb], dim=-1))
         uc_gate = F.sigmoid(self.gate_norm(user_emb))
@@ -731,7 +837,7 @@ class CrossModel(nn.Module):
                 ], dim=0)
                 
             out = (word_item_features[edge_label_index[0]] * word_item_features[edge_label_index[1]]).sum(dim=-1).view(-1)
-            link_prediction_loss = self.link_criterion(out, edge_label.cuda())
+            link_prediction_loss = self.link_criterion(out, edge_label.to(self.device))
             info_con_loss = 0
         else: 
             link_prediction_loss = 0
@@ -739,10 +845,10 @@ class CrossModel(nn.Module):
             
         # entity_scores = F.softmax(entity_scores.cuda(), dim=-1).cuda()
         rec_loss = self.criterion(
-            entity_scores.squeeze(1).squeeze(1).float(), labels.cuda()
+            entity_scores.squeeze(1).squeeze(1).float(), labels.to(self.device)
         )
         # rec_loss=self.klloss(entity_scores.squeeze(1).squeeze(1).float(), labels.float().cuda())
-        rec_loss = torch.sum(rec_loss * rec.float().cuda())
+        rec_loss = torch.sum(rec_loss * rec.float().to(self.device))
         self.user_rep = user_emb
 
         # generation---------------------------------------------------------------------------------------------------
@@ -750,12 +856,12 @@ class CrossModel(nn.Module):
         con_emb4gen = con_nodes_features4gen[concept_mask]
         con_mask4gen = concept_mask != self.concept_padding
         # kg_encoding=self.kg_encoder(con_emb4gen.cuda(),con_mask4gen.cuda())
-        kg_encoding = (self.kg_norm(con_emb4gen), con_mask4gen.cuda())
+        kg_encoding = (self.kg_norm(con_emb4gen), con_mask4gen)
 
         db_emb4gen = entities_features[entity_vector]  # batch*50*dim
         db_mask4gen = entity_vector != 0
         # db_encoding=self.db_encoder(db_emb4gen.cuda(),db_mask4gen.cuda())
-        db_encoding = (self.db_norm(db_emb4gen), db_mask4gen.cuda())
+        db_encoding = (self.db_norm(db_emb4gen), db_mask4gen)
         movie_mask = torch.sum(db_label, dim =-1)
 
         if test == False:
@@ -884,27 +990,34 @@ class CrossModel(nn.Module):
     def compute_loss(self, output, scores):
         score_view = scores.view(-1)
         output_view = output.view(-1, output.size(-1))
-        loss = self.criterion(output_view.cuda(), score_view.cuda())
+        loss = self.criterion(output_view, score_view)
         return loss
 
     def compute_bow_loss(self, concept_label, con_logits_1_hop, word_features, movie_mask):
-        # scores = [bs, seq_length, V]
+        # scores = [bs, seq_length, len(copy_key_ids)]
         scores = torch.sum(con_logits_1_hop, dim =1)
-        #scores = [bs, |V|]
+        #scores = [bs, len(copy_key_ids)]
         # copy_scores = self.w_align(copy_latent)
         #copy_scores = [bs, dim]
         # scores = torch.matmul(copy_scores, word_features.permute(1,0))
         # scores = [bs,n_concept]
-        loss = self.boc_criterion(scores.float().cuda(), concept_label.float().cuda()) * self.mask4key.unsqueeze(0)
-        loss = loss * movie_mask.unsqueeze(1).cuda()
-        loss = torch.mean(loss)
+        concept_label = concept_label.to(self.device)[:, self.copy_key_ids]
+        loss = self.boc_criterion(scores.float(), concept_label.float()) * self.mask4key[self.copy_key_ids].unsqueeze(0)
+        loss = loss * movie_mask.unsqueeze(1).to(self.device)
+        # the tokens outside mask4key contribute zero loss, so average over the
+        # whole vocabulary as before
+        loss = torch.sum(loss) / (loss.size(0) * self.mask4key.size(0))
         return loss
 
-    def save_model(self):
-        torch.save(self.state_dict(), "saved_model/boc_net_parameter1.pkl")
+    def save_model(self, path="saved_model/boc_net_parameter1.pkl", writer=None):
+        """Save the parameters, in the background with an AsyncCheckpointWriter."""
+        if writer is None:
+            atomic_save(self.state_dict(), path)
+        else:
+            writer.save(self.state_dict(), path)
 
-    def load_model(self):
-        self.load_state_dict(torch.load("saved_model/boc_net_parameter1.pkl"))
+    def load_model(self, path="saved_model/boc_net_parameter1.pkl"):
+        self.load_state_dict(torch.load(path, map_location=self.device))
 
     def output(self, tensor):
         # project back to vocabulary
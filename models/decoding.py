@@ -0,0 +1,84 @@
+import torch
+import torch.nn.functional as F
+
+from models.utils import neginf
+
+
+DECODE_METHODS = ("greedy", "sample")
+
+
+def apply_repetition_penalty(logits, prev_tokens, penalty):
+    """
+    Penalize every token that already appears in ``prev_tokens`` (CTRL style).
+
+    :param logits: FloatTensor[bsz, vocab] of step logits.
+    :param prev_tokens: LongTensor[bsz, seqlen] of tokens generated so far.
+    :param float penalty: values > 1 discourage repetition, 1 is a no-op.
+    """
+    if penalty == 1.0:
+        return logits
+    seen = torch.zeros_like(logits, dtype=torch.bool).scatter_(1, prev_tokens, True)
+    penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+    return torch.where(seen, penalized, logits)
+
+
+def filter_top_k_top_p(logits, top_k=0, top_p=1.0):
+    """
+    Mask everything outside the top-k tokens and the nucleus of mass top_p.
+
+    Both filters are computed on the whole ``[bsz, vocab]`` batch at once; a
+    row always keeps at least its best token.
+    """
+    fill = neginf(logits.dtype)
+    if top_k > 0:
+        top_k = min(top_k, logits.size(-1))
+        kth = logits.topk(top_k, dim=-1)[0][:, -1:]
+        logits = logits.masked_fill(logits < kth, fill)
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+        probs = F.softmax(sorted_logits, dim=-1)
+        # drop a token once the mass before it already reaches top_p
+        remove = (probs.cumsum(dim=-1) - probs) >= top_p
+        remove[:, 0] = False
+        remove = remove.scatter(1, sorted_idx, remove)
+        logits = logits.masked_fill(remove, fill)
+    return logits
+
+
+def select_tokens(
+    logits,
+    prev_tokens=None,
+    method="greedy",
+    temperature=1.0,
+    top_k=0,
+    top_p=1.0,
+    repetition_penalty=1.0,
+    allowed=None,
+):
+    """
+    Choose the next token for every row of a decoding step.
+
+    The post-processing (repetition penalty, constraint masking, temperature,
+    top-k and nucleus masking, sampling) runs as one vectorized pass over ``[bsz, vocab]``.
+
+    :param logits: FloatTensor[bsz, vocab], already including the copy logits.
+    :param prev_tokens: LongTensor[bsz, seqlen] of tokens generated so far.
+    :param str method: ``greedy`` or ``sample``.
+    :param allowed: optional BoolTensor broadcastable to ``logits``; tokens
+        where it is False are never chosen.
+
+    :return: LongTensor[bsz] of chosen tokens.
+    """
+    if method not in DECODE_METHODS:
+        raise ValueError(f"Unknown decode method {method}, pick one of {DECODE_METHODS}")
+    if prev_tokens is not None:
+        logits = apply_repetition_penalty(logits, prev_tokens, repetition_penalty)
+    if allowed is not None:
+        logits = logits.masked_fill(~allowed, neginf(logits.dtype))
+    if method == "greedy":
+        return logits.argmax(dim=-1)
+
+    logits = logits.float() / max(temperature, 1e-5)
+    logits = filter_top_k_top_p(logits, top_k, top_p)
+    probs = F.softmax(logits, dim=-1)
+    return torch.multinomial(probs, 1).squeeze(1)
@@ -183,7 +183,7 @@ class SelfAttentionLayer_batch(nn.Module):
         e = torch.matmul(torch.tanh(torch.matmul(h, self.a)), self.b)
         # print(e.size())
         # print(mask.size())
-        attention = F.softmax(e + mask.unsqueeze(-1), dim=1)
+        attention = F.softmax(e + mask.unsqueeze(-1), dim=1, dtype=torch.float)
         # attention = F.dropout(attention, self.dropout, training=self.training)
         return torch.matmul(torch.transpose(attention, 1, 2), h).squeeze(1), attention
 
@@ -343,7 +343,7 @@ class SpGraphAttentionLayer(nn.Module):
         # edge_e: E
 
         e_rowsum = self.special_spmm(
-            edge, edge_e, torch.Size([N, N]), torch.ones(size=(N, 1)).cuda()
+            edge, edge_e, torch.Size([N, N]), torch.ones(size=(N, 1), device=h.device)
         )
         # e_rowsum: N x 1
 
@@ -0,0 +1,698 @@
+"""
+Inference-only copy of CrossModel for serving on CPU.
+
+The serving model reuses the transformer stacks and heads of a trained
+CrossModel but replaces the graph encoders by frozen node feature tables: the
+RGCN and GCN outputs only depend on the weights, so they are computed once at
+export time. Nothing here imports torch_geometric, and :func:`export_onnx` writes the
+model as ONNX graphs that run on ONNX Runtime without PyTorch.
+"""
+import copy
+import inspect
+import io
+import json
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.transformer import _build_encoder, _build_decoder4kg
+
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    from torch.quantization import quantize_dynamic
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+# CrossModel modules that the serving model copies unchanged
+SHARED_MODULES = (
+    "embeddings",
+    "encoder",
+    "decoder",
+    "db_norm",
+    "kg_norm",
+    "db_attn_norm",
+    "kg_attn_norm",
+    "copy_norm",
+    "user_norm",
+    "gate_norm",
+    "self_attn",
+    "en_self_attn",
+)
+
+
+def pad_seed_sets(seed_sets, length, device=None):
+    """
+    Turn CrossModel's list of seed entity lists into padded tensors.
+
+    :return: (seed_ids, seed_mask), LongTensor and BoolTensor [bsz, length].
+    """
+    seed_ids = torch.zeros(len(seed_sets), length, dtype=torch.long)
+    for i, seed_set in enumerate(seed_sets):
+        seed_ids[i, : len(seed_set)] = torch.LongTensor(seed_set)
+    seed_mask = torch.arange(length)[None, :] < torch.LongTensor(
+        [len(seed_set) for seed_set in seed_sets]
+    )[:, None]
+    return seed_ids.to(device), seed_mask.to(device)
+
+
+def model_size(module):
+    """Size in bytes of the serialized state dict of a module."""
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+class NodeTable(nn.Module):
+    """
+    Frozen node features of a graph encoder, looked up by node id.
+
+    With ``quantized`` the rows are stored as int8 with one fp32 scale per
+    row (symmetric quantization), a quarter of the fp32 size, and are
+    dequantized on lookup.
+    """
+
+    def __init__(self, features, quantized=False):
+        super().__init__()
+        self.quantized = quantized
+        features = features.detach().float()
+        if quantized:
+            scale = features.abs().max(dim=-1, keepdim=True)[0].clamp(min=1e-8) / 127
+            self.register_buffer("weight", torch.round(features / scale).to(torch.int8))
+            self.register_buffer("scale", scale)
+        else:
+            self.register_buffer("weight", features)
+            self.register_buffer("scale", torch.ones(0))
+
+    def forward(self, index):
+        rows = self.weight[index]
+        if self.quantized:
+            rows = rows.float() * self.scale[index]
+        return rows
+
+    def dense(self):
+        """The whole table in fp32."""
+        return self(torch.arange(self.weight.size(0), device=self.weight.device))
+
+
+class AttentionPooling(nn.Module):
+    """models.graph.SelfAttentionLayer_batch, without the graph imports."""
+
+    def __init__(self, dim, da):
+        super().__init__()
+        self.a = nn.Parameter(torch.zeros(size=(dim, da)))
+        self.b = nn.Parameter(torch.zeros(size=(da, 1)))
+
+    def forward(self, h, mask):
+        mask = 1e-30 * mask.float()
+        e = torch.matmul(torch.tanh(torch.matmul(h, self.a)), self.b)
+        attention = F.softmax(e + mask.unsqueeze(-1), dim=1, dtype=torch.float)
+        return torch.matmul(torch.transpose(attention, 1, 2), h).squeeze(1)
+
+
+class CrossModelInference(nn.Module):
+    """
+    Recommendation and greedy response generation of a trained CrossModel.
+
+    Build it with :meth:`from_model`; the constructor only lays out the
+    modules. All inputs are padded tensors, see :func:`pad_seed_sets`.
+
+    :param opt: the options CrossModel was trained with.
+    :param dictionary: word2index of the training data.
+    :param copy_mask: FloatTensor[vocab], CrossModel's mask4 copy weights.
+    """
+
+    def __init__(
+        self,
+        opt,
+        dictionary,
+        copy_mask,
+        n_positions=1024,
+        padding_idx=0,
+        start_idx=1,
+        end_idx=2,
+    ):
+        super().__init__()
+        vocab_size = len(dictionary) + 4
+        dim, embedding_size = opt["dim"], opt["embedding_size"]
+        self.NULL_IDX = padding_idx
+        self.START_IDX = start_idx
+        self.END_IDX = end_idx
+
+        self.embeddings = nn.Embedding(vocab_size, embedding_size, padding_idx)
+        self.encoder = _build_encoder(
+            opt,
+            dictionary,
+            self.embeddings,
+            padding_idx,
+            reduction=False,
+            n_positions=n_positions,
+        )
+        self.decoder = _build_decoder4kg(
+            opt, dictionary, self.embeddings, padding_idx, n_positions=n_positions
+        )
+        self.db_norm = nn.Linear(dim, embedding_size)
+        self.kg_norm = nn.Linear(dim, embedding_size)
+        self.db_attn_norm = nn.Linear(dim, embedding_size)
+        self.kg_attn_norm = nn.Linear(dim, embedding_size)
+        self.copy_norm = nn.Linear(embedding_size * 3, embedding_size)
+        self.user_norm = nn.Linear(dim * 2, dim)
+        self.gate_norm = nn.Linear(dim, 1)
+        self.self_attn = AttentionPooling(dim, dim)
+        self.en_self_attn = AttentionPooling(dim, dim)
+
+        # outputs of the RGCN (entities) and GCN (concepts)
+        self.db_nodes = NodeTable(torch.zeros(opt["n_entity"], dim))
+        self.con_nodes = NodeTable(torch.zeros(opt["n_concept"] + 1, dim))
+        # entity scores are F.linear(user_emb, db node features, output_en.bias)
+        self.entity_scorer = nn.Linear(dim, opt["n_entity"])
+        # vocabulary projection, tied to the word embeddings
+        self.output = nn.Linear(embedding_size, vocab_size, bias=False)
+        self.output.weight = self.embeddings.weight
+        # the representation_bias rows of the tokens the copy mask keeps
+        copy_ids = copy_mask.nonzero().view(-1)
+        self.register_buffer("copy_ids", copy_ids)
+        self.register_buffer("copy_weights", copy_mask[copy_ids].float())
+        self.copy_head = nn.Linear(embedding_size, copy_ids.numel())
+
+    @classmethod
+    def from_model(cls, model, opt, dictionary):
+        """Export a trained CrossModel, computing its node tables once."""
+        serving = cls(
+            opt,
+            dictionary,
+            model.mask4.cpu(),
+            n_positions=model.encoder.position_embeddings.num_embeddings,
+            padding_idx=model.pad_idx,
+            start_idx=int(model.START[0]),
+            end_idx=model.END_IDX,
+        )
+        for name in SHARED_MODULES:
+            getattr(serving, name).load_state_dict(getattr(model, name).state_dict())
+
+        was_training = model.training
+        model.eval()
+        with torch.no_grad():
+            db_nodes = model.dbpedia_RGCN(None, model.db_edge_idx, model.db_edge_type)
+            con_nodes = model.concept_GCN(
+                model.concept_embeddings.weight, model.concept_edge_sets
+            )
+            serving.db_nodes = NodeTable(db_nodes.cpu())
+            serving.con_nodes = NodeTable(con_nodes.cpu())
+            serving.entity_scorer.weight.copy_(db_nodes)
+            serving.entity_scorer.bias.copy_(model.output_en.bias)
+            serving.copy_head.weight.copy_(
+                model.representation_bias.weight[model.copy_ids]
+            )
+            serving.copy_head.bias.copy_(model.representation_bias.bias[model.copy_ids])
+        model.train(was_training)
+        return serving.eval()
+
+    def user_representation(self, concept_mask, seed_ids, seed_mask):
+        """
+        Pool the context concepts and mentioned entities into a user vector.
+
+        :param concept_mask: LongTensor[bsz, c_len] of concept ids, 0 for none.
+        :param seed_ids: LongTensor[bsz, c_len] of mentioned entity ids.
+        :param seed_mask: BoolTensor[bsz, c_len], True for real seeds.
+
+        :return: (user_emb, con_user_emb, db_user_emb), each [bsz, dim].
+        """
+        con_emb = self.con_nodes(concept_mask)
+        con_user_emb = self.self_attn(con_emb, concept_mask == 0)
+        db_emb = self.db_nodes(seed_ids) * seed_mask.unsqueeze(-1).float()
+        db_user_emb = self.en_self_attn(db_emb, ~seed_mask)
+
+        user_emb = self.user_norm(torch.cat([con_user_emb, db_user_emb], dim=-1))
+        uc_gate = torch.sigmoid(self.gate_norm(user_emb))
+        user_emb = uc_gate * db_user_emb + (1 - uc_gate) * con_user_emb
+        return user_emb, con_user_emb, db_user_emb
+
+    def recommend(self, concept_mask, seed_ids, seed_mask):
+        """Entity scores FloatTensor[bsz, n_entity] of the recommender."""
+        user_emb, _, _ = self.user_representation(concept_mask, seed_ids, seed_mask)
+        return self.entity_scorer(user_emb)
+
+    def step_logits(self, latent, kg_attn_norm, db_attn_norm):
+        """Vocabulary plus copy logits of decoder outputs latent [bsz, len, dim]."""
+        copy_latent = self.copy_norm(
+            torch.cat(
+                [
+                    kg_attn_norm.expand(-1, latent.size(1), -1),
+                    db_attn_norm.expand(-1, latent.size(1), -1),
+                    latent,
+                ],
+                -1,
+            )
+        )
+        voc_logits = self.output(latent)
+        con_logits = self.copy_head(copy_latent) * self.copy_weights
+        # a scatter_add rather than index_add, which the ONNX exporter lacks
+        return voc_logits.scatter_add(
+            -1, self.copy_ids.expand_as(con_logits), con_logits.type_as(voc_logits)
+        )
+
+    def encode(self, xs, concept_mask, entity_vector, seed_ids, seed_mask):
+        """
+        Everything that runs once per request, ahead of decoding.
+
+        :param xs: LongTensor[bsz, c_len] context tokens.
+        :param entity_vector: LongTensor[bsz, 50] context entity ids, 0 for none.
+
+        :return: tuple of the entity scores [bsz, n_entity], the two copy
+            inputs of :meth:`step_logits` and the decoder memory keys, values
+            and masks (see :meth:`TransformerDecoderKG.memory_state`), flat.
+        """
+        memory = self.decoder.memory_state(
+            self.encode_context(xs), *self.graph_memory(concept_mask, entity_vector)
+        )
+        return (
+            self.user_state(concept_mask, seed_ids, seed_mask)
+            + memory[0]
+            + memory[1]
+            + memory[2]
+        )
+
+    def user_state(self, concept_mask, seed_ids, seed_mask):
+        """
+        Entity scores and the user representation inputs of the copy head.
+
+        :return: (entity_scores [bsz, n_entity], kg_attn_norm [bsz, 1, emb],
+            db_attn_norm [bsz, 1, emb])
+        """
+        user_emb, con_user_emb, db_user_emb = self.user_representation(
+            concept_mask, seed_ids, seed_mask
+        )
+        return (
+            self.entity_scorer(user_emb),
+            self.kg_attn_norm(con_user_emb).unsqueeze(1),
+            self.db_attn_norm(db_user_emb).unsqueeze(1),
+        )
+
+    def encode_context(self, xs):
+        """The context encoding [bsz, c_len, emb] and its mask [bsz, c_len]."""
+        if self.encoder.attention == "hierarchical":
+            return self.encoder(xs)
+        # the untrimmed encoding keeps the shapes independent of the data
+        return self.encoder._encode(xs)
+
+    def graph_memory(self, concept_mask, entity_vector):
+        """The concept and entity memories of the decoder, with their masks."""
+        kg_states = (self.kg_norm(self.con_nodes(concept_mask)), concept_mask != 0)
+        db_states = (self.db_norm(self.db_nodes(entity_vector)), entity_vector != 0)
+        return kg_states, db_states
+
+    def decode_step(self, tokens, position, self_k, self_v, kg_attn_norm, db_attn_norm, *memory):
+        """
+        Logits of the next tokens, given the tokens at ``position``.
+
+        :param tokens: LongTensor[bsz] tokens at ``position``.
+        :param position: 0-dim LongTensor.
+        :param self_k, self_v: self attention caches, see
+            :meth:`TransformerDecoderKG.step`.
+        :param memory: the nine decoder memory tensors of :meth:`encode`.
+
+        :return: (logits [bsz, vocab], self_k, self_v)
+        """
+        latent, self_k, self_v = self.decoder.step(
+            tokens, position, self_k, self_v, (memory[0:3], memory[3:6], memory[6:9])
+        )
+        logits = self.step_logits(latent, kg_attn_norm, db_attn_norm)
+        return logits.squeeze(1), self_k, self_v
+
+    def generate(self, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen=20):
+        """Recommend and greedily decode a response, see :func:`generate`."""
+        return generate(self, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen)
+
+
+def generate(
+    model, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen=20, stop=True
+):
+    """
+    Recommend and greedily decode a response, like CrossModel at test time.
+
+    Works on a :class:`CrossModelInference` as well as on its traced or
+    compiled versions (see :func:`trace`, :func:`compile_serving`): only
+    ``encode`` and ``decode_step`` are called, the loop stays in Python.
+
+    :param bool stop: return as soon as every row produced the end token.
+        Traced or compiled models run fastest with ``stop=False``, which
+        keeps the loop free of host synchronization.
+
+    :return: (preds, entity_scores), preds is LongTensor[bsz, steps + 1]
+        starting with the start token, NULL_IDX after the end token.
+    """
+    encoded = model.encode(xs, concept_mask, entity_vector, seed_ids, seed_mask)
+    entity_scores, kg_attn_norm, db_attn_norm = encoded[:3]
+    memory = encoded[3:]
+    # [n_layers, bsz, n_heads, maxlen, dim_per_head], like the memory keys
+    n_layers, bsz, n_heads, _, dim_per_head = memory[0].size()
+    self_k = memory[0].new_zeros(n_layers, bsz, n_heads, maxlen, dim_per_head)
+    self_v = torch.zeros_like(self_k)
+
+    preds = [xs.new_full((bsz,), model.START_IDX)]
+    finished = torch.zeros(bsz, dtype=torch.bool, device=xs.device)
+    positions = torch.arange(maxlen, device=xs.device)
+    for i in range(maxlen):
+        logits, self_k, self_v = model.decode_step(
+            preds[-1], positions[i], self_k, self_v, kg_attn_norm, db_attn_norm, *memory
+        )
+        tokens = logits.argmax(dim=-1).masked_fill(finished, model.NULL_IDX)
+        preds.append(tokens)
+        finished = finished | (tokens == model.END_IDX)
+        if stop and finished.all():
+            break
+    return torch.stack(preds, dim=1), entity_scores
+
+
+def _example_inputs(serving, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen):
+    """Example inputs of encode and decode_step, for tracing."""
+    encode_inputs = (xs, concept_mask, entity_vector, seed_ids, seed_mask)
+    with torch.no_grad():
+        encoded = serving.encode(*encode_inputs)
+    n_layers, bsz, n_heads, _, dim_per_head = encoded[3].size()
+    self_k = encoded[3].new_zeros(n_layers, bsz, n_heads, maxlen, dim_per_head)
+    step_inputs = (
+        xs.new_full((bsz,), serving.START_IDX),
+        torch.tensor(0, device=xs.device),
+        self_k,
+        torch.zeros_like(self_k),
+    ) + encoded[1:]
+    return encode_inputs, step_inputs
+
+
+def trace(serving, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen=20):
+    """
+    TorchScript ``encode`` and ``decode_step`` of a serving model.
+
+    The example inputs fix nothing but the code path: the traced graphs run
+    on any batch size, context length and ``maxlen``. The result can be
+    saved with ``torch.jit.save`` and served without the model code.
+    """
+    if serving.encoder.attention != "full":
+        raise ValueError(
+            f"Only full encoder attention can be traced, not {serving.encoder.attention}"
+        )
+    serving = serving.eval()
+    encode_inputs, step_inputs = _example_inputs(
+        serving, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen
+    )
+    with torch.no_grad():
+        traced = torch.jit.trace_module(
+            serving,
+            {"encode": encode_inputs, "decode_step": step_inputs},
+            check_trace=False,
+        )
+    # generate reads the special tokens from the model
+    traced.START_IDX = serving.START_IDX
+    traced.NULL_IDX = serving.NULL_IDX
+    traced.END_IDX = serving.END_IDX
+    return traced
+
+
+def compile_serving(serving, **kwargs):
+    """
+    ``torch.compile`` the ``encode`` and ``decode_step`` of a serving model.
+
+    Compilation happens on the first call of each; the fixed size decoder
+    caches mean the step is compiled once rather than once per position.
+    kwargs go to ``torch.compile``.
+    """
+    if serving.encoder.attention != "full":
+        raise ValueError(
+            f"Only full encoder attention can be compiled, not {serving.encoder.attention}"
+        )
+    serving = serving.eval()
+    serving.encode = torch.compile(serving.encode, **kwargs)
+    serving.decode_step = torch.compile(serving.decode_step, **kwargs)
+    return serving
+
+
+def quantize(serving):
+    """
+    Dynamic int8 copy of a serving model for CPU inference.
+
+    Every nn.Linear (attention projections, FFNs, the norms, the copy, vocab
+    and entity heads) keeps int8 weights and quantizes its activations on
+    the fly, and the node tables are stored as int8 rows.
+    """
+    quantized = copy.deepcopy(serving).cpu().eval()
+    quantized.db_nodes = NodeTable(serving.db_nodes.dense().cpu(), quantized=True)
+    quantized.con_nodes = NodeTable(serving.con_nodes.dense().cpu(), quantized=True)
+    return quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+
+
+def export_quantized(model, opt, dictionary, path):
+    """Write the int8 serving model of a trained CrossModel to path."""
+    quantized = quantize(CrossModelInference.from_model(model, opt, dictionary))
+    torch.save(quantized, path)
+    return quantized
+
+
+# names of the nine decoder memory tensors of CrossModelInference.encode
+MEMORY_NAMES = tuple(
+    f"{memory}_{tensor}"
+    for memory in ("encoder", "kg", "db")
+    for tensor in ("keys", "values", "attn_mask")
+)
+
+# graph name -> (input names, output names); every graph is one method call
+# of CrossModelInference, see _OnnxGraph
+ONNX_GRAPHS = {
+    "encoder": (("xs",), ("encoder_output", "encoder_mask")),
+    "recommender": (
+        ("concept_mask", "entity_vector", "seed_ids", "seed_mask"),
+        (
+            "entity_scores",
+            "kg_attn_norm",
+            "db_attn_norm",
+            "kg_memory",
+            "kg_mask",
+            "db_memory",
+            "db_mask",
+        ),
+    ),
+    "decoder_memory": (
+        ("encoder_output", "encoder_mask", "kg_memory", "kg_mask", "db_memory", "db_mask"),
+        MEMORY_NAMES,
+    ),
+    "decoder_step": (
+        ("tokens", "position", "self_keys", "self_values", "kg_attn_norm", "db_attn_norm")
+        + MEMORY_NAMES,
+        ("logits", "new_self_keys", "new_self_values"),
+    ),
+}
+
+# symbolic sizes of every tensor, by name
+ONNX_AXES = {
+    "xs": {0: "bsz", 1: "c_len"},
+    "encoder_output": {0: "bsz", 1: "c_len"},
+    "encoder_mask": {0: "bsz", 1: "c_len"},
+    "concept_mask": {0: "bsz", 1: "c_len"},
+    "entity_vector": {0: "bsz", 1: "n_context_entities"},
+    "seed_ids": {0: "bsz", 1: "c_len"},
+    "seed_mask": {0: "bsz", 1: "c_len"},
+    "entity_scores": {0: "bsz"},
+    "kg_attn_norm": {0: "bsz"},
+    "db_attn_norm": {0: "bsz"},
+    "kg_memory": {0: "bsz", 1: "c_len"},
+    "kg_mask": {0: "bsz", 1: "c_len"},
+    "db_memory": {0: "bsz", 1: "n_context_entities"},
+    "db_mask": {0: "bsz", 1: "n_context_entities"},
+    "encoder_keys": {1: "bsz", 3: "c_len"},
+    "encoder_values": {1: "bsz", 3: "c_len"},
+    "encoder_attn_mask": {0: "bsz", 3: "c_len"},
+    "kg_keys": {1: "bsz", 3: "c_len"},
+    "kg_values": {1: "bsz", 3: "c_len"},
+    "kg_attn_mask": {0: "bsz", 3: "c_len"},
+    "db_keys": {1: "bsz", 3: "n_context_entities"},
+    "db_values": {1: "bsz", 3: "n_context_entities"},
+    "db_attn_mask": {0: "bsz", 3: "n_context_entities"},
+    "tokens": {0: "bsz"},
+    "self_keys": {1: "bsz", 3: "max_len"},
+    "self_values": {1: "bsz", 3: "max_len"},
+    "new_self_keys": {1: "bsz", 3: "max_len"},
+    "new_self_values": {1: "bsz", 3: "max_len"},
+    "logits": {0: "bsz"},
+}
+
+# the TorchScript based exporter takes dynamic_axes, newer torch defaults to
+# the torch.export based one
+_ONNX_EXPORT_KWARGS = (
+    {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+)
+
+
+class _OnnxGraph(nn.Module):
+    """One of the ONNX_GRAPHS of a serving model, as a module to export."""
+
+    def __init__(self, serving, name):
+        super().__init__()
+        self.serving = serving
+        self.name = name
+
+    def forward(self, *inputs):
+        serving = self.serving
+        if self.name == "encoder":
+            return serving.encode_context(*inputs)
+        if self.name == "recommender":
+            concept_mask, entity_vector, seed_ids, seed_mask = inputs
+            kg_states, db_states = serving.graph_memory(concept_mask, entity_vector)
+            return serving.user_state(concept_mask, seed_ids, seed_mask) + kg_states + db_states
+        if self.name == "decoder_memory":
+            memory = serving.decoder.memory_state(inputs[0:2], inputs[2:4], inputs[4:6])
+            return memory[0] + memory[1] + memory[2]
+        return serving.decode_step(*inputs)
+
+
+def export_onnx(
+    serving, directory, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen=20, opset=17
+):
+    """
+    Write a serving model as ONNX graphs, see ONNX_GRAPHS.
+
+    ``encoder`` is the TransformerEncoder, ``recommender`` the user
+    representation and entity scoring, with the node tables as initializers,
+    ``decoder_memory`` the per-layer keys and values of the decoder memories
+    and ``decoder_step`` one TransformerDecoderKG step over a key/value cache.
+    Batch size, context length and ``maxlen`` stay dynamic. serving.json
+    holds the special tokens. Load the directory with :class:`OnnxServing`.
+
+    The example request only needs the right dtypes and ranks.
+    """
+    if serving.encoder.attention != "full":
+        raise ValueError(
+            f"Only full encoder attention can be exported, not {serving.encoder.attention}"
+        )
+    serving = serving.eval()
+    os.makedirs(directory, exist_ok=True)
+    with torch.no_grad():
+        encoder_states = serving.encode_context(xs)
+        kg_states, db_states = serving.graph_memory(concept_mask, entity_vector)
+        _, step_inputs = _example_inputs(
+            serving, xs, concept_mask, entity_vector, seed_ids, seed_mask, maxlen
+        )
+    example_inputs = {
+        "encoder": (xs,),
+        "recommender": (concept_mask, entity_vector, seed_ids, seed_mask),
+        "decoder_memory": encoder_states + kg_states + db_states,
+        "decoder_step": step_inputs,
+    }
+    for name, (input_names, output_names) in ONNX_GRAPHS.items():
+        with torch.no_grad():
+            torch.onnx.export(
+                _OnnxGraph(serving, name),
+                example_inputs[name],
+                os.path.join(directory, f"{name}.onnx"),
+                input_names=list(input_names),
+                output_names=list(output_names),
+                dynamic_axes={
+                    tensor: ONNX_AXES[tensor]
+                    for tensor in input_names + output_names
+                    if tensor in ONNX_AXES
+                },
+                opset_version=opset,
+                **_ONNX_EXPORT_KWARGS,
+            )
+    with open(os.path.join(directory, "serving.json"), "w") as f:
+        json.dump(
+            {
+                "START_IDX": serving.START_IDX,
+                "NULL_IDX": serving.NULL_IDX,
+                "END_IDX": serving.END_IDX,
+            },
+            f,
+        )
+
+
+class OnnxServing(object):
+    """
+    The graphs of :func:`export_onnx`, run by ONNX Runtime.
+
+    Offers the ``encode`` / ``decode_step`` interface of CrossModelInference
+    on torch tensors (zero copy from and to numpy), so :func:`generate` and
+    the parity checks run unchanged. A server without PyTorch feeds the
+    sessions numpy arrays with the same names.
+
+    :param int threads: intra op threads of every session, 0 lets ONNX
+        Runtime decide.
+    """
+
+    def __init__(self, directory, threads=0, providers=("CPUExecutionProvider",)):
+        if onnxruntime is None:
+            raise ImportError("OnnxServing needs onnxruntime: pip install onnxruntime")
+        with open(os.path.join(directory, "serving.json")) as f:
+            self.__dict__.update(json.load(f))
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.sessions = {
+            name: onnxruntime.InferenceSession(
+                os.path.join(directory, f"{name}.onnx"), options, providers=list(providers)
+            )
+            for name in ONNX_GRAPHS
+        }
+
+    def run(self, name, *inputs):
+        """Run graph ``name`` on torch tensors, in the order of ONNX_GRAPHS."""
+        session = self.sessions[name]
+        # the exporter drops inputs the graph does not depend on
+        used = {node.name for node in session.get_inputs()}
+        feed = {
+            input_name: tensor.numpy()
+            for input_name, tensor in zip(ONNX_GRAPHS[name][0], inputs)
+            if input_name in used
+        }
+        return tuple(torch.from_numpy(output) for output in session.run(None, feed))
+
+    def encode(self, xs, concept_mask, entity_vector, seed_ids, seed_mask):
+        """See CrossModelInference.encode."""
+        encoder_states = self.run("encoder", xs)
+        recommender = self.run("recommender", concept_mask, entity_vector, seed_ids, seed_mask)
+        memory = self.run("decoder_memory", *(encoder_states + recommender[3:]))
+        return recommender[:3] + memory
+
+    def decode_step(self, tokens, position, self_k, self_v, kg_attn_norm, db_attn_norm, *memory):
+        """See CrossModelInference.decode_step."""
+        return self.run(
+            "decoder_step", tokens, position, self_k, self_v, kg_attn_norm, db_attn_norm, *memory
+        )
+
+
+def check_parity(reference, candidate, batches, maxlen=20):
+    """
+    Compare the outputs of two serving models over padded batches.
+
+    :param batches: iterable of (xs, concept_mask, entity_vector, seed_ids,
+        seed_mask) tuples, e.g. the test split.
+
+    :return: dict with the largest entity score and first step logit
+        differences and the fraction of identical responses.
+    """
+    score_diff = logit_diff = 0.0
+    same = total = 0
+    with torch.no_grad():
+        for batch in batches:
+            ref_preds, ref_scores = generate(reference, *batch, maxlen=maxlen, stop=False)
+            preds, scores = generate(candidate, *batch, maxlen=maxlen, stop=False)
+            score_diff = max(score_diff, (scores - ref_scores).abs().max().item())
+            # the first step sees the same input, later ones may diverge
+            ref_encoded = reference.encode(*batch)
+            encoded = candidate.encode(*batch)
+            _, step_inputs = _example_inputs(reference, *batch, maxlen)
+            ref_logits = reference.decode_step(*step_inputs[:4], *ref_encoded[1:])[0]
+            logits = candidate.decode_step(*step_inputs[:4], *encoded[1:])[0]
+            logit_diff = max(logit_diff, (logits - ref_logits).abs().max().item())
+            same += (preds == ref_preds).all(dim=1).sum().item()
+            total += preds.size(0)
+    return {
+        "entity_score_diff": score_diff,
+        "logit_diff": logit_diff,
+        "same_response": same / max(total, 1),
+    }
+
@@ -5,6 +5,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 import os
 import math
@@ -15,6 +16,23 @@ import numpy as np
 from models.utils import neginf
 
 
+# torch >= 2.0 ships fused (flash / memory efficient) attention kernels
+_HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
+
+def _run_layer(layer, checkpoint, *args):
+    """
+    Call ``layer(*args)``, with activation checkpointing if ``checkpoint``.
+
+    A checkpointed layer keeps only its inputs for backward and recomputes
+    its activations there, trading compute for memory. It only applies when
+    gradients are being recorded.
+    """
+    if checkpoint and layer.training and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(layer, *args, use_reentrant=False)
+    return layer(*args)
+
+
 def _normalize(tensor, norm_layer):
     """Broadcast layer norm"""
     size = tensor.size()
@@ -39,6 +57,13 @@ def _build_encoder(
         embeddings_scale=opt["embeddings_scale"],
         reduction=reduction,
         n_positions=n_positions,
+        length_buckets=opt.get("encoder_length_buckets", 0),
+        attention=opt.get("encoder_attention", "full"),
+        split_idx=dictionary.get("_split_"),
+        cache_size=opt.get("encoder_cache_size", 0),
+        window_size=opt.get("encoder_window_size", 64),
+        checkpoint_activations=opt.get("checkpoint_activations", "none")
+        in ("encoder", "all"),
     )
 
 
@@ -115,6 +140,8 @@ def _build_decoder4kg(
         learn_positional_embeddings=opt.get("learn_positional_embeddings", False),
         embeddings_scale=opt["embeddings_scale"],
         n_positions=n_positions,
+        checkpoint_activations=opt.get("checkpoint_activations", "none")
+        in ("decoder", "all"),
     )
 
 
@@ -174,6 +201,33 @@ class MultiHeadAttention(nn.Module):
         self.out_lin = nn.Linear(dim, dim)
 
         nn.init.xavier_normal_(self.out_lin.weight)
+        # dispatch to torch's fused attention kernels when they are available
+        self.use_sdpa = True
+
+    def _project(self, query, key, value):
+        """
+        Project query, key and value with as few matmuls as possible.
+
+        Self attention runs a single fused QKV projection, attention over a
+        shared memory (``value`` omitted or identical to ``key``) a fused KV
+        projection. The weights stay in the separate q_lin / k_lin / v_lin
+        modules so existing checkpoints load unchanged. Modules swapped for
+        quantized ones (see models/inference.py) are called one by one.
+        """
+        if not isinstance(self.q_lin, nn.Linear):
+            key = query if key is None else key
+            value = key if value is None else value
+            return self.q_lin(query), self.k_lin(key), self.v_lin(value)
+        if key is None and value is None:
+            weight = torch.cat([self.q_lin.weight, self.k_lin.weight, self.v_lin.weight])
+            bias = torch.cat([self.q_lin.bias, self.k_lin.bias, self.v_lin.bias])
+            return F.linear(query, weight, bias).chunk(3, dim=-1)
+        if value is None or value is key:
+            weight = torch.cat([self.k_lin.weight, self.v_lin.weight])
+            bias = torch.cat([self.k_lin.bias, self.v_lin.bias])
+            k, v = F.linear(key, weight, bias).chunk(2, dim=-1)
+            return self.q_lin(query), k, v
+        return self.q_lin(query), self.k_lin(key), self.v_lin(value)
 
     def forward(self, query, key=None, value=None, mask=None):
         # Input is [B, query_len, dim]
@@ -185,53 +239,24 @@ class MultiHeadAttention(nn.Module):
         assert mask is not None, "Mask is None, please specify a mask"
         n_heads = self.n_heads
         dim_per_head = dim // n_heads
-        scale = math.sqrt(dim_per_head)
 
         def prepare_head(tensor):
             # input is [batch_size, seq_len, n_heads * dim_per_head]
-            # output is [batch_size * n_heads, seq_len, dim_per_head]
-            bsz, seq_len, _ = tensor.size()
-            tensor = tensor.view(batch_size, tensor.size(1), n_heads, dim_per_head)
-            tensor = (
-                tensor.transpose(1, 2)
-                .contiguous()
-                .view(batch_size * n_heads, seq_len, dim_per_head)
-            )
-            return tensor
+            # output is [batch_size, n_heads, seq_len, dim_per_head]
+            return tensor.view(batch_size, -1, n_heads, dim_per_head).transpose(1, 2)
 
-        # q, k, v are the transformed values
-        if key is None and value is None:
-            # self attention
-            key = value = query
-        elif value is None:
-            # key and value are the same, but query differs
-            # self attention
-            value = key
-        _, key_len, dim = key.size()
-
-        q = prepare_head(self.q_lin(query))
-        k = prepare_head(self.k_lin(key))
-        v = prepare_head(self.v_lin(value))
-
-        dot_prod = q.div_(scale).bmm(k.transpose(1, 2))
-        # [B * n_heads, query_len, key_len]
-        attn_mask = (
-            (mask == 0)
-            .view(batch_size, 1, -1, key_len)
-            .repeat(1, n_heads, 1, 1)
-            .expand(batch_size, n_heads, query_len, key_len)
-            .view(batch_size * n_heads, query_len, key_len)
-        )
-        assert attn_mask.shape == dot_prod.shape
-        dot_prod.masked_fill_(attn_mask, neginf(dot_prod.dtype))
+        q, k, v = self._project(query, key, value)
+        q = prepare_head(q)
+        k = prepare_head(k)
+        v = prepare_head(v)
+        key_len = k.size(2)
 
-        attn_weights = F.softmax(dot_prod, dim=-1).type_as(query)
-        attn_weights = self.attn_dropout(attn_weights)  # --attention-dropout
+        # [B, 1, 1 or query_len, key_len], broadcast over heads (and queries)
+        # instead of materializing a [B * n_heads, query_len, key_len] mask.
+        attentioned = self._attend(q, k, v, mask.view(batch_size, 1, -1, key_len))
 
-        attentioned = attn_weights.bmm(v)
         attentioned = (
             attentioned.type_as(query)
-            .view(batch_size, n_heads, query_len, dim_per_head)
             .transpose(1, 2)
             .contiguous()
             .view(batch_size, query_len, dim)
@@ -241,6 +266,207 @@ class MultiHeadAttention(nn.Module):
 
         return out
 
+    def _attend(self, q, k, v, mask):
+        """
+        Attention of the heads q over the heads k, v.
+
+        :param q, k, v: FloatTensor[B, n_heads, len, dim_per_head]
+        :param mask: BoolTensor broadcastable to [B, n_heads, query_len,
+            key_len], True for the keys to attend to.
+
+        :return: FloatTensor[B, n_heads, query_len, dim_per_head]
+        """
+        # Masked keys get a large finite penalty rather than -inf, so a row
+        # without any valid key still attends uniformly as it always did.
+        attn_mask = torch.zeros(
+            mask.size(), dtype=q.dtype, device=q.device
+        ).masked_fill_(mask == 0, neginf(q.dtype))
+        if self.use_sdpa and _HAS_SDPA:
+            return F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=attn_mask,
+                dropout_p=self.attn_dropout.p if self.training else 0.0,
+            )
+        return self._attention_math(q, k, v, attn_mask)
+
+    def _split_heads(self, tensor):
+        # [B, len, dim] -> [B, n_heads, len, dim_per_head]
+        return tensor.view(
+            tensor.size(0), -1, self.n_heads, self.dim // self.n_heads
+        ).transpose(1, 2)
+
+    def _merge_heads(self, tensor):
+        # [B, n_heads, len, dim_per_head] -> [B, len, dim]
+        return tensor.transpose(1, 2).reshape(tensor.size(0), -1, self.dim)
+
+    def project_memory(self, memory):
+        """
+        Keys and values of a memory that stays fixed while decoding.
+
+        :param memory: FloatTensor[B, mem_len, dim]
+        :return: (k, v), FloatTensor[B, n_heads, mem_len, dim_per_head]
+        """
+        if isinstance(self.k_lin, nn.Linear):
+            weight = torch.cat([self.k_lin.weight, self.v_lin.weight])
+            bias = torch.cat([self.k_lin.bias, self.v_lin.bias])
+            k, v = F.linear(memory, weight, bias).chunk(2, dim=-1)
+        else:
+            k, v = self.k_lin(memory), self.v_lin(memory)
+        return self._split_heads(k), self._split_heads(v)
+
+    def forward_memory(self, query, k, v, mask):
+        """
+        Attention over keys and values from :meth:`project_memory`.
+
+        :param query: FloatTensor[B, query_len, dim]
+        :param mask: BoolTensor[B, 1, 1, mem_len], True for real memory slots.
+        """
+        q = self._split_heads(self.q_lin(query))
+        attentioned = self._attend(q, k, v, mask).type_as(query)
+        return self.out_lin(self._merge_heads(attentioned))
+
+    def forward_step(self, query, cache_k, cache_v, write, mask):
+        """
+        Self attention of one new position over a fixed size key/value cache.
+
+        The cache has a slot for every position to decode. The keys and values
+        of the new position are written to the slot flagged in ``write``, and
+        ``mask`` hides the slots of the positions not decoded yet, so every
+        step runs on the same shapes.
+
+        :param query: FloatTensor[B, 1, dim]
+        :param cache_k, cache_v: FloatTensor[B, n_heads, max_len, dim_per_head]
+        :param write: BoolTensor[1, 1, max_len, 1], True at the new position.
+        :param mask: BoolTensor[1, 1, 1, max_len], True up to the new position.
+
+        :return: (output, cache_k, cache_v), with the updated caches.
+        """
+        q, k, v = self._project(query, None, None)
+        cache_k = torch.where(write, self._split_heads(k), cache_k)
+        cache_v = torch.where(write, self._split_heads(v), cache_v)
+        attentioned = self._attend(self._split_heads(q), cache_k, cache_v, mask)
+        return (
+            self.out_lin(self._merge_heads(attentioned.type_as(query))),
+            cache_k,
+            cache_v,
+        )
+
+    def forward_windowed(self, query, mask, window, global_mask=None):
+        """
+        Self attention restricted to a band of ``window`` tokens on each side.
+
+        Queries are processed in chunks of ``window`` that only look at their
+        own and the two neighbouring chunks, so memory and compute grow
+        linearly with the sequence length. Tokens flagged in ``global_mask``
+        attend to, and are attended by, every token of the sequence.
+
+        :param query: FloatTensor[B, seq_len, dim]
+        :param mask: BoolTensor[B, seq_len], True for real tokens.
+        :param int window: number of neighbours seen on each side.
+        :param global_mask: optional BoolTensor[B, seq_len] of global tokens.
+        """
+        batch_size, seq_len, dim = query.size()
+        n_heads = self.n_heads
+        dim_per_head = dim // n_heads
+        mask = mask.bool()
+        if global_mask is None:
+            global_mask = torch.zeros_like(mask)
+        global_mask = global_mask & mask
+        fill = neginf(query.dtype)
+
+        def prepare_head(tensor):
+            # [B, seq_len, dim] -> [B, n_heads, seq_len, dim_per_head]
+            return tensor.view(batch_size, seq_len, n_heads, dim_per_head).transpose(1, 2)
+
+        q, k, v = self._project(query, None, None)
+        q = prepare_head(q) / math.sqrt(dim_per_head)
+        k = prepare_head(k)
+        v = prepare_head(v)
+
+        # chunk the queries, every chunk sees the 3 * window keys around it
+        n_chunks = -(-seq_len // window)
+        pad = n_chunks * window - seq_len
+        chunked_q = F.pad(q, (0, 0, 0, pad)).view(
+            batch_size, n_heads, n_chunks, window, dim_per_head
+        )
+        # [B, n_heads, n_chunks, dim_per_head, 3 * window]
+        chunked_k = F.pad(k, (0, 0, window, pad + window)).unfold(2, 3 * window, window)
+        chunked_v = F.pad(v, (0, 0, window, pad + window)).unfold(2, 3 * window, window)
+        local_scores = torch.matmul(chunked_q, chunked_k)
+        # global tokens are reached through the global keys below instead
+        local_keys = F.pad(mask & ~global_mask, (window, pad + window))
+        local_keys = local_keys.unfold(1, 3 * window, window)
+        distance = (
+            torch.arange(3 * window, device=query.device)[None, :]
+            - window
+            - torch.arange(window, device=query.device)[:, None]
+        )
+        band = distance.abs() <= window
+        local_mask = local_keys[:, None, :, None, :] & band
+        local_scores = local_scores.masked_fill(~local_mask, fill)
+
+        n_global = int(global_mask.sum(dim=1).max()) if global_mask.any() else 0
+        if n_global > 0:
+            # positions of the global tokens first, in their original order
+            order = global_mask.long().argsort(dim=1, descending=True, stable=True)
+            order = order[:, :n_global]
+            is_global = global_mask.gather(1, order)
+            head_order = order[:, None, :, None].expand(-1, n_heads, -1, dim_per_head)
+            global_k = k.gather(2, head_order)
+            global_v = v.gather(2, head_order)
+            global_scores = torch.matmul(chunked_q, global_k[:, :, None].transpose(-1, -2))
+            global_scores = global_scores.masked_fill(
+                ~is_global[:, None, None, None, :], fill
+            )
+            scores = torch.cat([local_scores, global_scores], dim=-1)
+        else:
+            scores = local_scores
+
+        attn_weights = F.softmax(scores, dim=-1, dtype=torch.float).type_as(q)
+        attn_weights = self.attn_dropout(attn_weights)  # --attention-dropout
+        attentioned = torch.matmul(
+            attn_weights[..., : 3 * window], chunked_v.transpose(-1, -2)
+        )
+        if n_global > 0:
+            attentioned = attentioned + torch.matmul(
+                attn_weights[..., 3 * window :], global_v[:, :, None]
+            )
+        attentioned = attentioned.view(batch_size, n_heads, -1, dim_per_head)
+        attentioned = attentioned[:, :, :seq_len]
+
+        if n_global > 0:
+            # the global tokens themselves attend over the whole sequence
+            global_q = q.gather(2, head_order)
+            global_scores = torch.matmul(global_q, k.transpose(-1, -2))
+            global_scores = global_scores.masked_fill(~mask[:, None, None, :], fill)
+            global_weights = F.softmax(global_scores, dim=-1, dtype=torch.float).type_as(q)
+            global_weights = self.attn_dropout(global_weights)
+            global_out = torch.matmul(global_weights, v)
+            attentioned = torch.where(
+                global_mask[:, None, :, None],
+                attentioned.scatter(2, head_order, global_out),
+                attentioned,
+            )
+
+        attentioned = (
+            attentioned.type_as(query)
+            .transpose(1, 2)
+            .contiguous()
+            .view(batch_size, seq_len, dim)
+        )
+        return self.out_lin(attentioned)
+
+    def _attention_math(self, q, k, v, attn_mask):
+        """Reference attention, used when scaled_dot_product_attention is missing."""
+        scale = math.sqrt(q.size(-1))
+        dot_prod = torch.matmul(q / scale, k.transpose(-1, -2)) + attn_mask
+        # [B, n_heads, query_len, key_len]
+        attn_weights = F.softmax(dot_prod, dim=-1, dtype=torch.float).type_as(q)
+        attn_weights = self.attn_dropout(attn_weights)  # --attention-dropout
+        return torch.matmul(attn_weights, v)
+
 
 class TransformerFFN(nn.Module):
     def __init__(self, dim, dim_hidden, relu_dropout=0):
@@ -405,8 +631,12 @@ class TransformerEncoderLayer(nn.Module):
         self.norm2 = nn.LayerNorm(embedding_size)
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, tensor, mask):
-        tensor = tensor + self.dropout(self.attention(tensor, mask=mask))
+    def forward(self, tensor, mask, window=0, global_mask=None):
+        if window > 0:
+            attended = self.attention.forward_windowed(tensor, mask, window, global_mask)
+        else:
+            attended = self.attention(tensor, mask=mask)
+        tensor = tensor + self.dropout(attended)
         tensor = _normalize(tensor, self.norm1)
         tensor = tensor + self.dropout(self.ffn(tensor))
         tensor = _normalize(tensor, self.norm2)
@@ -439,6 +669,25 @@ class TransformerEncoder(nn.Module):
     :param bool reduction: If true, returns the mean vector for the entire encoding
         sequence.
     :param int n_positions: Size of the position embeddings matrix.
+    :param int length_buckets: 0 runs every layer over the full padded input.
+        1 trims the batch to its longest real sequence, larger values sort the
+        rows by length and encode that many buckets, each trimmed to its own
+        longest sequence. The output is padded back to the batch maximum.
+    :param str attention: ``full`` attends over the whole context,
+        ``hierarchical`` encodes every utterance on its own, with positions
+        restarting at each utterance. The ``_split_`` and end tokens closing
+        the utterances are encoded as one token segments, so an utterance
+        encodes the same whether it is the last one of a context or not.
+        ``window`` restricts every token to its ``window_size`` neighbours on
+        each side, with the ``_split_`` tokens as global tokens that see and
+        are seen by the whole context, so the cost is linear in its length.
+    :param int split_idx: index of the ``_split_`` token between utterances.
+    :param int end_idx: index of the end token closing the context.
+    :param int cache_size: in hierarchical mode, the number of utterance
+        encodings kept for reuse at eval time. 0 disables the cache.
+    :param int window_size: number of neighbours seen in window mode.
+    :param bool checkpoint_activations: recompute the activations of every
+        layer in backward instead of storing them.
     """
 
     def __init__(
@@ -457,6 +706,13 @@ class TransformerEncoder(nn.Module):
         embeddings_scale=False,
         reduction=True,
         n_positions=1024,
+        length_buckets=0,
+        attention="full",
+        split_idx=None,
+        end_idx=2,
+        cache_size=0,
+        window_size=64,
+        checkpoint_activations=False,
     ):
         super(TransformerEncoder, self).__init__()
 
@@ -468,6 +724,22 @@ class TransformerEncoder(nn.Module):
         self.embeddings_scale = embeddings_scale
         self.reduction = reduction
         self.padding_idx = padding_idx
+        self.length_buckets = length_buckets
+        self.attention = attention
+        self.split_idx = split_idx
+        self.end_idx = end_idx
+        self.window_size = window_size
+        self.checkpoint_activations = checkpoint_activations
+        assert attention in (
+            "full",
+            "hierarchical",
+            "window",
+        ), f"Unknown attention {attention}"
+        assert (
+            attention != "hierarchical" or split_idx is not None
+        ), "Hierarchical encoding needs the index of the _split_ token"
+        # utterance token ids -> [utterance_len, dim] encoding, in LRU order
+        self.utterance_cache = UtteranceCache(cache_size) if cache_size > 0 else None
         # this is --dropout, not --relu-dropout or --attention-dropout
         self.dropout = nn.Dropout(p=dropout)
 
@@ -517,10 +789,30 @@ class TransformerEncoder(nn.Module):
 
     def forward(self, input):
         """
-        input data is a FloatTensor of shape [batch, seq_len, dim]
-        mask is a ByteTensor of shape [batch, seq_len], filled with 1 when
-        inside the sequence and 0 outside.
+        input data is a LongTensor of shape [batch, seq_len]
+
+        returns the mean encoding [batch, dim] if reduction is on, otherwise
+        the encoding [batch, len, dim] and its mask [batch, len], filled with 1
+        when inside the sequence and 0 outside. Unless length_buckets is 0
+        (and always in hierarchical mode), len is the longest real sequence in
+        the batch rather than seq_len.
         """
+        if self.attention == "hierarchical":
+            tensor, mask = self._encode_utterances(input)
+        elif self.length_buckets > 0:
+            tensor, mask = self._encode_trimmed(input)
+        else:
+            tensor, mask = self._encode(input)
+
+        if self.reduction:
+            divisor = mask.type_as(tensor).sum(dim=1).unsqueeze(-1).clamp(min=1e-7)
+            output = tensor.sum(dim=1) / divisor
+            return output
+        else:
+            output = tensor
+            return output, mask
+
+    def _encode(self, input):
         mask = input != self.padding_idx
         positions = (mask.cumsum(dim=1, dtype=torch.int64) - 1).clamp_(min=0)
         tensor = self.embeddings(input)
@@ -531,16 +823,181 @@ class TransformerEncoder(nn.Module):
         tensor = self.dropout(tensor)
 
         tensor *= mask.unsqueeze(-1).type_as(tensor)
+        if self.attention == "window":
+            window = self.window_size
+            global_mask = None if self.split_idx is None else input == self.split_idx
+        else:
+            window, global_mask = 0, None
         for i in range(self.n_layers):
-            tensor = self.layers[i](tensor, mask)
+            tensor = _run_layer(
+                self.layers[i],
+                self.checkpoint_activations,
+                tensor,
+                mask,
+                window,
+                global_mask,
+            )
+        return tensor, mask
 
-        if self.reduction:
-            divisor = mask.type_as(tensor).sum(dim=1).unsqueeze(-1).clamp(min=1e-7)
-            output = tensor.sum(dim=1) / divisor
-            return output
+    def _encode_trimmed(self, input):
+        """
+        Encode only up to the last real token of every sequence.
+
+        Trailing padding never influences real positions (it is masked out of
+        attention and zeroed after every layer), so cutting it off gives the
+        same encodings while the layers only pay for the real tokens.
+        """
+        bsz, seq_len = input.size()
+        mask = input != self.padding_idx
+        steps = torch.arange(1, seq_len + 1, device=input.device)
+        lengths = (mask.long() * steps).max(dim=1)[0]
+        if self.length_buckets == 1 or bsz == 1:
+            return self._encode(input[:, : max(int(lengths.max()), 1)])
+
+        lengths, order = lengths.sort(descending=True)
+        longest = max(int(lengths[0]), 1)
+        tensor = None
+        for rows, row_lengths in zip(
+            order.chunk(self.length_buckets), lengths.chunk(self.length_buckets)
+        ):
+            bucket_len = max(int(row_lengths[0]), 1)
+            encoded, _ = self._encode(input[rows, :bucket_len])
+            if tensor is None:
+                tensor = encoded.new_zeros((bsz, longest, self.dim))
+            tensor[rows, :bucket_len] = encoded
+        return tensor, mask[:, :longest]
+
+    def _encode_utterances(self, input):
+        """
+        Encode every utterance of every context independently.
+
+        Consecutive cases of a dialogue share all but their last utterance, so
+        in eval mode the encodings are looked up in the utterance cache and
+        only unseen utterances are run through the layers, as one batch.
+        """
+        bsz = input.size(0)
+        use_cache = self.utterance_cache is not None and not self.training
+        # split the (right padded) rows into utterances and boundary tokens
+        boundaries = (self.split_idx, self.end_idx)
+        row_utterances = []
+        for row in input.tolist():
+            while row and row[-1] == self.padding_idx:
+                row.pop()
+            utterances, start = [], 0
+            for i, token in enumerate(row):
+                if token in boundaries:
+                    if start < i:
+                        utterances.append(tuple(row[start:i]))
+                    utterances.append((token,))
+                    start = i + 1
+            if start < len(row):
+                utterances.append(tuple(row[start:]))
+            row_utterances.append(utterances)
+
+        # every distinct utterance once, cached ones from the cache
+        encodings = OrderedDict()
+        missing = []
+        for utterances in row_utterances:
+            for utterance in utterances:
+                if utterance in encodings:
+                    continue
+                cached = self.utterance_cache.get(utterance) if use_cache else None
+                encodings[utterance] = cached
+                if cached is None:
+                    missing.append(utterance)
+        if missing:
+            longest = max(len(utterance) for utterance in missing)
+            batch = input.new_full((len(missing), longest), self.padding_idx)
+            for i, utterance in enumerate(missing):
+                batch[i, : len(utterance)] = torch.tensor(utterance)
+            if self.length_buckets > 0:
+                encoded, _ = self._encode_trimmed(batch)
+            else:
+                encoded, _ = self._encode(batch)
+            for i, utterance in enumerate(missing):
+                encodings[utterance] = encoded[i, : len(utterance)]
+                if use_cache:
+                    # a copy, a view would keep the whole batch alive
+                    self.utterance_cache.put(
+                        utterance, encoded[i, : len(utterance)].detach().clone()
+                    )
+
+        # gather the utterance encodings back into [bsz, len, dim], the last
+        # row of the flat table is a zero vector for the padding
+        offsets, flat = {}, []
+        total = 0
+        for utterance, encoded in encodings.items():
+            offsets[utterance] = total
+            total += len(utterance)
+            flat.append(encoded)
+        lengths = [sum(len(u) for u in utterances) for utterances in row_utterances]
+        longest = max(max(lengths), 1)
+        index = torch.full((bsz, longest), total, dtype=torch.long)
+        for row, utterances in enumerate(row_utterances):
+            pos = 0
+            for utterance in utterances:
+                start = offsets[utterance]
+                index[row, pos : pos + len(utterance)] = torch.arange(
+                    start, start + len(utterance)
+                )
+                pos += len(utterance)
+        if flat:
+            flat.append(flat[0].new_zeros((1, self.dim)))
+            table = torch.cat(flat)
         else:
-            output = tensor
-            return output, mask
+            table = self.embeddings.weight.new_zeros((1, self.dim))
+        tensor = table[index.to(input.device)]
+        mask = input[:, :longest] != self.padding_idx
+        return tensor, mask
+
+    def train(self, mode=True):
+        # cached encodings are stale as soon as the weights change again
+        if mode and self.utterance_cache is not None:
+            self.utterance_cache.clear()
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # and so are they after loading other weights, e.g. load_model()
+        if self.utterance_cache is not None:
+            self.utterance_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
+
+class UtteranceCache(object):
+    """
+    LRU map from an utterance (tuple of token ids) to its encoding.
+
+    Keying on the tokens themselves makes entries shared by every case of a
+    dialogue, by repeated utterances across dialogues, and by the turns of a
+    live session, without any bookkeeping of dialogue or turn ids.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, utterance):
+        encoding = self.entries.get(utterance)
+        if encoding is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(utterance)
+        return encoding
+
+    def put(self, utterance, encoding):
+        self.entries[utterance] = encoding
+        self.entries.move_to_end(utterance)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
 
 
 class TransformerEncoder_mask(nn.Module):
@@ -935,6 +1392,34 @@ class TransformerDecoderLayerKG(nn.Module):
 
         return x
 
+    def forward_step(self, x, self_k, self_v, write, step_mask, memory):
+        """
+        Decode one position, see :meth:`TransformerDecoderKG.step`.
+
+        :param memory: ((k, v, mask) of the encoder, kg and db memories) of
+            this layer.
+
+        :return: (x, self_k, self_v)
+        """
+        (enc_k, enc_v, enc_mask), (kg_k, kg_v, kg_mask), (db_k, db_v, db_mask) = memory
+        residual = x
+        x, self_k, self_v = self.self_attention.forward_step(
+            x, self_k, self_v, write, step_mask
+        )
+        x = _normalize(residual + x, self.norm1)
+        residual = x
+        x = self.encoder_db_attention.forward_memory(x, db_k, db_v, db_mask)
+        x = _normalize(residual + x, self.norm2_db)
+        residual = x
+        x = self.encoder_kg_attention.forward_memory(x, kg_k, kg_v, kg_mask)
+        x = _normalize(residual + x, self.norm2_kg)
+        residual = x
+        x = self.encoder_attention.forward_memory(x, enc_k, enc_v, enc_mask)
+        x = _normalize(residual + x, self.norm2)
+        residual = x
+        x = _normalize(residual + self.ffn(x), self.norm3)
+        return x, self_k, self_v
+
     def _create_selfattn_mask(self, x):
         # figure out how many timestamps we need
         bsz = x.size(0)
@@ -969,6 +1454,8 @@ class TransformerDecoderKG(nn.Module):
     :param bool embeddings_scale: Scale embeddings relative to their dimensionality.
         Found useful in fairseq.
     :param int n_positions: Size of the position embeddings matrix.
+    :param bool checkpoint_activations: recompute the activations of every
+        layer in backward instead of storing them.
     """
 
     def __init__(
@@ -986,6 +1473,7 @@ class TransformerDecoderKG(nn.Module):
         learn_positional_embeddings=False,
         padding_idx=None,
         n_positions=1024,
+        checkpoint_activations=False,
     ):
         super().__init__()
         self.embedding_size = embedding_size
@@ -994,6 +1482,7 @@ class TransformerDecoderKG(nn.Module):
         self.n_heads = n_heads
         self.dim = embedding_size
         self.embeddings_scale = embeddings_scale
+        self.checkpoint_activations = checkpoint_activations
         self.dropout = nn.Dropout(p=dropout)  # --dropout
 
         self.out_dim = embedding_size
@@ -1043,7 +1532,9 @@ class TransformerDecoderKG(nn.Module):
         tensor = self.dropout(tensor)  # --dropout
 
         for layer in self.layers:
-            tensor = layer(
+            tensor = _run_layer(
+                layer,
+                self.checkpoint_activations,
                 tensor,
                 encoder_output,
                 encoder_mask,
@@ -1055,6 +1546,71 @@ class TransformerDecoderKG(nn.Module):
 
         return tensor, None
 
+    def memory_state(self, encoder_state, encoder_kg_state, encoder_db_state):
+        """
+        Project the three memories into per layer keys and values once.
+
+        :return: ((k, v, mask) of the encoder, kg and db memories), k and v
+            FloatTensor[n_layers, B, n_heads, mem_len, dim_per_head], mask
+            BoolTensor[B, 1, 1, mem_len].
+        """
+        memories = []
+        for name, (output, mask) in (
+            ("encoder_attention", encoder_state),
+            ("encoder_kg_attention", encoder_kg_state),
+            ("encoder_db_attention", encoder_db_state),
+        ):
+            keys, values = zip(
+                *[getattr(layer, name).project_memory(output) for layer in self.layers]
+            )
+            memories.append(
+                (torch.stack(keys), torch.stack(values), mask[:, None, None, :].bool())
+            )
+        return tuple(memories)
+
+    def step(self, input, position, self_k, self_v, memory):
+        """
+        Decode the tokens at one position from cached keys and values.
+
+        Unlike forward, which re-runs the whole prefix, every call only
+        computes the new position and all shapes stay the same from one step
+        to the next, so a step can be traced or compiled once.
+
+        :param input: LongTensor[B] tokens at ``position``.
+        :param position: 0-dim LongTensor.
+        :param self_k, self_v: FloatTensor[n_layers, B, n_heads, max_len,
+            dim_per_head] self attention caches, zeros before the first step.
+        :param memory: output of :meth:`memory_state`.
+
+        :return: (output [B, 1, dim], self_k, self_v)
+        """
+        tensor = self.embeddings(input).unsqueeze(1)
+        if self.embeddings_scale:
+            tensor = tensor * np.sqrt(self.dim)
+        tensor = tensor + self.position_embeddings(position)
+
+        slots = torch.arange(self_k.size(3), device=input.device)
+        write = (slots == position).view(1, 1, -1, 1)
+        step_mask = (slots <= position).view(1, 1, 1, -1)
+        enc, kg, db = memory
+        new_k, new_v = [], []
+        for i, layer in enumerate(self.layers):
+            tensor, k, v = layer.forward_step(
+                tensor,
+                self_k[i],
+                self_v[i],
+                write,
+                step_mask,
+                (
+                    (enc[0][i], enc[1][i], enc[2]),
+                    (kg[0][i], kg[1][i], kg[2]),
+                    (db[0][i], db[1][i], db[2]),
+                ),
+            )
+            new_k.append(k)
+            new_v.append(v)
+        return tensor, torch.stack(new_k), torch.stack(new_v)
+
 
 class TransformerMemNetModel(nn.Module):
     """Model which takes context, memories, candidates and encodes them"""
@@ -1,4 +1,5 @@
 from collections import deque
+import contextlib
 from functools import lru_cache
 import math
 import os
@@ -31,6 +32,105 @@ def neginf(dtype):
         return -NEAR_INF
 
 
+PRECISIONS = ("fp32", "bf16", "fp16")
+
+
+def autocast(precision, device_type):
+    """
+    Autocast context for the --precision option.
+
+    Parameters stay in fp32 (master weights); under bf16 / fp16 the matmuls
+    run in reduced precision. fp32 runs without autocast at all.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, pick one of {PRECISIONS}")
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float16
+    return torch.autocast(device_type, dtype=dtype)
+
+
+def resolve_device(opt):
+    """
+    The torch.device of the --device and --use_cuda options.
+
+    --device wins when it is set. Otherwise CUDA is used when --use_cuda is
+    on and a GPU is present, the CPU in every other case.
+    """
+    if opt.get("device"):
+        return torch.device(opt["device"])
+    if opt.get("use_cuda", True) and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def numa_node_cpus(node):
+    """Ids of the CPUs of a NUMA node, read from sysfs."""
+    with open(f"/sys/devices/system/node/node{node}/cpulist") as f:
+        cpulist = f.read().strip()
+    cpus = []
+    for part in cpulist.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def configure_cpu(intra_op_threads=0, inter_op_threads=0, numa_node=-1):
+    """
+    Apply the --intra_op_threads, --inter_op_threads and --numa_node options.
+
+    Pinning to a NUMA node restricts this process, and the DataLoader workers
+    it starts, to the cores of that node, so memory is allocated and read
+    locally. The intra-op pool then defaults to one thread per core of the
+    node. 0 and -1 keep the torch defaults.
+
+    :return: the number of intra-op threads in use.
+    """
+    if numa_node >= 0:
+        cpus = numa_node_cpus(numa_node)
+        os.sched_setaffinity(0, cpus)
+        if intra_op_threads == 0:
+            intra_op_threads = len(cpus)
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # only possible before the first inter-op parallel work
+            warnings.warn("inter-op threads already started, keeping their number")
+    return torch.get_num_threads()
+
+
+class EvalBatches:
+    """
+    The batches of an evaluation split, collated once and kept for the run.
+
+    The multi-hot vectors over all entities / concepts of a CRSdataset case
+    (entity_vec, concept_vec, db_vec) are stored sparse and made dense again
+    per batch; dense, the test split alone would take gigabytes.
+    """
+
+    # positions of the multi-hot vectors in a batch
+    multi_hot = (6, 11, 12)
+
+    def __init__(self, loader):
+        self.batches = [
+            [t.to_sparse() if i in self.multi_hot else t for i, t in enumerate(batch)]
+            for batch in loader
+        ]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield [t.to_dense() if i in self.multi_hot else t for i, t in enumerate(batch)]
+
+
 def _create_embeddings(dictionary, embedding_size, padding_idx):
     """Create and initialize word embeddings."""
     # e=nn.Embedding.from_pretrained(data, freeze=False, padding_idx=0).double()
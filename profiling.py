@@ -0,0 +1,185 @@
+"""
+Opt-in per-stage timings of the training loops and the CrossModel forward.
+
+Code marks its stages with named regions,
+
+    with region("encoder"):
+        encoder_states = self.encoder(xs)
+
+    for batch in iterate("data", loader):
+        ...
+
+    @profiled("val")
+    def val(self, is_test=False):
+        ...
+
+which do nothing until enable_profiling(trace, device) is called (run.py
+--profile), with the device the profiled loop runs on. From
+then on every region records its wall-clock time and the change of memory
+(allocated CUDA memory on a GPU, the resident set size of the process on the
+CPU), keyed by the path of the regions it is nested in, e.g.
+"val/forward/encoder". With a trace path torch.profiler records the run as
+well and disable_profiling() writes it as a Chrome trace (chrome://tracing,
+ui.perfetto.dev), with the regions as labelled ranges.
+
+On a CUDA device the regions synchronize it at their borders, so that a stage
+is charged for its kernels and not only for launching them; a profiled run is
+slower than an unprofiled one.
+"""
+
+import contextlib
+import functools
+import os
+import time
+
+import torch
+
+# the active Profiler, None while profiling is off
+_profiler = None
+_NULL = contextlib.nullcontext()
+
+
+def _resident_bytes():
+    """The resident set size of this process, 0 where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class Profiler:
+    """
+    Calls, wall-clock seconds and memory delta of every region path.
+
+    Use enable_profiling() rather than creating one; ``stats`` maps a region
+    path to ``[calls, seconds, memory delta in bytes]``. ``device`` is the
+    device the profiled code runs on, the CPU by default.
+    """
+
+    def __init__(self, trace=None, device=None):
+        self.trace = trace
+        self.stats = {}
+        self._stack = []
+        self.device = torch.device(device or "cpu")
+        self._cuda = self.device.type == "cuda"
+        self._torch_profiler = None
+        if trace is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self._cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(
+                activities=activities, profile_memory=True
+            )
+            self._torch_profiler.start()
+
+    def _memory(self):
+        if self._cuda:
+            return torch.cuda.memory_allocated(self.device)
+        return _resident_bytes()
+
+    @contextlib.contextmanager
+    def region(self, name):
+        self._stack.append(name)
+        path = "/".join(self._stack)
+        if self._cuda:
+            torch.cuda.synchronize(self.device)
+        memory = self._memory()
+        start = time.perf_counter()
+        try:
+            if self._torch_profiler is None:
+                yield
+            else:
+                with torch.profiler.record_function(path):
+                    yield
+        finally:
+            if self._cuda:
+                torch.cuda.synchronize(self.device)
+            seconds = time.perf_counter() - start
+            stats = self.stats.setdefault(path, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += self._memory() - memory
+            self._stack.pop()
+
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.region(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def close(self):
+        """Stop the torch profiler and write its Chrome trace."""
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            directory = os.path.dirname(self.trace)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._torch_profiler.export_chrome_trace(self.trace)
+            self._torch_profiler = None
+
+    def summary(self):
+        """A table of the regions, nested regions below the one they are in."""
+        lines = [f"{'region':<44} {'calls':>7} {'total s':>9} {'mean ms':>9} {'mem MB':>9}"]
+        for path, (calls, seconds, memory) in sorted(self.stats.items()):
+            lines.append(
+                f"{path:<44} {calls:>7} {seconds:>9.3f} "
+                f"{seconds / calls * 1000:>9.2f} {memory / 2 ** 20:>9.1f}"
+            )
+        return "\n".join(lines)
+
+
+def enable_profiling(trace=None, device=None):
+    """
+    Start recording the regions, and a Chrome trace to ``trace`` if given.
+
+    ``device`` is the device of the profiled loop; CUDA memory and syncs only
+    for a CUDA device.
+    """
+    global _profiler
+    disable_profiling()
+    _profiler = Profiler(trace, device)
+    return _profiler
+
+
+def disable_profiling():
+    """Stop recording; returns the Profiler with the stats, or None."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.close()
+    return profiler
+
+
+def region(name):
+    """Context manager around a stage, a shared no-op while profiling is off."""
+    if _profiler is None:
+        return _NULL
+    return _profiler.region(name)
+
+
+def iterate(name, iterable):
+    """``iterable``, with every next() timed as region ``name`` when profiling."""
+    if _profiler is None:
+        return iterable
+    return _profiler.iterate(name, iterable)
+
+
+def profiled(name):
+    """Decorator running the function in region ``name``."""
+
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _profiler.region(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
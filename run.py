@@ -29,12 +29,39 @@ from math import exp
 import os
 
 # os.environ['CUDA_VISIBLE_DEVICES']='3'
+import contextlib
 import signal
 import json
 import argparse
 import pickle as pkl
 from dataset import dataset, CRSdataset
 from model import CrossModel
+from metrics import LossLog, RecMetrics, bleu_scores, distinct, print_losses
+from profiling import (
+    disable_profiling,
+    enable_profiling,
+    iterate,
+    profiled,
+    region,
+)
+from models.utils import EvalBatches, configure_cpu, resolve_device
+from checkpoint import (
+    CHECKPOINT,
+    AsyncCheckpointWriter,
+    TrainProgress,
+    grad_accum_state,
+    init_model_path,
+    load_grad_accum,
+    load_states,
+    run_dir,
+)
+from models.inference import (
+    CrossModelInference,
+    OnnxServing,
+    check_parity,
+    export_onnx,
+    pad_seed_sets,
+)
 import torch.nn as nn
 from torch import optim
 import torch
@@ -48,7 +75,13 @@ try:
     TORCH_AVAILABLE = True
 except ImportError:
     TORCH_AVAILABLE = False
-from nltk.translate.bleu_score import sentence_bleu
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+try:
+    from torch.amp import GradScaler
+except ImportError:
+    from torch.cuda.amp import GradScaler
 
 
 def is_distributed():
@@ -58,6 +91,80 @@ def is_distributed():
     return TORCH_AVAILABLE and dist.is_available() and dist.is_initialized()
 
 
+def get_rank():
+    """Rank of this process, 0 outside of distributed training."""
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """Number of training processes, 1 outside of distributed training."""
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_primary():
+    """Only the rank 0 process saves checkpoints, logs and output files."""
+    return get_rank() == 0
+
+
+def train_loader(train_set, batch_size, epoch=0, skip=0):
+    """
+    DataLoader over the training cases, in their original order.
+
+    In distributed mode every process reads its own 1 / world_size of them
+    through a DistributedSampler, so a step sees world_size * batch_size
+    cases in total. The first ``skip`` batches are left out, where a resumed
+    run continues.
+    """
+    sampler = range(len(train_set))
+    if is_distributed():
+        sampler = DistributedSampler(train_set, shuffle=False)
+        sampler.set_epoch(epoch)
+    if skip:
+        sampler = list(sampler)[skip * batch_size :]
+    return torch.utils.data.DataLoader(
+        dataset=train_set, batch_size=batch_size, sampler=sampler
+    )
+
+
+def eval_loader(val_set, batch_size):
+    """
+    DataLoader over the evaluation cases.
+
+    In distributed mode process ``rank`` evaluates cases rank, rank +
+    world_size, ...; unlike a DistributedSampler this never pads the split
+    with repeated cases, so the reduced metrics are exact.
+    """
+    if is_distributed():
+        val_set = torch.utils.data.Subset(
+            val_set, range(get_rank(), len(val_set), get_world_size())
+        )
+    return torch.utils.data.DataLoader(
+        dataset=val_set, batch_size=batch_size, shuffle=False
+    )
+
+
+def all_reduce_metrics(metrics):
+    """Sum the values of a metrics dict over all processes, in place."""
+    if is_distributed():
+        keys = sorted(metrics)
+        values = torch.tensor([float(metrics[key]) for key in keys], dtype=torch.float64)
+        dist.all_reduce(values)
+        metrics.update(zip(keys, values.tolist()))
+    return metrics
+
+
+def gather_shards(items):
+    """The per case results of every process, in the order of the split."""
+    if not is_distributed():
+        return items
+    shards = [None] * get_world_size()
+    dist.all_gather_object(shards, items)
+    # undo the striding of eval_loader
+    return [
+        shard[i] for i in range(len(shards[0])) for shard in shards if i < len(shard)
+    ]
+
+
 def save_logs(dic, file_name):
     with open(file_name, "w") as f:
         json.dump(dic, f)
@@ -89,6 +196,8 @@ def setup_args():
     train.add_argument("-epoch", "--epoch", type=int, default=2)
     train.add_argument("-gpu", "--gpu", type=str, default="0,1")
     train.add_argument("-gradient_clip", "--gradient_clip", type=float, default=0.1)
+    # micro-batches whose gradients are accumulated into one optimizer step
+    train.add_argument("-update_freq", "--update_freq", type=int, default=1)
     train.add_argument("-embedding_size", "--embedding_size", type=int, default=300)
 
     train.add_argument("-n_heads", "--n_heads", type=int, default=2)
@@ -133,6 +242,112 @@ def setup_args():
         "-info_loss_ratio", "--info_loss_ratio", type=float, default=0.025
     )
 
+    train.add_argument(
+        "-decode_method",
+        "--decode_method",
+        type=str,
+        default="greedy",
+        choices=["greedy", "sample"],
+    )
+    train.add_argument("-temperature", "--temperature", type=float, default=1.0)
+    train.add_argument("-top_k", "--top_k", type=int, default=0)
+    train.add_argument("-top_p", "--top_p", type=float, default=1.0)
+    train.add_argument(
+        "-repetition_penalty", "--repetition_penalty", type=float, default=1.0
+    )
+    train.add_argument(
+        "-movie_constraint",
+        "--movie_constraint",
+        type=str,
+        default="none",
+        choices=["none", "valid", "topk"],
+    )
+    train.add_argument(
+        "-movie_constraint_k", "--movie_constraint_k", type=int, default=50
+    )
+    train.add_argument(
+        "-encoder_length_buckets", "--encoder_length_buckets", type=int, default=4
+    )
+    train.add_argument(
+        "-encoder_attention",
+        "--encoder_attention",
+        type=str,
+        default="full",
+        choices=["full", "hierarchical", "window"],
+    )
+    train.add_argument(
+        "-encoder_cache_size", "--encoder_cache_size", type=int, default=20000
+    )
+    train.add_argument(
+        "-encoder_window_size", "--encoder_window_size", type=int, default=64
+    )
+    train.add_argument(
+        "-checkpoint_activations",
+        "--checkpoint_activations",
+        type=str,
+        default="none",
+        choices=["none", "encoder", "decoder", "all"],
+    )
+    # cpu, cuda, cuda:1, ...; by default cuda when --use_cuda and available
+    train.add_argument("-device", "--device", type=str, default=None)
+    # 0 keeps the torch default
+    train.add_argument(
+        "-intra_op_threads", "--intra_op_threads", type=int, default=0
+    )
+    train.add_argument(
+        "-inter_op_threads", "--inter_op_threads", type=int, default=0
+    )
+    # pin the process (and its data loading workers) to a NUMA node, -1 for none
+    train.add_argument("-numa_node", "--numa_node", type=int, default=-1)
+    train.add_argument(
+        "-precision",
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+    )
+    train.add_argument("-export_onnx", "--export_onnx", type=str, default=None)
+    # checkpoints go to saved_model/<run_name>, a timestamp by default
+    train.add_argument("-run_name", "--run_name", type=str, default=None)
+    # a checkpoint file or run directory to continue from
+    train.add_argument("-resume", "--resume", type=str, default=None)
+    # cutoffs of the recall / mrr / ndcg of the recommender; recall@1 and
+    # recall@50 are always computed, they select the model
+    train.add_argument("-rec_ks", "--rec_ks", type=int, nargs="+", default=[1, 10, 50])
+    # processes scoring the BLEU of the generated responses, 1 scores inline
+    train.add_argument("-metric_workers", "--metric_workers", type=int, default=1)
+    # steps between the training loss records (printed, run_dir/losses.jsonl)
+    train.add_argument("-log_every", "--log_every", type=int, default=50)
+    # time the stages of the loops and the model, see profiling.py
+    train.add_argument("-profile", "--profile", action="store_true")
+    # with --profile, also write a torch.profiler Chrome trace to this file
+    train.add_argument("-profile_trace", "--profile_trace", type=str, default=None)
+    # checkpoints written in the background at a time, 0 to write synchronously
+    train.add_argument(
+        "-checkpoint_in_flight", "--checkpoint_in_flight", type=int, default=1
+    )
+    # optimizer steps between checkpoints, 0 for the end of epochs only
+    train.add_argument(
+        "-checkpoint_every", "--checkpoint_every", type=int, default=1000
+    )
+    # the recommender the generator is finetuned from. The rec stage saves its
+    # best model to saved_model/<run_name>/net_parameter1.pkl and publishes it
+    # as saved_model/net_parameter1.pkl; by default the gen stage loads the
+    # first with --run_name (run both stages with the same name), else the second
+    train.add_argument(
+        "-init_model",
+        "--init_model",
+        type=str,
+        default=None,
+        help="recommender to finetune from; default: the best model of the rec "
+        "run --run_name, or the one the latest rec run published as "
+        "saved_model/net_parameter1.pkl",
+    )
+    # used when started by torchrun with more than one process
+    train.add_argument(
+        "-dist_backend", "--dist_backend", type=str, default="gloo"
+    )
+
     return train
 
 
@@ -153,6 +368,7 @@ class TrainLoop_fusion_rec:
         self.train_MIM = self.opt["train_mim"]
 
         self.use_cuda = opt["use_cuda"]
+        self.device = resolve_device(opt)
         if opt["load_dict"] != None:
             self.load_data = True
         else:
@@ -162,13 +378,14 @@ class TrainLoop_fusion_rec:
         self.info_loss_ratio = self.opt["info_loss_ratio"]
 
         self.movie_ids = pkl.load(open("data/movie_ids.pkl", "rb"))
+        self.rec_metrics = RecMetrics(
+            self.movie_ids, opt["n_entity"], set(opt["rec_ks"]) | {1, 50}
+        )
         # Note: we cannot change the type of metrics ahead of time, so you
         # should correctly initialize to floats or ints here
 
         self.metrics_rec = {
-            "recall@1": 0,
-            "recall@10": 0,
-            "recall@50": 0,
+            **dict.fromkeys(self.rec_metrics.names, 0),
             "loss": 0,
             "count": 0,
         }
@@ -185,49 +402,82 @@ class TrainLoop_fusion_rec:
         }
 
         self.build_model(is_finetune)
+        # val() runs every few hundred steps, its data is prepared only once
+        self.eval_batches_cache = {
+            is_test: self.eval_batches(is_test) for is_test in (False, True)
+        }
 
-        if opt["load_dict"] is not None:
+        self.run_dir = run_dir(opt)
+        self.checkpoint_writer = AsyncCheckpointWriter(opt["checkpoint_in_flight"])
+        if opt["resume"] is not None:
+            print("[ Resuming from {} ]".format(opt["resume"]))
+            states = load_states(opt["resume"], self.model)
+        elif opt["load_dict"] is not None:
             # load model parameters if available
             print(
                 "[ Loading existing model params from {} ]" "".format(opt["load_dict"])
             )
-            states = self.model.load(opt["load_dict"])
+            states = load_states(opt["load_dict"], self.model)
         else:
             states = {}
+        self.progress = TrainProgress(["mim", "rec"], states if opt["resume"] else None)
+        self.logs = states.get("logs", self.logs)
 
         self.init_optim(
             [p for p in self.model.parameters() if p.requires_grad],
             optim_states=states.get("optimizer"),
             saved_optim_type=states.get("optimizer_type"),
         )
+        # a checkpoint at the end of an epoch may be inside an update_freq window
+        self._number_grad_accum = load_grad_accum(self.model, states)
+        if "scaler" in states:
+            self.scaler.load_state_dict(states["scaler"])
 
     def build_model(self, is_finetune):
         self.model = CrossModel(self.opt, self.dict, is_finetune)
         if self.opt["embedding_type"] != "random":
             pass
-        if self.use_cuda:
-            self.model.cuda()
+        self.model.to(self.device)
+        # training steps go through the DDP wrapper, which all-reduces the
+        # gradients in backward; everything else uses the model itself
+        self.parallel_model = self.model
+        if is_distributed():
+            self.parallel_model = DistributedDataParallel(
+                self.model,
+                # the rec and gen losses each leave parts of the model unused
+                find_unused_parameters=True,
+                # the buffers are constants (edge lists, masks)
+                broadcast_buffers=False,
+            )
 
     def train(self):
         # self.model.load_model()
-        losses = []
-        best_val_rec = 0
-        rec_stop = False
+        # restored when resuming from a checkpoint
+        best_val_rec = self.progress.values.get("best_val_rec", 0)
+        rec_stop = self.progress.values.get("rec_stop", False)
+        iterations = self.progress.values.get("iterations", 0)
 
         if self.train_MIM:
 
             print("Pretraining MIM objective ... ")
 
+            loss_log = LossLog(
+                "mim",
+                ["info_db_loss"],
+                self.opt["log_every"],
+                self.loss_sink(),
+                start=self.progress.steps,
+            )
             for i in range(3):
+                if self.progress.done("mim", i):
+                    continue
+                skip = self.progress.start("mim", i)
                 train_set = CRSdataset(
                     self.train_dataset.data_process(),
                     self.opt["n_entity"],
                     self.opt["n_concept"],
                 )
-                train_dataset_loader = torch.utils.data.DataLoader(
-                    dataset=train_set, batch_size=self.batch_size, shuffle=False
-                )
-                num = 0
+                train_dataset_loader = train_loader(train_set, self.batch_size, i, skip)
                 for (
                     context,
                     c_lengths,
@@ -243,7 +493,11 @@ class TrainLoop_fusion_rec:
                     concept_vec,
                     db_vec,
                     rec,
-                ) in tqdm(train_dataset_loader):
+                ) in tqdm(
+                    iterate("data", self.progress.batches(train_dataset_loader)),
+                    total=len(train_dataset_loader),
+                    disable=not is_primary(),
+                ):
                     seed_sets = []
                     batch_size = context.shape[0]
                     for b in range(batch_size):
@@ -252,60 +506,70 @@ class TrainLoop_fusion_rec:
                     self.model.train()
                     self.zero_grad()
 
-                    (
-                        scores,
-                        preds,
-                        rec_scores,
-                        rec_loss,
-                        gen_loss,
-                        mask_loss,
-                        info_db_loss,
-                        info_con_loss,
-                    ) = self.model(
-                        context.cuda(),
-                        response.cuda(),
-                        mask_response.cuda(),
-                        concept_mask,
-                        dbpedia_mask,
-                        seed_sets,
-                        movie,
-                        concept_vec,
-                        db_vec,
-                        entity_vector.cuda(),
-                        rec,
-                        test=False,
-                    )
+                    with self.no_sync(), region("forward"):
+                        (
+                            scores,
+                            preds,
+                            rec_scores,
+                            rec_loss,
+                            gen_loss,
+                            mask_loss,
+                            info_db_loss,
+                            info_con_loss,
+                        ) = self.parallel_model(
+                            context.to(self.device),
+                            response.to(self.device),
+                            mask_response.to(self.device),
+                            concept_mask,
+                            dbpedia_mask,
+                            seed_sets,
+                            movie,
+                            concept_vec,
+                            db_vec,
+                            entity_vector.to(self.device),
+                            rec,
+                            test=False,
+                            mode="rec",
+                        )
 
                     joint_loss = info_db_loss + info_con_loss
 
-                    losses.append([info_db_loss])
+                    loss_log.add(info_db_loss)
                     self.backward(joint_loss)
                     self.update_params()
-                    if num % 50 == 0:
-                        print(
-                            "info db loss is %f"
-                            % (sum([l[0] for l in losses]) / len(losses))
+                    self.progress.step()
+                    if self.checkpoint_due():
+                        self.save_checkpoint(
+                            best_val_rec=best_val_rec,
+                            rec_stop=rec_stop,
+                            iterations=iterations,
                         )
-                        # print('info con loss is %f'%(sum([l[1] for l in losses])/len(losses)))
-                        losses = []
-                    num += 1
+                loss_log.flush(wait=True)
+                self.progress.end_epoch()
 
             # print("masked loss pre-trained")
 
         print("Recommendation training ......")
 
-        losses = []
-        iterations = 0
+        loss_log = LossLog(
+            "rec",
+            ["rec_loss", "info_db_loss"],
+            self.opt["log_every"],
+            self.loss_sink(),
+            start=self.progress.steps,
+        )
         for i in range(self.epoch):
+            if rec_stop:
+                break
+            if self.progress.done("rec", i):
+                continue
+            skip = self.progress.start("rec", i)
             train_set = CRSdataset(
                 self.train_dataset.data_process(),
                 self.opt["n_entity"],
                 self.opt["n_concept"],
             )
-            train_dataset_loader = torch.utils.data.DataLoader(
-                dataset=train_set, batch_size=self.batch_size, shuffle=False
-            )
-            num = 0
+            train_dataset_loader = train_loader(train_set, self.batch_size, i, skip)
             for (
                 context,
                 c_lengths,
@@ -321,7 +585,11 @@ class TrainLoop_fusion_rec:
                 concept_vec,
                 db_vec,
                 rec,
-            ) in tqdm(train_dataset_loader):
+            ) in tqdm(
+                iterate("data", self.progress.batches(train_dataset_loader)),
+                total=len(train_dataset_loader),
+                disable=not is_primary(),
+            ):
                 seed_sets = []
                 iterations += 1
                 batch_size = context.shape[0]
@@ -331,56 +599,57 @@ class TrainLoop_fusion_rec:
                 self.model.train()
                 self.zero_grad()
 
-                (
-                    scores,
-                    preds,
-                    rec_scores,
-                    rec_loss,
-                    gen_loss,
-                    mask_loss,
-                    info_db_loss,
-                    info_con_loss,
-                ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
-                    concept_mask,
-                    dbpedia_mask,
-                    seed_sets,
-                    movie,
-                    concept_vec,
-                    db_vec,
-                    entity_vector.cuda(),
-                    rec,
-                    test=False,
-                )
+                with self.no_sync(), region("forward"):
+                    (
+                        scores,
+                        preds,
+                        rec_scores,
+                        rec_loss,
+                        gen_loss,
+                        mask_loss,
+                        info_db_loss,
+                        info_con_loss,
+                    ) = self.parallel_model(
+                        context.to(self.device),
+                        response.to(self.device),
+                        mask_response.to(self.device),
+                        concept_mask,
+                        dbpedia_mask,
+                        seed_sets,
+                        movie,
+                        concept_vec,
+                        db_vec,
+                        entity_vector.to(self.device),
+                        rec,
+                        test=False,
+                        mode="rec",
+                    )
 
                 joint_loss = (
                     rec_loss + self.info_loss_ratio * info_db_loss + self.info_loss_ratio * info_con_loss
                 )  # +0.0*info_con_loss#+mask_loss*0.05
 
-                losses.append([rec_loss, info_db_loss])
+                loss_log.add(rec_loss, info_db_loss)
                 self.backward(joint_loss)
                 self.update_params()
-                if num % 50 == 0:
-                    print(
-                        "rec loss is %f" % (sum([l[0] for l in losses]) / len(losses))
-                    )
-                    print(
-                        "info db loss is %f"
-                        % (sum([l[1] for l in losses]) / len(losses))
-                    )
-                    losses = []
                 if iterations % 400 == 0:
-                    print(f"Evaluate model on test set at {iterations} step....")
+                    if is_primary():
+                        print(f"Evaluate model on test set at {iterations} step....")
                     output_metrics_rec = self.val(is_test=True)
                     self.logs[iterations] = {
-                        "recall@1": output_metrics_rec["recall@1"],
-                        "recall@10": output_metrics_rec["recall@10"],
-                        "recall@50": output_metrics_rec["recall@50"],
+                        key: value
+                        for key, value in output_metrics_rec.items()
+                        if key.startswith("recall@")
                     }
-                num += 1
+                self.progress.step()
+                if self.checkpoint_due():
+                    self.save_checkpoint(
+                        best_val_rec=best_val_rec,
+                        rec_stop=rec_stop,
+                        iterations=iterations,
+                    )
 
+            loss_log.flush(wait=True)
             output_metrics_rec = self.val()
 
             if (
@@ -392,41 +661,51 @@ class TrainLoop_fusion_rec:
                 best_val_rec = (
                     output_metrics_rec["recall@50"] + output_metrics_rec["recall@1"]
                 )
-                self.model.save_model()
-                print(
-                    "recommendation model saved once------------------------------------------------"
-                )
+                if is_primary():
+                    self.model.save_model(
+                        os.path.join(self.run_dir, "net_parameter1.pkl"),
+                        self.checkpoint_writer,
+                    )
+                    # the default --init_model of a gen run without --run_name
+                    self.model.save_model(
+                        os.path.join("saved_model", "net_parameter1.pkl"),
+                        self.checkpoint_writer,
+                    )
+                    print(
+                        "recommendation model saved once------------------------------------------------"
+                    )
 
+            self.progress.end_epoch()
+            self.save_checkpoint(
+                best_val_rec=best_val_rec, rec_stop=rec_stop, iterations=iterations
+            )
             if rec_stop == True:
                 break
 
         _ = self.val(is_test=True)
 
-        print("Saving logs .........")
-        save_logs(self.logs, self.log_file_name)
+        if is_primary():
+            print("Saving logs .........")
+            save_logs(self.logs, self.log_file_name)
+        # the last checkpoints are still being written
+        self.checkpoint_writer.wait()
 
+    @profiled("metrics")
     def metrics_cal_rec(self, rec_loss, scores, labels):
-        batch_size = len(labels.view(-1).tolist())
-        self.metrics_rec["loss"] += rec_loss
-        
-        outputs = scores.cpu()
-        outputs = outputs[:, torch.LongTensor(self.movie_ids)]
-
-        _, pred_idx = torch.topk(outputs, k=100, dim=1)
-        for b in range(batch_size):
-            if labels[b].item() == 0:
-                continue
-            target_idx = self.movie_ids.index(labels[b].item())
-            #456 target , [456, 678, 243435, 34534]
-            self.metrics_rec["recall@1"] += int(target_idx in pred_idx[b][:1].tolist())
-            self.metrics_rec["recall@10"] += int(
-                target_idx in pred_idx[b][:10].tolist()
-            )
-            self.metrics_rec["recall@50"] += int(
-                target_idx in pred_idx[b][:50].tolist()
-            )
-            self.metrics_rec["count"] += 1
+        self.rec_metrics.update(scores, labels, rec_loss)
+
+    def eval_batches(self, is_test):
+        """The collated batches of the test or valid split (this process' shard)."""
+        if is_test:
+            val_dataset = dataset("data/test_data.jsonl", self.opt)
+        else:
+            val_dataset = dataset("data/valid_data.jsonl", self.opt)
+        val_set = CRSdataset(
+            val_dataset.data_process(), self.opt["n_entity"], self.opt["n_concept"]
+        )
+        return EvalBatches(eval_loader(val_set, self.batch_size))
 
+    @profiled("val")
     def val(self, is_test=False):
         self.metrics_gen = {
             "ppl": 0,
@@ -441,25 +720,14 @@ class TrainLoop_fusion_rec:
             "count": 0,
         }
         self.metrics_rec = {
-            "recall@1": 0,
-            "recall@10": 0,
-            "recall@50": 0,
             "loss": 0,
             "gate": 0,
             "count": 0,
             "gate_count": 0,
         }
+        self.rec_metrics.reset()
         self.model.eval()
-        if is_test:
-            val_dataset = dataset("data/test_data.jsonl", self.opt)
-        else:
-            val_dataset = dataset("data/valid_data.jsonl", self.opt)
-        val_set = CRSdataset(
-            val_dataset.data_process(), self.opt["n_entity"], self.opt["n_concept"]
-        )
-        val_dataset_loader = torch.utils.data.DataLoader(
-            dataset=val_set, batch_size=self.batch_size, shuffle=False
-        )
+        val_dataset_loader = self.eval_batches_cache[is_test]
         recs = []
         for (
             context,
@@ -476,8 +744,8 @@ class TrainLoop_fusion_rec:
             concept_vec,
             db_vec,
             rec,
-        ) in val_dataset_loader:
-            with torch.no_grad():
+        ) in iterate("data", val_dataset_loader):
+            with torch.no_grad(), region("forward"):
                 seed_sets = []
                 batch_size = context.shape[0]
                 for b in range(batch_size):
@@ -493,20 +761,21 @@ class TrainLoop_fusion_rec:
                     info_db_loss,
                     info_con_loss,
                 ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
+                    context.to(self.device),
+                    response.to(self.device),
+                    mask_response.to(self.device),
                     concept_mask,
                     dbpedia_mask,
                     seed_sets,
                     movie,
                     concept_vec,
                     db_vec,
-                    entity_vector.cuda(),
+                    entity_vector.to(self.device),
                     rec,
                     test=True,
                     maxlen=20,
                     bsz=batch_size,
+                    mode="rec",
                 )
 
             recs.extend(rec.cpu())
@@ -514,11 +783,15 @@ class TrainLoop_fusion_rec:
             # exit()
             self.metrics_cal_rec(rec_loss, rec_scores, movie)
 
+        # the ranking metrics were summed on the device, read them once
+        self.metrics_rec.update(self.rec_metrics.compute())
+        all_reduce_metrics(self.metrics_rec)
         output_dict_rec = {
             key: self.metrics_rec[key] / self.metrics_rec["count"]
             for key in self.metrics_rec
         }
-        print(output_dict_rec)
+        if is_primary():
+            print(output_dict_rec)
 
         return output_dict_rec
 
@@ -582,15 +855,57 @@ class TrainLoop_fusion_rec:
 
         optim_class = self.optim_opts()[opt["optimizer"]]
         self.optimizer = optim_class(params, **kwargs)
+        if optim_states is not None and saved_optim_type == opt["optimizer"]:
+            self.optimizer.load_state_dict(optim_states)
+        # loss scaling keeps fp16 gradients from underflowing, no-op otherwise
+        self.scaler = GradScaler(enabled=opt["precision"] == "fp16")
+        self._number_grad_accum = 0
+
+    def checkpoint_due(self):
+        """Whether --checkpoint_every optimizer steps have passed since the last one."""
+        every = self.opt["checkpoint_every"]
+        steps = self.progress.steps // self.opt["update_freq"]
+        return every > 0 and self._number_grad_accum == 0 and steps % every == 0
+
+    @profiled("checkpoint")
+    def save_checkpoint(self, **values):
+        """
+        Write the full training state to the run directory, see checkpoint.py.
+
+        ``values`` are the loop variables to resume with. Every process has to
+        call this, rank 0 writes the file.
+        """
+        states = self.progress.state(**values)
+        states.update(grad_accum_state(self.model, self._number_grad_accum))
+        if not is_primary():
+            return
+        states.update(
+            model=self.model.state_dict(),
+            optimizer=self.optimizer.state_dict(),
+            optimizer_type=self.opt["optimizer"],
+            scaler=self.scaler.state_dict(),
+            logs=self.logs,
+        )
+        self.checkpoint_writer.save(states, os.path.join(self.run_dir, CHECKPOINT))
 
+    def loss_sink(self):
+        """Print the LossLog records and append them to run_dir/losses.jsonl."""
+        if not is_primary():
+            return None
+        return print_losses(os.path.join(self.run_dir, "losses.jsonl"))
+
+    @profiled("backward")
     def backward(self, loss):
         """
         Perform a backward pass. It is recommended you use this instead of
         loss.backward(), for integration with distributed training and FP16
         training.
         """
-        loss.backward()
+        # the step applies the mean of the micro-batch gradients
+        loss = loss / self.opt["update_freq"]
+        self.scaler.scale(loss).backward()
 
+    @profiled("optimizer")
     def update_params(self):
         """
         Perform step of optimization, clipping gradients and adjusting LR
@@ -599,7 +914,7 @@ class TrainLoop_fusion_rec:
 
         It is recommended (but not forced) that you call this in train_step.
         """
-        update_freq = 1
+        update_freq = self.opt["update_freq"]
         if update_freq > 1:
             # we're doing gradient accumulation, so we don't only want to step
             # every N updates instead
@@ -608,11 +923,25 @@ class TrainLoop_fusion_rec:
                 return
 
         if self.opt["gradient_clip"] > 0:
+            # clip the true gradients, not the loss-scaled ones
+            self.scaler.unscale_(self.optimizer)
             torch.nn.utils.clip_grad_norm_(
                 self.model.parameters(), self.opt["gradient_clip"]
             )
 
-        self.optimizer.step()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+
+    def no_sync(self):
+        """
+        Context for the forward pass of a micro-batch.
+
+        With --update_freq in distributed training, only the last micro-batch
+        of a step all-reduces the gradients, the others accumulate locally.
+        """
+        if is_distributed() and self._number_grad_accum + 1 < self.opt["update_freq"]:
+            return self.parallel_model.no_sync()
+        return contextlib.nullcontext()
 
     def zero_grad(self):
         """
@@ -621,6 +950,9 @@ class TrainLoop_fusion_rec:
         It is recommended you call this in train_step. It automatically handles
         gradient accumulation if agent is called with --update-freq.
         """
+        if self._number_grad_accum != 0:
+            # keep accumulating until update_params steps
+            return
         self.optimizer.zero_grad()
 
 
@@ -636,6 +968,7 @@ class TrainLoop_fusion_gen:
         self.epoch = self.opt["epoch"]
 
         self.use_cuda = opt["use_cuda"]
+        self.device = resolve_device(opt)
         if opt["load_dict"] != None:
             self.load_data = True
         else:
@@ -666,44 +999,75 @@ class TrainLoop_fusion_gen:
         }
 
         self.build_model(is_finetune=True)
+        # val() runs after every epoch, its data is prepared only once
+        self.eval_batches_cache = {
+            is_test: self.eval_batches(is_test) for is_test in (False, True)
+        }
 
-        if opt["load_dict"] is not None:
+        self.run_dir = run_dir(opt)
+        self.checkpoint_writer = AsyncCheckpointWriter(opt["checkpoint_in_flight"])
+        if opt["resume"] is not None:
+            print("[ Resuming from {} ]".format(opt["resume"]))
+            states = load_states(opt["resume"], self.model)
+        elif opt["load_dict"] is not None:
             # load model parameters if available
             print(
                 "[ Loading existing model params from {} ]" "".format(opt["load_dict"])
             )
-            states = self.model.load(opt["load_dict"])
+            states = load_states(opt["load_dict"], self.model)
         else:
             states = {}
+        self.progress = TrainProgress(["gen"], states if opt["resume"] else None)
 
         self.init_optim(
             [p for p in self.model.parameters() if p.requires_grad],
             optim_states=states.get("optimizer"),
             saved_optim_type=states.get("optimizer_type"),
         )
+        # a checkpoint at the end of an epoch may be inside an update_freq window
+        self._number_grad_accum = load_grad_accum(self.model, states)
+        if "scaler" in states:
+            self.scaler.load_state_dict(states["scaler"])
 
     def build_model(self, is_finetune):
         self.model = CrossModel(self.opt, self.dict, is_finetune)
         if self.opt["embedding_type"] != "random":
             pass
-        if self.use_cuda:
-            self.model.cuda()
+        self.model.to(self.device)
+        # training steps go through the DDP wrapper, which all-reduces the
+        # gradients in backward; everything else uses the model itself
+        self.parallel_model = self.model
+        if is_distributed():
+            self.parallel_model = DistributedDataParallel(
+                self.model,
+                # the rec and gen losses each leave parts of the model unused
+                find_unused_parameters=True,
+                # the buffers are constants (edge lists, masks)
+                broadcast_buffers=False,
+            )
 
     def train(self):
-        self.model.load_model()
-        losses = []
-        best_val_gen = 1000
+        if not self.progress.resumed:
+            self.model.load_model(init_model_path(self.opt, "net_parameter1.pkl"))
+        best_val_gen = self.progress.values.get("best_val_gen", 1000)
         gen_stop = False
+        loss_log = LossLog(
+            "gen",
+            ["gen_loss"],
+            self.opt["log_every"],
+            self.loss_sink(),
+            start=self.progress.steps,
+        )
         for i in range(self.epoch * 3):
+            if self.progress.done("gen", i):
+                continue
+            skip = self.progress.start("gen", i)
             train_set = CRSdataset(
                 self.train_dataset.data_process(True),
                 self.opt["n_entity"],
                 self.opt["n_concept"],
             )
-            train_dataset_loader = torch.utils.data.DataLoader(
-                dataset=train_set, batch_size=self.batch_size, shuffle=False
-            )
-            num = 0
+            train_dataset_loader = train_loader(train_set, self.batch_size, i, skip)
             for (
                 context,
                 c_lengths,
@@ -719,7 +1083,11 @@ class TrainLoop_fusion_gen:
                 concept_vec,
                 db_vec,
                 rec,
-            ) in tqdm(train_dataset_loader):
+            ) in tqdm(
+                iterate("data", self.progress.batches(train_dataset_loader)),
+                total=len(train_dataset_loader),
+                disable=not is_primary(),
+            ):
                 seed_sets = []
                 batch_size = context.shape[0]
                 for b in range(batch_size):
@@ -728,54 +1096,73 @@ class TrainLoop_fusion_gen:
                 self.model.train()
                 self.zero_grad()
 
-                (
-                    scores,
-                    preds,
-                    rec_scores,
-                    rec_loss,
-                    gen_loss,
-                    mask_loss,
-                    info_db_loss,
-                    info_con_loss,
-                ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
-                    concept_mask,
-                    dbpedia_mask,
-                    seed_sets,
-                    movie,
-                    concept_vec,
-                    db_vec,
-                    entity_vector.cuda(),
-                    rec,
-                    test=False,
-                )
+                with self.no_sync(), region("forward"):
+                    (
+                        scores,
+                        preds,
+                        rec_scores,
+                        rec_loss,
+                        gen_loss,
+                        mask_loss,
+                        info_db_loss,
+                        info_con_loss,
+                    ) = self.parallel_model(
+                        context.to(self.device),
+                        response.to(self.device),
+                        mask_response.to(self.device),
+                        concept_mask,
+                        dbpedia_mask,
+                        seed_sets,
+                        movie,
+                        concept_vec,
+                        db_vec,
+                        entity_vector.to(self.device),
+                        rec,
+                        test=False,
+                    )
 
                 joint_loss = gen_loss
 
-                losses.append([gen_loss])
+                loss_log.add(gen_loss)
                 self.backward(joint_loss)
                 self.update_params()
-                if num % 50 == 0:
-                    print(
-                        "gen loss is %f" % (sum([l[0] for l in losses]) / len(losses))
-                    )
-                    losses = []
-                num += 1
+                self.progress.step()
+                if self.checkpoint_due():
+                    self.save_checkpoint(best_val_gen=best_val_gen)
 
+            loss_log.flush(wait=True)
             output_metrics_gen = self.val(True)
             if best_val_gen < output_metrics_gen["dist4"]:
                 pass
             else:
                 best_val_gen = output_metrics_gen["dist4"]
-                self.model.save_model()
-                print(
-                    "generator model saved once------------------------------------------------"
-                )
+                if is_primary():
+                    self.model.save_model(
+                        os.path.join(self.run_dir, "net_parameter1.pkl"),
+                        self.checkpoint_writer,
+                    )
+                    print(
+                        "generator model saved once------------------------------------------------"
+                    )
+            self.progress.end_epoch()
+            self.save_checkpoint(best_val_gen=best_val_gen)
 
         _ = self.val(is_test=True)
+        # the last checkpoints are still being written
+        self.checkpoint_writer.wait()
 
+    def eval_batches(self, is_test):
+        """The collated batches of the test or valid split (this process' shard)."""
+        if is_test:
+            val_dataset = dataset("data/test_data.jsonl", self.opt)
+        else:
+            val_dataset = dataset("data/valid_data.jsonl", self.opt)
+        val_set = CRSdataset(
+            val_dataset.data_process(True), self.opt["n_entity"], self.opt["n_concept"]
+        )
+        return EvalBatches(eval_loader(val_set, self.batch_size))
+
+    @profiled("val")
     def val(self, is_test=False):
         self.metrics_gen = {
             "ppl": 0,
@@ -799,16 +1186,7 @@ class TrainLoop_fusion_gen:
             "gate_count": 0,
         }
         self.model.eval()
-        if is_test:
-            val_dataset = dataset("data/test_data.jsonl", self.opt)
-        else:
-            val_dataset = dataset("data/valid_data.jsonl", self.opt)
-        val_set = CRSdataset(
-            val_dataset.data_process(True), self.opt["n_entity"], self.opt["n_concept"]
-        )
-        val_dataset_loader = torch.utils.data.DataLoader(
-            dataset=val_set, batch_size=self.batch_size, shuffle=False
-        )
+        val_dataset_loader = self.eval_batches_cache[is_test]
         inference_sum = []
         golden_sum = []
         context_sum = []
@@ -829,60 +1207,43 @@ class TrainLoop_fusion_gen:
             concept_vec,
             db_vec,
             rec,
-        ) in tqdm(val_dataset_loader):
-            with torch.no_grad():
+        ) in tqdm(
+            iterate("data", val_dataset_loader),
+            total=len(val_dataset_loader),
+            disable=not is_primary(),
+        ):
+            with torch.no_grad(), region("forward"):
                 seed_sets = []
                 batch_size = context.shape[0]
                 for b in range(batch_size):
                     seed_set = entity[b].nonzero().view(-1).tolist()
                     seed_sets.append(seed_set)
-                (
-                    _,
-                    _,
-                    _,
-                    _,
-                    gen_loss,
-                    mask_loss,
-                    info_db_loss,
-                    info_con_loss,
-                ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
-                    concept_mask,
-                    dbpedia_mask,
-                    seed_sets,
-                    movie,
-                    concept_vec,
-                    db_vec,
-                    entity_vector.cuda(),
-                    rec,
-                    test=False,
-                )
+                # teacher-forced loss and greedy responses from one pass
                 (
                     scores,
                     preds,
                     rec_scores,
                     rec_loss,
-                    _,
+                    gen_loss,
                     mask_loss,
                     info_db_loss,
                     info_con_loss,
                 ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
+                    context.to(self.device),
+                    response.to(self.device),
+                    mask_response.to(self.device),
                     concept_mask,
                     dbpedia_mask,
                     seed_sets,
                     movie,
                     concept_vec,
                     db_vec,
-                    entity_vector.cuda(),
+                    entity_vector.to(self.device),
                     rec,
                     test=True,
                     maxlen=20,
                     bsz=batch_size,
+                    mode="eval",
                 )
 
             golden_sum.extend(self.vector2sentence(response.cpu()))
@@ -893,6 +1254,11 @@ class TrainLoop_fusion_gen:
             # print(losses)
             # exit()
 
+        # every process scores all responses, distinct-n needs them together
+        inference_sum = gather_shards(inference_sum)
+        golden_sum = gather_shards(golden_sum)
+        context_sum = gather_shards(context_sum)
+        recs = gather_shards(recs)
         self.metrics_cal_gen(losses, inference_sum, golden_sum, recs)
 
         output_dict_gen = {}
@@ -901,6 +1267,8 @@ class TrainLoop_fusion_gen:
                 output_dict_gen[key] = self.metrics_gen[key] / self.metrics_gen["count"]
             else:
                 output_dict_gen[key] = self.metrics_gen[key]
+        if not is_primary():
+            return output_dict_gen
         print(output_dict_gen)
 
         f = open("context_test.txt", "w", encoding="utf-8")
@@ -912,80 +1280,50 @@ class TrainLoop_fusion_gen:
         f.close()
         return output_dict_gen
 
+    def export_onnx(self, directory):
+        """
+        Write the model as ONNX graphs and check them on the test split.
+
+        The graphs come from the CPU serving copy of the model (see
+        models/inference.py); their entity scores, first step logits and
+        greedy responses are compared against that PyTorch model.
+        """
+        serving = CrossModelInference.from_model(self.model, self.opt, self.dict)
+        test_dataset = dataset("data/test_data.jsonl", self.opt)
+        test_set = CRSdataset(
+            test_dataset.data_process(True), self.opt["n_entity"], self.opt["n_concept"]
+        )
+        test_dataset_loader = torch.utils.data.DataLoader(
+            dataset=test_set, batch_size=self.batch_size, shuffle=False
+        )
+        batches = []
+        for batch in test_dataset_loader:
+            context, entity, entity_vector, concept_mask = (
+                batch[0], batch[6], batch[7], batch[9]
+            )
+            seed_sets = [entity[b].nonzero().view(-1).tolist() for b in range(len(entity))]
+            seed_ids, seed_mask = pad_seed_sets(seed_sets, concept_mask.size(1))
+            batches.append(
+                (context, concept_mask.long(), entity_vector.long(), seed_ids, seed_mask)
+            )
+
+        export_onnx(serving, directory, *batches[0])
+        parity = check_parity(serving, OnnxServing(directory), tqdm(batches))
+        print(f"[ Exported ONNX graphs to {directory} ]", parity)
+        return parity
+
+    @profiled("metrics")
     def metrics_cal_gen(self, rec_loss, preds, responses, recs):
-        def bleu_cal(sen1, tar1):
-            bleu1 = sentence_bleu([tar1], sen1, weights=(1, 0, 0, 0))
-            bleu2 = sentence_bleu([tar1], sen1, weights=(0, 1, 0, 0))
-            bleu3 = sentence_bleu([tar1], sen1, weights=(0, 0, 1, 0))
-            bleu4 = sentence_bleu([tar1], sen1, weights=(0, 0, 0, 1))
-            return bleu1, bleu2, bleu3, bleu4
-
-        def distinct_metrics(outs):
-            # outputs is a list which contains several sentences, each sentence contains several words
-            unigram_count = 0
-            bigram_count = 0
-            trigram_count = 0
-            quagram_count = 0
-            unigram_set = set()
-            bigram_set = set()
-            trigram_set = set()
-            quagram_set = set()
-            for sen in outs:
-                for word in sen:
-                    unigram_count += 1
-                    unigram_set.add(word)
-                for start in range(len(sen) - 1):
-                    bg = str(sen[start]) + " " + str(sen[start + 1])
-                    bigram_count += 1
-                    bigram_set.add(bg)
-                for start in range(len(sen) - 2):
-                    trg = (
-                        str(sen[start])
-                        + " "
-                        + str(sen[start + 1])
-                        + " "
-                        + str(sen[start + 2])
-                    )
-                    trigram_count += 1
-                    trigram_set.add(trg)
-                for start in range(len(sen) - 3):
-                    quag = (
-                        str(sen[start])
-                        + " "
-                        + str(sen[start + 1])
-                        + " "
-                        + str(sen[start + 2])
-                        + " "
-                        + str(sen[start + 3])
-                    )
-                    quagram_count += 1
-                    quagram_set.add(quag)
-            dis1 = len(unigram_set) / len(outs)  # unigram_count
-            dis2 = len(bigram_set) / len(outs)  # bigram_count
-            dis3 = len(trigram_set) / len(outs)  # trigram_count
-            dis4 = len(quagram_set) / len(outs)  # quagram_count
-            return dis1, dis2, dis3, dis4
-
-        predict_s = preds
-        golden_s = responses
         # print(rec_loss[0])
         # self.metrics_gen["ppl"]+=sum([exp(ppl) for ppl in rec_loss])/len(rec_loss)
-        generated = []
-
-        for out, tar, rec in zip(predict_s, golden_s, recs):
-            bleu1, bleu2, bleu3, bleu4 = bleu_cal(out, tar)
-            generated.append(out)
-            self.metrics_gen["bleu1"] += bleu1
-            self.metrics_gen["bleu2"] += bleu2
-            self.metrics_gen["bleu3"] += bleu3
-            self.metrics_gen["bleu4"] += bleu4
-            self.metrics_gen["count"] += 1
-
-        dis1, dis2, dis3, dis4 = distinct_metrics(generated)
-        self.metrics_gen["dist1"] = dis1
-        self.metrics_gen["dist2"] = dis2
-        self.metrics_gen["dist3"] = dis3
-        self.metrics_gen["dist4"] = dis4
+        bleus = bleu_scores(preds, responses, workers=self.opt["metric_workers"])
+        for n, bleu in enumerate(bleus.T.tolist(), 1):
+            # summed in order, like the per-sample scores before
+            self.metrics_gen[f"bleu{n}"] += sum(bleu)
+        self.metrics_gen["count"] += len(preds)
+
+        for n, dis in enumerate(distinct(preds), 1):
+            self.metrics_gen[f"dist{n}"] = dis
 
     def vector2sentence(self, batch_sen):
         sentences = []
@@ -1059,15 +1397,56 @@ class TrainLoop_fusion_gen:
 
         optim_class = self.optim_opts()[opt["optimizer"]]
         self.optimizer = optim_class(params, **kwargs)
+        if optim_states is not None and saved_optim_type == opt["optimizer"]:
+            self.optimizer.load_state_dict(optim_states)
+        # loss scaling keeps fp16 gradients from underflowing, no-op otherwise
+        self.scaler = GradScaler(enabled=opt["precision"] == "fp16")
+        self._number_grad_accum = 0
+
+    def checkpoint_due(self):
+        """Whether --checkpoint_every optimizer steps have passed since the last one."""
+        every = self.opt["checkpoint_every"]
+        steps = self.progress.steps // self.opt["update_freq"]
+        return every > 0 and self._number_grad_accum == 0 and steps % every == 0
+
+    @profiled("checkpoint")
+    def save_checkpoint(self, **values):
+        """
+        Write the full training state to the run directory, see checkpoint.py.
 
+        ``values`` are the loop variables to resume with. Every process has to
+        call this, rank 0 writes the file.
+        """
+        states = self.progress.state(**values)
+        states.update(grad_accum_state(self.model, self._number_grad_accum))
+        if not is_primary():
+            return
+        states.update(
+            model=self.model.state_dict(),
+            optimizer=self.optimizer.state_dict(),
+            optimizer_type=self.opt["optimizer"],
+            scaler=self.scaler.state_dict(),
+        )
+        self.checkpoint_writer.save(states, os.path.join(self.run_dir, CHECKPOINT))
+
+    def loss_sink(self):
+        """Print the LossLog records and append them to run_dir/losses.jsonl."""
+        if not is_primary():
+            return None
+        return print_losses(os.path.join(self.run_dir, "losses.jsonl"))
+
+    @profiled("backward")
     def backward(self, loss):
         """
         Perform a backward pass. It is recommended you use this instead of
         loss.backward(), for integration with distributed training and FP16
         training.
         """
-        loss.backward()
+        # the step applies the mean of the micro-batch gradients
+        loss = loss / self.opt["update_freq"]
+        self.scaler.scale(loss).backward()
 
+    @profiled("optimizer")
     def update_params(self):
         """
         Perform step of optimization, clipping gradients and adjusting LR
@@ -1076,7 +1455,7 @@ class TrainLoop_fusion_gen:
 
         It is recommended (but not forced) that you call this in train_step.
         """
-        update_freq = 1
+        update_freq = self.opt["update_freq"]
         if update_freq > 1:
             # we're doing gradient accumulation, so we don't only want to step
             # every N updates instead
@@ -1085,11 +1464,25 @@ class TrainLoop_fusion_gen:
                 return
 
         if self.opt["gradient_clip"] > 0:
+            # clip the true gradients, not the loss-scaled ones
+            self.scaler.unscale_(self.optimizer)
             torch.nn.utils.clip_grad_norm_(
                 self.model.parameters(), self.opt["gradient_clip"]
             )
 
-        self.optimizer.step()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+
+    def no_sync(self):
+        """
+        Context for the forward pass of a micro-batch.
+
+        With --update_freq in distributed training, only the last micro-batch
+        of a step all-reduces the gradients, the others accumulate locally.
+        """
+        if is_distributed() and self._number_grad_accum + 1 < self.opt["update_freq"]:
+            return self.parallel_model.no_sync()
+        return contextlib.nullcontext()
 
     def zero_grad(self):
         """
@@ -1098,13 +1491,33 @@ class TrainLoop_fusion_gen:
         It is recommended you call this in train_step. It automatically handles
         gradient accumulation if agent is called with --update-freq.
         """
+        if self._number_grad_accum != 0:
+            # keep accumulating until update_params steps
+            return
         self.optimizer.zero_grad()
 
 
 if __name__ == "__main__":
     args = setup_args().parse_args()
-    print(vars(args))
+    # e.g. torchrun --nproc_per_node 4 run.py --device cpu ...
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1:
+        dist.init_process_group(args.dist_backend)
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        local_size = int(os.environ.get("LOCAL_WORLD_SIZE", get_world_size()))
+        if args.device is None and args.use_cuda and torch.cuda.is_available():
+            args.device = f"cuda:{local_rank}"
+        if args.intra_op_threads == 0:
+            # share the cores between the processes of this machine
+            args.intra_op_threads = max(1, os.cpu_count() // local_size)
+    if is_primary():
+        print(vars(args))
     seed_all(vars(args)["random_seed"])
+    configure_cpu(args.intra_op_threads, args.inter_op_threads, args.numa_node)
+    if args.profile:
+        trace = args.profile_trace
+        if trace is not None and is_distributed():
+            trace = f"{trace}.rank{get_rank()}"
+        enable_profiling(trace, resolve_device(vars(args)))
     if args.is_finetune == False:
         loop = TrainLoop_fusion_rec(vars(args), is_finetune=False)
         # loop.model.load_model()
@@ -1112,8 +1525,17 @@ if __name__ == "__main__":
     else:
         loop = TrainLoop_fusion_gen(vars(args), is_finetune=True)
         # loop.train()
-        loop.model.load_model()
+        if args.resume is None:
+            loop.model.load_model(init_model_path(vars(args), "net_parameter1.pkl"))
         # met = loop.val(True)
         loop.train()
     met = loop.val(True)
+    if args.is_finetune and args.export_onnx is not None and is_primary():
+        loop.export_onnx(args.export_onnx)
+    if args.profile:
+        profiler = disable_profiling()
+        if is_primary():
+            print(profiler.summary())
+    if is_distributed():
+        dist.destroy_process_group()
     # print(met)
@@ -35,6 +35,18 @@ import argparse
 import pickle as pkl
 from dataset_copy_boc_loss import dataset, CRSdataset
 from model_copy_boc_loss import CrossModel
+from metrics import LossLog, RecMetrics, bleu_scores, distinct, print_losses
+from models.utils import EvalBatches, configure_cpu, resolve_device
+from checkpoint import (
+    CHECKPOINT,
+    AsyncCheckpointWriter,
+    TrainProgress,
+    grad_accum_state,
+    init_model_path,
+    load_grad_accum,
+    load_states,
+    run_dir,
+)
 import torch.nn as nn
 from torch import optim
 import torch
@@ -54,7 +66,6 @@ try:
     TORCH_AVAILABLE = True
 except ImportError:
     TORCH_AVAILABLE = False
-from nltk.translate.bleu_score import sentence_bleu
 
 
 def is_distributed():
@@ -95,6 +106,8 @@ def setup_args():
     train.add_argument("-epoch", "--epoch", type=int, default=2)
     train.add_argument("-gpu", "--gpu", type=str, default="0,1")
     train.add_argument("-gradient_clip", "--gradient_clip", type=float, default=0.1)
+    # micro-batches whose gradients are accumulated into one optimizer step
+    train.add_argument("-update_freq", "--update_freq", type=int, default=1)
     train.add_argument("-embedding_size", "--embedding_size", type=int, default=300)
 
     train.add_argument("-n_heads", "--n_heads", type=int, default=2)
@@ -138,6 +151,72 @@ def setup_args():
     train.add_argument(
         "-info_loss_ratio", "--info_loss_ratio", type=float, default=0.025
     )
+    train.add_argument(
+        "-encoder_length_buckets", "--encoder_length_buckets", type=int, default=4
+    )
+    train.add_argument(
+        "-encoder_attention",
+        "--encoder_attention",
+        type=str,
+        default="full",
+        choices=["full", "hierarchical", "window"],
+    )
+    train.add_argument(
+        "-encoder_cache_size", "--encoder_cache_size", type=int, default=20000
+    )
+    train.add_argument(
+        "-encoder_window_size", "--encoder_window_size", type=int, default=64
+    )
+    train.add_argument(
+        "-checkpoint_activations",
+        "--checkpoint_activations",
+        type=str,
+        default="none",
+        choices=["none", "encoder", "decoder", "all"],
+    )
+    # cpu, cuda, cuda:1, ...; by default cuda when --use_cuda and available
+    train.add_argument("-device", "--device", type=str, default=None)
+    # 0 keeps the torch default
+    train.add_argument(
+        "-intra_op_threads", "--intra_op_threads", type=int, default=0
+    )
+    train.add_argument(
+        "-inter_op_threads", "--inter_op_threads", type=int, default=0
+    )
+    # pin the process (and its data loading workers) to a NUMA node, -1 for none
+    train.add_argument("-numa_node", "--numa_node", type=int, default=-1)
+    # checkpoints go to saved_model/<run_name>, a timestamp by default
+    train.add_argument("-run_name", "--run_name", type=str, default=None)
+    # a checkpoint file or run directory to continue from
+    train.add_argument("-resume", "--resume", type=str, default=None)
+    # cutoffs of the recall / mrr / ndcg of the recommender; recall@1 and
+    # recall@50 are always computed, they select the model
+    train.add_argument("-rec_ks", "--rec_ks", type=int, nargs="+", default=[1, 10, 50])
+    # processes scoring the BLEU of the generated responses, 1 scores inline
+    train.add_argument("-metric_workers", "--metric_workers", type=int, default=1)
+    # steps between the training loss records (printed, run_dir/losses.jsonl)
+    train.add_argument("-log_every", "--log_every", type=int, default=50)
+    # checkpoints written in the background at a time, 0 to write synchronously
+    train.add_argument(
+        "-checkpoint_in_flight", "--checkpoint_in_flight", type=int, default=1
+    )
+    # optimizer steps between checkpoints, 0 for the end of epochs only
+    train.add_argument(
+        "-checkpoint_every", "--checkpoint_every", type=int, default=1000
+    )
+    # the recommender the generator is finetuned from. The rec stage saves its
+    # best model to saved_model/<run_name>/boc_net_parameter1.pkl and publishes
+    # it as saved_model/boc_net_parameter1.pkl; by default the gen stage loads
+    # the first with --run_name (run both stages with the same name), else the second
+    train.add_argument(
+        "-init_model",
+        "--init_model",
+        type=str,
+        default=None,
+        help="recommender to finetune from; default: the best model of the rec "
+        "run --run_name, or the one the latest rec run published as "
+        "saved_model/boc_net_parameter1.pkl",
+    )
 
     return train
 
@@ -159,6 +238,7 @@ class TrainLoop_fusion_rec:
         self.train_MIM = self.opt["train_mim"]
 
         self.use_cuda = opt["use_cuda"]
+        self.device = resolve_device(opt)
         if opt["load_dict"] != None:
             self.load_data = True
         else:
@@ -168,13 +248,14 @@ class TrainLoop_fusion_rec:
         self.info_loss_ratio = self.opt["info_loss_ratio"]
 
         self.movie_ids = pkl.load(open("data/movie_ids.pkl", "rb"))
+        self.rec_metrics = RecMetrics(
+            self.movie_ids, opt["n_entity"], set(opt["rec_ks"]) | {1, 50}
+        )
         # Note: we cannot change the type of metrics ahead of time, so you
         # should correctly initialize to floats or ints here
 
         self.metrics_rec = {
-            "recall@1": 0,
-            "recall@10": 0,
-            "recall@50": 0,
+            **dict.fromkeys(self.rec_metrics.names, 0),
             "loss": 0,
             "count": 0,
         }
@@ -191,34 +272,49 @@ class TrainLoop_fusion_rec:
         }
 
         self.build_model(is_finetune)
+        # val() runs every few hundred steps, its data is prepared only once
+        self.eval_batches_cache = {
+            is_test: self.eval_batches(is_test) for is_test in (False, True)
+        }
 
-        if opt["load_dict"] is not None:
+        self.run_dir = run_dir(opt)
+        self.checkpoint_writer = AsyncCheckpointWriter(opt["checkpoint_in_flight"])
+        if opt["resume"] is not None:
+            print("[ Resuming from {} ]".format(opt["resume"]))
+            states = load_states(opt["resume"], self.model)
+        elif opt["load_dict"] is not None:
             # load model parameters if available
             print(
                 "[ Loading existing model params from {} ]" "".format(opt["load_dict"])
             )
-            states = self.model.load(opt["load_dict"])
+            states = load_states(opt["load_dict"], self.model)
         else:
             states = {}
+        self.progress = TrainProgress(["rec"], states if opt["resume"] else None)
+        self.logs = states.get("logs", self.logs)
 
         self.init_optim(
             [p for p in self.model.parameters() if p.requires_grad],
             optim_states=states.get("optimizer"),
             saved_optim_type=states.get("optimizer_type"),
         )
+        # a checkpoint at the end of an epoch may be inside an update_freq window
+        self._number_grad_accum = load_grad_accum(self.model, states)
+        if "lr_scheduler" in states:
+            self.lr_scheduler.load_state_dict(states["lr_scheduler"])
 
     def build_model(self, is_finetune):
         self.model = CrossModel(self.opt, self.dict, is_finetune)
         if self.opt["embedding_type"] != "random":
             pass
-        if self.use_cuda:
-            self.model.cuda()
+        self.model.to(self.device)
 
     def train(self):
         # self.model.load_model()
-        losses = []
-        best_val_rec = 0
-        rec_stop = False
+        # restored when resuming from a checkpoint
+        best_val_rec = self.progress.values.get("best_val_rec", 0)
+        rec_stop = self.progress.values.get("rec_stop", False)
+        iterations = self.progress.values.get("iterations", 0)
 
 
         print("Recommendation training ......")
@@ -226,23 +322,34 @@ class TrainLoop_fusion_rec:
 
         neg_edge_index = negative_sampling(
                 edge_index=self.model.word_item_edge_sets, num_nodes=90000,
-                num_neg_samples = 5 * self.model.word_item_edge_sets.size(1) , method='sparse').cuda()
+                num_neg_samples = 5 * self.model.word_item_edge_sets.size(1) , method='sparse').to(self.device)
     
         self.model.neg_edge_index = neg_edge_index
 
-        losses = []
-        iterations = 0
+        loss_log = LossLog(
+            "rec",
+            ["rec_loss", "link_prediction_loss"],
+            self.opt["log_every"],
+            self.loss_sink(),
+            start=self.progress.steps,
+        )
         for i in range(self.epoch):
-            
+            if rec_stop:
+                break
+            if self.progress.done("rec", i):
+                continue
+            skip = self.progress.start("rec", i)
             train_set = CRSdataset(
                 self.train_dataset.data_process(),
                 self.opt["n_entity"],
                 self.opt["n_concept"],
             )
             train_dataset_loader = torch.utils.data.DataLoader(
-                dataset=train_set, batch_size=self.batch_size, shuffle=False
+                dataset=train_set,
+                batch_size=self.batch_size,
+                # a resumed run skips the batches it has trained on
+                sampler=range(skip * self.batch_size, len(train_set)),
             )
-            num = 0
             for (
                 context,
                 c_lengths,
@@ -258,7 +365,10 @@ class TrainLoop_fusion_rec:
                 concept_vec,
                 db_vec,
                 rec,
-            ) in tqdm(train_dataset_loader):
+            ) in tqdm(
+                self.progress.batches(train_dataset_loader),
+                total=len(train_dataset_loader),
+            ):
                 seed_sets = []
                 batch_words = []
                 batch_entities = []
@@ -282,16 +392,16 @@ class TrainLoop_fusion_rec:
                     link_prediction_loss,
                     _,
                 ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
+                    context.to(self.device),
+                    response.to(self.device),
+                    mask_response.to(self.device),
                     concept_mask,
                     dbpedia_mask,
                     seed_sets,
                     movie,
                     concept_vec,
                     db_vec,
-                    entity_vector.cuda(),
+                    entity_vector.to(self.device),
                     rec,
                     None,
                     None,
@@ -303,20 +413,18 @@ class TrainLoop_fusion_rec:
                     rec_loss + self.info_loss_ratio * link_prediction_loss
                 )  # +0.0*info_con_loss#+mask_loss*0.05
                 
-                losses.append([rec_loss, link_prediction_loss])
+                loss_log.add(rec_loss, link_prediction_loss)
                 self.backward(joint_loss)
                 self.update_params()
-                if num % 50 == 0:
-                    print(
-                        "rec loss is %f" % (sum([l[0] for l in losses]) / len(losses))
-                    )
-                    print(
-                        "link prediction loss is %f"
-                        % (sum([l[1] for l in losses]) / len(losses))
+                self.progress.step()
+                if self.checkpoint_due():
+                    self.save_checkpoint(
+                        best_val_rec=best_val_rec,
+                        rec_stop=rec_stop,
+                        iterations=iterations,
                     )
-                    losses = []
-                num += 1
-        
+
+            loss_log.flush(wait=True)
             output_metrics_rec = self.val()
             if (
                 best_val_rec
@@ -327,11 +435,23 @@ class TrainLoop_fusion_rec:
                 best_val_rec = (
                     output_metrics_rec["recall@50"] + output_metrics_rec["recall@1"]
                 )
-                self.model.save_model()
+                self.model.save_model(
+                    os.path.join(self.run_dir, "boc_net_parameter1.pkl"),
+                    self.checkpoint_writer,
+                )
+                # the default --init_model of a gen run without --run_name
+                self.model.save_model(
+                    os.path.join("saved_model", "boc_net_parameter1.pkl"),
+                    self.checkpoint_writer,
+                )
                 print(
                     "recommendation model saved once------------------------------------------------"
                 )
 
+            self.progress.end_epoch()
+            self.save_checkpoint(
+                best_val_rec=best_val_rec, rec_stop=rec_stop, iterations=iterations
+            )
             if rec_stop == True:
                 break
 
@@ -339,26 +459,27 @@ class TrainLoop_fusion_rec:
 
         print("Saving logs .........")
         save_logs(self.logs, self.log_file_name)
+        # the last checkpoints are still being written
+        self.checkpoint_writer.wait()
 #         wandb.finish()
 
     def metrics_cal_rec(self, rec_loss, scores, labels):
-        batch_size = len(labels.view(-1).tolist())
-        self.metrics_rec["loss"] += rec_loss
-        outputs = scores.cpu()
-        outputs = outputs[:, torch.LongTensor(self.movie_ids)]
-        _, pred_idx = torch.topk(outputs, k=100, dim=1)
-        for b in range(batch_size):
-            if labels[b].item() == 0:
-                continue
-            target_idx = self.movie_ids.index(labels[b].item())
-            self.metrics_rec["recall@1"] += int(target_idx in pred_idx[b][:1].tolist())
-            self.metrics_rec["recall@10"] += int(
-                target_idx in pred_idx[b][:10].tolist()
-            )
-            self.metrics_rec["recall@50"] += int(
-                target_idx in pred_idx[b][:50].tolist()
+        self.rec_metrics.update(scores, labels, rec_loss)
+
+    def eval_batches(self, is_test):
+        """The collated batches of the test or valid split."""
+        if is_test:
+            val_dataset = dataset("data/test_data.jsonl", self.opt)
+        else:
+            val_dataset = dataset("data/valid_data.jsonl", self.opt)
+        val_set = CRSdataset(
+            val_dataset.data_process(), self.opt["n_entity"], self.opt["n_concept"]
+        )
+        return EvalBatches(
+            torch.utils.data.DataLoader(
+                dataset=val_set, batch_size=self.batch_size, shuffle=False
             )
-            self.metrics_rec["count"] += 1
+        )
 
     def val(self, is_test=False):
         self.metrics_gen = {
@@ -374,25 +495,14 @@ class TrainLoop_fusion_rec:
             "count": 0,
         }
         self.metrics_rec = {
-            "recall@1": 0,
-            "recall@10": 0,
-            "recall@50": 0,
             "loss": 0,
             "gate": 0,
             "count": 0,
             "gate_count": 0,
         }
+        self.rec_metrics.reset()
         self.model.eval()
-        if is_test:
-            val_dataset = dataset("data/test_data.jsonl", self.opt)
-        else:
-            val_dataset = dataset("data/valid_data.jsonl", self.opt)
-        val_set = CRSdataset(
-            val_dataset.data_process(), self.opt["n_entity"], self.opt["n_concept"]
-        )
-        val_dataset_loader = torch.utils.data.DataLoader(
-            dataset=val_set, batch_size=self.batch_size, shuffle=False
-        )
+        val_dataset_loader = self.eval_batches_cache[is_test]
         recs = []
         for (
             context,
@@ -430,16 +540,16 @@ class TrainLoop_fusion_rec:
                     info_db_loss,
                     info_con_loss,
                 ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
+                    context.to(self.device),
+                    response.to(self.device),
+                    mask_response.to(self.device),
                     concept_mask,
                     dbpedia_mask,
                     seed_sets,
                     movie,
                     concept_vec,
                     db_vec,
-                    entity_vector.cuda(),
+                    entity_vector.to(self.device),
                     rec,
                     None,
                     None,
@@ -452,6 +562,8 @@ class TrainLoop_fusion_rec:
             recs.extend(rec.cpu())
             self.metrics_cal_rec(rec_loss, rec_scores, movie)
 
+        # the ranking metrics were summed on the device, read them once
+        self.metrics_rec.update(self.rec_metrics.compute())
         output_dict_rec = {
             key: self.metrics_rec[key] / self.metrics_rec["count"]
             for key in self.metrics_rec
@@ -520,7 +632,37 @@ class TrainLoop_fusion_rec:
 
         optim_class = self.optim_opts()[opt["optimizer"]]
         self.optimizer = optim_class(params, **kwargs)
+        if optim_states is not None and saved_optim_type == opt["optimizer"]:
+            self.optimizer.load_state_dict(optim_states)
         self.lr_scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=1600, gamma=0.4)
+        self._number_grad_accum = 0
+
+    def checkpoint_due(self):
+        """Whether --checkpoint_every optimizer steps have passed since the last one."""
+        every = self.opt["checkpoint_every"]
+        steps = self.progress.steps // self.opt["update_freq"]
+        return every > 0 and self._number_grad_accum == 0 and steps % every == 0
+
+    def save_checkpoint(self, **values):
+        """
+        Write the full training state to the run directory, see checkpoint.py.
+
+        ``values`` are the loop variables to resume with.
+        """
+        states = self.progress.state(**values)
+        states.update(grad_accum_state(self.model, self._number_grad_accum))
+        states.update(
+            model=self.model.state_dict(),
+            optimizer=self.optimizer.state_dict(),
+            optimizer_type=self.opt["optimizer"],
+            lr_scheduler=self.lr_scheduler.state_dict(),
+            logs=self.logs,
+        )
+        self.checkpoint_writer.save(states, os.path.join(self.run_dir, CHECKPOINT))
+
+    def loss_sink(self):
+        """Print the LossLog records and append them to run_dir/losses.jsonl."""
+        return print_losses(os.path.join(self.run_dir, "losses.jsonl"))
 
     def backward(self, loss):
         """
@@ -528,6 +670,8 @@ class TrainLoop_fusion_rec:
         loss.backward(), for integration with distributed training and FP16
         training.
         """
+        # the step applies the mean of the micro-batch gradients
+        loss = loss / self.opt["update_freq"]
         loss.backward()
 
     def update_params(self):
@@ -538,7 +682,7 @@ class TrainLoop_fusion_rec:
 
         It is recommended (but not forced) that you call this in train_step.
         """
-        update_freq = 1
+        update_freq = self.opt["update_freq"]
         if update_freq > 1:
             # we're doing gradient accumulation, so we don't only want to step
             # every N updates instead
@@ -561,6 +705,9 @@ class TrainLoop_fusion_rec:
         It is recommended you call this in train_step. It automatically handles
         gradient accumulation if agent is called with --update-freq.
         """
+        if self._number_grad_accum != 0:
+            # keep accumulating until update_params steps
+            return
         self.optimizer.zero_grad()
 
 
@@ -576,6 +723,7 @@ class TrainLoop_fusion_gen:
         self.epoch = self.opt["epoch"]
 
         self.use_cuda = opt["use_cuda"]
+        self.device = resolve_device(opt)
         if opt["load_dict"] != None:
             self.load_data = True
         else:
@@ -606,51 +754,74 @@ class TrainLoop_fusion_gen:
         }
 
         self.build_model(is_finetune=True)
+        # val() runs after every epoch, its data is prepared only once
+        self.eval_batches_cache = {
+            is_test: self.eval_batches(is_test) for is_test in (False, True)
+        }
 
-        if opt["load_dict"] is not None:
+        self.run_dir = run_dir(opt)
+        self.checkpoint_writer = AsyncCheckpointWriter(opt["checkpoint_in_flight"])
+        if opt["resume"] is not None:
+            print("[ Resuming from {} ]".format(opt["resume"]))
+            states = load_states(opt["resume"], self.model)
+        elif opt["load_dict"] is not None:
             # load model parameters if available
             print(
                 "[ Loading existing model params from {} ]" "".format(opt["load_dict"])
             )
-            states = self.model.load(opt["load_dict"])
+            states = load_states(opt["load_dict"], self.model)
         else:
             states = {}
+        self.progress = TrainProgress(["gen"], states if opt["resume"] else None)
 
         self.init_optim(
             [p for p in self.model.parameters() if p.requires_grad],
             optim_states=states.get("optimizer"),
             saved_optim_type=states.get("optimizer_type"),
         )
+        # a checkpoint at the end of an epoch may be inside an update_freq window
+        self._number_grad_accum = load_grad_accum(self.model, states)
 
     def build_model(self, is_finetune):
         self.model = CrossModel(self.opt, self.dict, is_finetune)
         if self.opt["embedding_type"] != "random":
             pass
-        if self.use_cuda:
-            self.model.cuda()
+        self.model.to(self.device)
 
     def train(self):
-        self.model.load_model()
-        losses = []
-        best_val_gen = 1000
+        if not self.progress.resumed:
+            self.model.load_model(init_model_path(self.opt, "boc_net_parameter1.pkl"))
+        best_val_gen = self.progress.values.get("best_val_gen", 1000)
         gen_stop = False
 
         neg_edge_index = negative_sampling(
                 edge_index=self.model.word_item_edge_sets, num_nodes=6000,
-                num_neg_samples = 5 * self.model.word_item_edge_sets.size(1) , method='sparse').cuda()
+                num_neg_samples = 5 * self.model.word_item_edge_sets.size(1) , method='sparse').to(self.device)
     
         self.model.neg_edge_index = neg_edge_index
 
+        loss_log = LossLog(
+            "gen",
+            ["gen_loss", "bow_loss"],
+            self.opt["log_every"],
+            self.loss_sink(),
+            start=self.progress.steps,
+        )
         for i in range(self.epoch * 3):
+            if self.progress.done("gen", i):
+                continue
+            skip = self.progress.start("gen", i)
             train_set = CRSdataset(
                 self.train_dataset.data_process(True),
                 self.opt["n_entity"],
                 self.opt["n_concept"],
             )
             train_dataset_loader = torch.utils.data.DataLoader(
-                dataset=train_set, batch_size=self.batch_size, shuffle=False
+                dataset=train_set,
+                batch_size=self.batch_size,
+                # a resumed run skips the batches it has trained on
+                sampler=range(skip * self.batch_size, len(train_set)),
             )
-            num = 0
             for (
                 context,
                 c_lengths,
@@ -666,7 +837,10 @@ class TrainLoop_fusion_gen:
                 concept_vec,
                 db_vec,
                 rec,
-            ) in tqdm(train_dataset_loader):
+            ) in tqdm(
+                self.progress.batches(train_dataset_loader),
+                total=len(train_dataset_loader),
+            ):
                 seed_sets = []
                 batch_size = context.shape[0]
                 for b in range(batch_size):
@@ -685,16 +859,16 @@ class TrainLoop_fusion_gen:
                     info_db_loss,
                     info_con_loss,
                 ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
+                    context.to(self.device),
+                    response.to(self.device),
+                    mask_response.to(self.device),
                     concept_mask,
                     dbpedia_mask,
                     seed_sets,
                     movie,
                     concept_vec,
                     db_vec,
-                    entity_vector.cuda(),
+                    entity_vector.to(self.device),
                     rec,
                     test=False,
                     pretrain = False,
@@ -702,30 +876,47 @@ class TrainLoop_fusion_gen:
 
                 joint_loss = gen_loss + 0.25 * mask_loss
 
-                losses.append([gen_loss, mask_loss])
+                loss_log.add(gen_loss, mask_loss)
                 self.backward(joint_loss)
                 self.update_params()
-                if num % 50 == 0:
-                    print(
-                        "gen loss is %f" % (sum([l[0] for l in losses]) / len(losses))
-                    )
-                    print(
-                        "bow loss is %f" % (sum([l[1] for l in losses]) / len(losses))
-                    )
-                    losses = []
-                num += 1
+                self.progress.step()
+                if self.checkpoint_due():
+                    self.save_checkpoint(best_val_gen=best_val_gen)
 
+            loss_log.flush(wait=True)
             output_metrics_gen = self.val()
             if best_val_gen < output_metrics_gen["dist4"]:
                 pass
             else:
                 best_val_gen = output_metrics_gen["dist4"]
-                self.model.save_model()
+                self.model.save_model(
+                    os.path.join(self.run_dir, "boc_net_parameter1.pkl"),
+                    self.checkpoint_writer,
+                )
                 print(
                     "generator model saved once------------------------------------------------"
                 )
+            self.progress.end_epoch()
+            self.save_checkpoint(best_val_gen=best_val_gen)
 
         _ = self.val(is_test=True)
+        # the last checkpoints are still being written
+        self.checkpoint_writer.wait()
+
+    def eval_batches(self, is_test):
+        """The collated batches of the test or valid split."""
+        if is_test:
+            val_dataset = dataset("data/test_data.jsonl", self.opt)
+        else:
+            val_dataset = dataset("data/valid_data.jsonl", self.opt)
+        val_set = CRSdataset(
+            val_dataset.data_process(True), self.opt["n_entity"], self.opt["n_concept"]
+        )
+        return EvalBatches(
+            torch.utils.data.DataLoader(
+                dataset=val_set, batch_size=self.batch_size, shuffle=False
+            )
+        )
 
     def val(self, is_test=False):
         self.metrics_gen = {
@@ -750,16 +941,7 @@ class TrainLoop_fusion_gen:
             "gate_count": 0,
         }
         self.model.eval()
-        if is_test:
-            val_dataset = dataset("data/test_data.jsonl", self.opt)
-        else:
-            val_dataset = dataset("data/valid_data.jsonl", self.opt)
-        val_set = CRSdataset(
-            val_dataset.data_process(True), self.opt["n_entity"], self.opt["n_concept"]
-        )
-        val_dataset_loader = torch.utils.data.DataLoader(
-            dataset=val_set, batch_size=self.batch_size, shuffle=False
-        )
+        val_dataset_loader = self.eval_batches_cache[is_test]
         inference_sum = []
         golden_sum = []
         context_sum = []
@@ -797,16 +979,16 @@ class TrainLoop_fusion_gen:
                     info_db_loss,
                     info_con_loss,
                 ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
+                    context.to(self.device),
+                    response.to(self.device),
+                    mask_response.to(self.device),
                     concept_mask,
                     dbpedia_mask,
                     seed_sets,
                     movie,
                     concept_vec,
                     db_vec,
-                    entity_vector.cuda(),
+                    entity_vector.to(self.device),
                     rec,
                     test=False,
                     pretrain = False
@@ -821,16 +1003,16 @@ class TrainLoop_fusion_gen:
                     info_db_loss,
                     info_con_loss,
                 ) = self.model(
-                    context.cuda(),
-                    response.cuda(),
-                    mask_response.cuda(),
+                    context.to(self.device),
+                    response.to(self.device),
+                    mask_response.to(self.device),
                     concept_mask,
                     dbpedia_mask,
                     seed_sets,
                     movie,
                     concept_vec,
                     db_vec,
-                    entity_vector.cuda(),
+                    entity_vector.to(self.device),
                     rec,
                     test=True,
                     maxlen=20,
@@ -866,79 +1048,16 @@ class TrainLoop_fusion_gen:
         return output_dict_gen
 
     def metrics_cal_gen(self, rec_loss, preds, responses, recs):
-        def bleu_cal(sen1, tar1):
-            bleu1 = sentence_bleu([tar1], sen1, weights=(1, 0, 0, 0))
-            bleu2 = sentence_bleu([tar1], sen1, weights=(0, 1, 0, 0))
-            bleu3 = sentence_bleu([tar1], sen1, weights=(0, 0, 1, 0))
-            bleu4 = sentence_bleu([tar1], sen1, weights=(0, 0, 0, 1))
-            return bleu1, bleu2, bleu3, bleu4
-
-        def distinct_metrics(outs):
-            # outputs is a list which contains several sentences, each sentence contains several words
-            unigram_count = 0
-            bigram_count = 0
-            trigram_count = 0
-            quagram_count = 0
-            unigram_set = set()
-            bigram_set = set()
-            trigram_set = set()
-            quagram_set = set()
-            for sen in outs:
-                for word in sen:
-                    unigram_count += 1
-                    unigram_set.add(word)
-                for start in range(len(sen) - 1):
-                    bg = str(sen[start]) + " " + str(sen[start + 1])
-                    bigram_count += 1
-                    bigram_set.add(bg)
-                for start in range(len(sen) - 2):
-                    trg = (
-                        str(sen[start])
-                        + " "
-                        + str(sen[start + 1])
-                        + " "
-                        + str(sen[start + 2])
-                    )
-                    trigram_count += 1
-                    trigram_set.add(trg)
-                for start in range(len(sen) - 3):
-                    quag = (
-                        str(sen[start])
-                        + " "
-                        + str(sen[start + 1])
-                        + " "
-                        + str(sen[start + 2])
-                        + " "
-                        + str(sen[start + 3])
-                    )
-                    quagram_count += 1
-                    quagram_set.add(quag)
-            dis1 = len(unigram_set) / len(outs)  # unigram_count
-            dis2 = len(bigram_set) / len(outs)  # bigram_count
-            dis3 = len(trigram_set) / len(outs)  # trigram_count
-            dis4 = len(quagram_set) / len(outs)  # quagram_count
-            return dis1, dis2, dis3, dis4
-
-        predict_s = preds
-        golden_s = responses
         # print(rec_loss[0])
         # self.metrics_gen["ppl"]+=sum([exp(ppl) for ppl in rec_loss])/len(rec_loss)
-        generated = []
-
-        for out, tar, rec in zip(predict_s, golden_s, recs):
-            bleu1, bleu2, bleu3, bleu4 = bleu_cal(out, tar)
-            generated.append(out)
-            self.metrics_gen["bleu1"] += bleu1
-            self.metrics_gen["bleu2"] += bleu2
-            self.metrics_gen["bleu3"] += bleu3
-            self.metrics_gen["bleu4"] += bleu4
-            self.metrics_gen["count"] += 1
-
-        dis1, dis2, dis3, dis4 = distinct_metrics(generated)
-        self.metrics_gen["dist1"] = dis1
-        self.metrics_gen["dist2"] = dis2
-        self.metrics_gen["dist3"] = dis3
-        self.metrics_gen["dist4"] = dis4
+        bleus = bleu_scores(preds, responses, workers=self.opt["metric_workers"])
+        for n, bleu in enumerate(bleus.T.tolist(), 1):
+            # summed in order, like the per-sample scores before
+            self.metrics_gen[f"bleu{n}"] += sum(bleu)
+        self.metrics_gen["count"] += len(preds)
+
+        for n, dis in enumerate(distinct(preds), 1):
+            self.metrics_gen[f"dist{n}"] = dis
 
     def vector2sentence(self, batch_sen):
         sentences = []
@@ -1012,6 +1131,34 @@ class TrainLoop_fusion_gen:
 
         optim_class = self.optim_opts()[opt["optimizer"]]
         self.optimizer = optim_class(params, **kwargs)
+        if optim_states is not None and saved_optim_type == opt["optimizer"]:
+            self.optimizer.load_state_dict(optim_states)
+        self._number_grad_accum = 0
+
+    def checkpoint_due(self):
+        """Whether --checkpoint_every optimizer steps have passed since the last one."""
+        every = self.opt["checkpoint_every"]
+        steps = self.progress.steps // self.opt["update_freq"]
+        return every > 0 and self._number_grad_accum == 0 and steps % every == 0
+
+    def save_checkpoint(self, **values):
+        """
+        Write the full training state to the run directory, see checkpoint.py.
+
+        ``values`` are the loop variables to resume with.
+        """
+        states = self.progress.state(**values)
+        states.update(grad_accum_state(self.model, self._number_grad_accum))
+        states.update(
+            model=self.model.state_dict(),
+            optimizer=self.optimizer.state_dict(),
+            optimizer_type=self.opt["optimizer"],
+        )
+        self.checkpoint_writer.save(states, os.path.join(self.run_dir, CHECKPOINT))
+
+    def loss_sink(self):
+        """Print the LossLog records and append them to run_dir/losses.jsonl."""
+        return print_losses(os.path.join(self.run_dir, "losses.jsonl"))
 
     def backward(self, loss):
         """
@@ -1019,6 +1166,8 @@ class TrainLoop_fusion_gen:
         loss.backward(), for integration with distributed training and FP16
         training.
         """
+        # the step applies the mean of the micro-batch gradients
+        loss = loss / self.opt["update_freq"]
         loss.backward()
 
     def update_params(self):
@@ -1029,7 +1178,7 @@ class TrainLoop_fusion_gen:
 
         It is recommended (but not forced) that you call this in train_step.
         """
-        update_freq = 1
+        update_freq = self.opt["update_freq"]
         if update_freq > 1:
             # we're doing gradient accumulation, so we don't only want to step
             # every N updates instead
@@ -1051,6 +1200,9 @@ class TrainLoop_fusion_gen:
         It is recommended you call this in train_step. It automatically handles
         gradient accumulation if agent is called with --update-freq.
         """
+        if self._number_grad_accum != 0:
+            # keep accumulating until update_params steps
+            return
         self.optimizer.zero_grad()
 
 
@@ -1058,6 +1210,7 @@ if __name__ == "__main__":
     args = setup_args().parse_args()
     print(vars(args))
     seed_all(vars(args)["random_seed"])
+    configure_cpu(args.intra_op_threads, args.inter_op_threads, args.numa_node)
 #     wandb.config.update(args)
     if args.is_finetune == False:
         loop = TrainLoop_fusion_rec(vars(args), is_finetune=False)
@@ -1066,7 +1219,8 @@ if __name__ == "__main__":
     else:
         loop = TrainLoop_fusion_gen(vars(args), is_finetune=True)
         # loop.train()
-        loop.model.load_model()
+        if args.resume is None:
+            loop.model.load_model(init_model_path(vars(args), "boc_net_parameter1.pkl"))
         # met = loop.val(True)
         loop.train()
     met = loop.val(True)